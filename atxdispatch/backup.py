@@ -0,0 +1,112 @@
+""" Database backups via SQLite online backup API
+
+    Unlike plain file copy, online backup produces consistent snapshot even if someone writes into the DB
+    (and it includes changes still sitting in WAL file). DB is copied in big steps (settings.DB_BACKUP_STEP_PAGES)
+    with progress logged after every step. In WAL mode the backup is just a reader, so writers are not blocked,
+    but write by other connection between steps restarts the backup, so steps follow each other without pause.
+
+    Backups are named <timestamp>.sqlite3 in settings.DB_BACKUP_PATH, only settings.DB_BACKUP_KEEP newest are kept.
+    Backup is written into temporary file <timestamp>.sqlite3_ first, leftovers of unfinished backups are removed.
+"""
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from . import func
+from . import settings
+
+_BACKUP_FN_RE = re.compile(r"^\d{8}-\d{6}(-\d{6})?\.sqlite3$")  # older backups have no microseconds
+
+_DEFAULT = object()  # default argument, which differs from None
+
+
+def _backup_sort_key(fn):
+    timestamp = fn.removesuffix(".sqlite3")
+    return timestamp if len(timestamp) > 15 else f"{timestamp}-000000"
+
+
+def rotate_backups(backup_path, keep):
+    """ Deletes all but <keep> newest backups in <backup_path>, and unfinished backups.
+        Files not looking like backup are left untouched
+    """
+    for fn in os.listdir(backup_path):
+        if fn.endswith("_") and _BACKUP_FN_RE.match(fn[:-1]):
+            logging.info(f"Removing unfinished DB backup {fn}")
+            os.remove(func.asterixed_path(backup_path, fn))
+    if not keep:
+        return
+    backups = sorted((fn for fn in os.listdir(backup_path) if _BACKUP_FN_RE.match(fn)), key=_backup_sort_key)
+    for fn in backups[:-keep]:
+        logging.info(f"Removing old DB backup {fn}")
+        os.remove(func.asterixed_path(backup_path, fn))
+
+
+def _log_progress(backup_fn):
+    def progress(status, remaining, total):
+        logging.info(f"Backing up to {backup_fn}: {total - remaining}/{total} pages copied")
+    return progress
+
+
+def backup_db(database_fn, backup_path=None, keep=_DEFAULT):
+    """ Backs up <database_fn> into new file in <backup_path>, rotates old backups (keeps settings.DB_BACKUP_KEEP
+        newest by default, <keep> None = keep all). Returns filename of backup
+    """
+    backup_path = backup_path or settings.DB_BACKUP_PATH
+    keep = settings.DB_BACKUP_KEEP if keep is _DEFAULT else keep
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    backup_fn = func.asterixed_path(backup_path, f"{timestamp}.sqlite3")
+    os.makedirs(backup_path, exist_ok=True)
+
+    t = time.time()
+    logging.info(f"Backing up {database_fn} to {backup_fn}")
+
+    # write into temporary file first, so there is never a half-written backup with a valid name
+    src = sqlite3.connect(database_fn, timeout=settings.DB_TIMEOUT)
+    dst = sqlite3.connect(f"{backup_fn}_")
+    try:
+        src.backup(dst, pages=settings.DB_BACKUP_STEP_PAGES, progress=_log_progress(backup_fn), sleep=0)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(f"{backup_fn}_", backup_fn)
+
+    logging.info(f"Database backed up to {backup_fn} in {time.time() - t:.1f} sec")
+    rotate_backups(backup_path, keep)
+    return backup_fn
+
+
+class BackupThread(threading.Thread):
+    """Backs up database every <interval> seconds (never if interval is None) and once more when stopped (if <on_exit>)"""
+
+    def __init__(self, database_fn, interval=None, on_exit=True):
+        super().__init__(name="db-backup", daemon=True)
+        self.database_fn = database_fn
+        self.interval = interval
+        self.on_exit = on_exit
+        self._stop_event = threading.Event()
+
+    def _backup(self):
+        try:
+            backup_db(self.database_fn)
+        except Exception:
+            logging.exception(f"Backup of {self.database_fn} failed")
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self._backup()
+        if self.on_exit:
+            self._backup()
+
+    def stop(self, timeout=None):
+        """ Stops the thread and waits for backup in progress and the final one, at most <timeout> seconds (None = until
+            finished). Backup unfinished in <timeout> is abandoned (daemon thread dies with the process)
+        """
+        self._stop_event.set()
+        self.join(timeout)
+        if self.is_alive():
+            logging.warning(f"Backup of {self.database_fn} not finished in {timeout} sec, exiting without it")
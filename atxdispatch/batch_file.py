@@ -0,0 +1,146 @@
+""" Single-pass parser of communication files received from manager (.be2, but also .std, .ddm, .int)
+
+    Formerly every section was read by separate atxcomm.*_from_ini_f call, which means reading and parsing
+    the same file up to five times. BatchFile reads the file once, line by line, and provides all sections.
+
+    Each section is a hashtable in the same format as atxcomm returns it:
+    plain values are under their keys, materials (keys like "Cement1_Weight") are gathered in list
+    under "materials" key, each material has its original prefix (e.g. "Cement1") under "_k_orig" key.
+
+    Values are strings (empty value is None), only values of NUMBERS keys are converted, because dispatch
+    compares or sums them. Everything else is converted (if needed) by model fields when written into DB.
+"""
+import logging
+import re
+
+# Material keys are <material name><number>_<key>, e.g. "Aggregate3_Weight", "AdMixture1_Name" or "Fiber2_Weight"
+_MATERIAL_KEY_RE = re.compile(r"^([A-Za-z]+\d+)_(.+)$")
+
+# Keys (of plain values and of materials) with numeric values -> conversion
+NUMBERS = {
+    "ID": int,
+    "Sequence": int,
+    "Total": int,
+    "Weight": float,
+}
+
+# Manager writes files in Windows encoding
+ENCODING = "cp1250"
+
+
+def _value(key, s):
+    """Converts ini value of <key> to number if it is one of NUMBERS, otherwise returns str. Empty value is None"""
+    if s == "":
+        return None
+    if (type_ := NUMBERS.get(key)) is not None:
+        try:
+            return type_(s)
+        except ValueError:
+            logging.warning(f"{key}={s} is not a number")
+    return s
+
+
+class BatchFile:
+    """ Parsed communication file. Sections are available as properties (see list below), or via section(name).
+        Missing section is returned as empty one, so callers can use .get() without further checks.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._sections = {}
+        with open(fn, "r", encoding=ENCODING, errors="replace") as f:
+            self._parse(f)
+
+    def _parse(self, lines):
+        section = None
+        materials = None  # _k_orig -> material of current section
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith((";", "#")):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                section = self._sections.setdefault(line[1:-1].strip(), {"materials": []})
+                materials = {x["_k_orig"]: x for x in section["materials"]}
+                continue
+            key, sep, value = line.partition("=")
+            if section is None or not sep:
+                continue  # garbage outside of section or damaged line
+            key = key.strip()
+            value = value.strip()
+            if m := _MATERIAL_KEY_RE.match(key):
+                k_orig, k = m.groups()
+                if (material := materials.get(k_orig)) is None:
+                    material = materials[k_orig] = {"_k_orig": k_orig}
+                    section["materials"].append(material)
+                material[k] = _value(k, value)
+            else:
+                section[key] = _value(key, value)
+
+    def section(self, name):
+        return self._sections.get(name, {"materials": []})
+
+    @property
+    def order(self):
+        return self.section("Order")
+
+    @property
+    def recipe(self):
+        return self.section("Recipe")
+
+    @property
+    def batch_request(self):
+        return self.section("Batch_Request")
+
+    @property
+    def batch_evidence1(self):
+        return self.section("Batch_Evidence1")
+
+    @property
+    def batch_evidence2(self):
+        return self.section("Batch_Evidence2")
+
+    def _index_by_id(self, section):
+        """ Returns hashtable material ID -> material of <section>.
+            Because of materials in production sections ([Batch_Request], [Batch_Evidence1] and [Batch_Evidence2])
+            sometimes do not contain ID, they must be paired (via _k_orig part) to appropriate material in [Recipe] section, where ID is present.
+        """
+        recipe_by_k_orig = {}
+        for x in self.recipe["materials"]:
+            recipe_by_k_orig.setdefault(x["_k_orig"], x)
+
+        ret = {}
+        for m in section["materials"]:
+            recipe_material = recipe_by_k_orig.get(m["_k_orig"])
+            if recipe_material is None:
+                # There is material in production section, that is not in Recipe.
+                # This should be common case and we can safely ignore it. TODO QUE Review this assumption
+                continue
+
+            # This line SHOULD crash with KeyError, when there is material without ID in recipe_section (thus not existing in our DB):
+            # It can indicate integrity problem (someone deleted material from our DB) or it indicates
+            # that someone (propably manager) modified [Recipe] section, which is not permitted
+            ret.setdefault(recipe_material["ID"], m)
+        return ret
+
+    def paired_materials(self):
+        """ Returns list of tuples (recipe_material, material_rq, material_ev1) for every material in [Recipe] section,
+            where material_rq is from [Batch_Request] and material_ev1 from [Batch_Evidence1] section (or None if not found).
+            Indexes are built once per file, so pairing is linear in number of materials.
+        """
+        request_by_id = self._index_by_id(self.batch_request)
+        evidence1_by_id = self._index_by_id(self.batch_evidence1)
+
+        ret = []
+        for material in self.recipe["materials"]:
+            mid = material["ID"]
+            material_rq = request_by_id.get(mid)
+            material_ev1 = evidence1_by_id.get(mid)
+            # There is no material with such ID. It means that manager sent us .be2 file without that material
+            # in one of production sections. This is propably not an error, maybe manager just does not used it
+            # for some reason - so we just log this situation and continue TODO QUE: review this assumptions
+            if material_rq is None:
+                logging.warning(f"Can't find material {mid} in {self.fn}")
+            if material_ev1 is None:
+                logging.warning(f"Can't find material {mid} in {self.fn}")
+            ret.append((material, material_rq, material_ev1))
+        return ret
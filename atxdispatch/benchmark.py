@@ -0,0 +1,514 @@
+"""
+Benchmarks of hot paths. Not part of the program, run it by hand: python -m atxdispatch.benchmark [options]
+
+Usage:
+  benchmark [options]
+
+Options:
+  --scales <counts>      Comma separated numbers of orders to benchmark with [default: 10000,100000,1000000]
+  --seed <seed>          Seed of generated data, the same scale and seed always give the same DB [default: 1]
+  --repeat <count>       Every case is run <count> times, the best time is taken [default: 5]
+  --db-path <path>       Keep generated DBs in <path> and reuse them in next runs (generating 1M orders takes long)
+  --output <fn>          Write results as JSON into <fn>
+  --compare <fn>         Compare results with JSON written by previous run, exit with 1 when a case is slower
+                         by more than --threshold
+  --threshold <percent>  Allowed slowdown of a case against --compare results [default: 20]
+  --micro                Run micro-benchmarks be2_pairing and consumption (see below) instead of the suite
+
+Suite: for every scale, DB is populated by model_utils.bigdata(<scale>), plus prices, transport zones and pump order.
+Then following cases are timed, each of them doing fixed number of operations (see constants below):
+
+    produce                        dispatch.produce() of PRODUCE_ORDERS orders (recipes with RECIPE_MATERIALS materials)
+    update_material_consumption    parsing and processing of .be2 file of every order produced above
+    ux/<model>                     queryset_to_ux() of UX_ROWS newest records, for every model in SD_TABLES
+    price/get_best_price           LOOKUPS calls of Price.get_best_price with random recipe, customer and site
+    price/build_cache              rebuild of Price cache (done after any change of prices)
+    transport_zone/get_zones       LOOKUPS calls of TransportZone.get_zones with random distance and vehicle
+    printout/<template>            rendering of every printout template
+
+Results of two versions (e.g. before and after a change) are compared by --output in the first run
+and --compare in the second one. Only cases slower by more than --threshold percent AND by more than
+REGRESSION_MIN_SECONDS are reported as regressions, so that noise of very short cases does not fail the comparison.
+
+Micro-benchmarks:
+
+    be2_pairing: parses synthetic .be2 files with growing count of materials and pairs
+    [Recipe] materials with production sections. Time per material should stay (roughly) constant,
+    i.e. cost per file is linear in material count.
+
+    consumption: material consumption report (Material.select_consumptions) over temporary DB
+    with 1M BatchMaterial rows, for one month and for entire history. One month is compared with
+    former implementation (query per material, consumptions loaded lazily and summed in Python).
+"""
+import contextlib
+import inspect
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import arrow
+import docopt
+import jinja2
+from peewee import chunked
+
+from .version import __version__
+from . import dispatch
+from . import glo
+from . import model
+from . import model_utils
+from . import settings
+from . import template_filters
+from .batch_file import BatchFile, ENCODING
+
+MATERIAL_TYPES = ["Aggregate", "Cement", "Water", "Admixture", "Addition"]
+
+PRODUCE_ORDERS = 20  # orders produced (and .be2 files processed) in one run of produce case
+RECIPE_MATERIALS = 8  # materials of recipes used by produce case, a common concrete has 6-10 of them
+UX_ROWS = 500  # records converted by queryset_to_ux in one run, about what UX loads at once
+LOOKUPS = 1000  # calls of get_best_price and get_zones in one run
+PRICES_PER_ORDERS = 100  # one price record per this number of orders
+TRANSPORT_ZONES = 20
+REGRESSION_MIN_SECONDS = 0.005  # differences below this are noise, never reported as regression
+
+
+def _write_be2(fn, order_id, materials):
+    """ Writes .be2 file for <order_id>, <materials> is list of (k_orig, name, weight, order_material_id).
+        Production sections list materials in reversed order, so naive pairing would scan the whole list
+    """
+    lines = ["[Order]", f"ID={order_id}", "Volume=1.0", ""]
+    lines += ["[Recipe]", "ID=1", "Name=Synthetic"]
+    for k_orig, name, weight, order_material_id in materials:
+        lines += [f"{k_orig}_Name={name}", f"{k_orig}_Weight={weight}", f"{k_orig}_ID={order_material_id}"]
+    lines += ["", "[Batch_Request]", "Sequence=1", "Total=1", "Volume=1.0", "Date=01.01.2024", "Time=8:00:00"]
+    for k_orig, _, weight, _ in reversed(materials):
+        lines += [f"{k_orig}_Weight={weight}", f"{k_orig}_Silo_Major=1", f"{k_orig}_Humidity=2.5"]
+    lines += ["", "[Batch_Evidence1]", "ProductionMode=A"]
+    for k_orig, _, weight, _ in reversed(materials):
+        lines += [f"{k_orig}_Weight={weight - 1}", f"{k_orig}_Silo_Major=1"]
+    lines += ["", "[Batch_Evidence2]", "Date=01.01.2024", "Time=8:01:00", ""]
+    with open(fn, "w", encoding=ENCODING) as f:
+        f.write("\n".join(lines))
+
+
+def synthetic_be2(fn, materials_count):
+    """Writes .be2 file with <materials_count> materials in [Recipe], [Batch_Request] and [Batch_Evidence1] sections"""
+    k_origs = [f"{MATERIAL_TYPES[i % len(MATERIAL_TYPES)]}{i // len(MATERIAL_TYPES) + 1}" for i in range(materials_count)]
+    _write_be2(fn, 1, [(k_orig, f"M{i}", 100 + i, i + 1) for i, k_orig in enumerate(k_origs)])
+
+
+def order_be2(fn, order):
+    """Writes .be2 file of one batch of <order>, the same as manager sends after batch of produced order is mixed"""
+    counters = {}
+    materials = []
+    for m in order.materials.order_by(model.OrderMaterial.sequence_number):
+        counters[m.type] = counters.get(m.type, 0) + 1
+        materials.append((f"{m.type}{counters[m.type]}", m.name, m.amount, m.id))
+    _write_be2(fn, order.id, materials)
+
+
+def bench_be2_pairing(counts=(10, 100, 1000, 10000), repeat=5):
+    """Returns list of (materials_count, seconds_per_file, microseconds_per_material)"""
+    ret = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            fn = os.path.join(tmp, f"{count}.be2")
+            synthetic_be2(fn, count)
+            best = None
+            for _ in range(repeat):
+                t = time.perf_counter()
+                pairs = BatchFile(fn).paired_materials()
+                elapsed = time.perf_counter() - t
+                best = elapsed if best is None else min(best, elapsed)
+            assert len(pairs) == count and all(rq and ev1 for _, rq, ev1 in pairs)
+            ret.append((count, best, best / count * 1e6))
+    return ret
+
+
+def populate_production(batch_materials_count, materials_count=10, batches_per_order=5, days=730, seed=1):
+    """ Fills mounted (empty) DB with orders, batches and consumptions, returns (first_t, last_t) of orders.
+        Every order consumes all <materials_count> materials in every batch
+    """
+    rng = random.Random(seed)
+    materials = [model.Material.create(type=MATERIAL_TYPES[i % len(MATERIAL_TYPES)], name=f"M{i}") for i in range(materials_count)]
+    orders_count = max(1, batch_materials_count // (batches_per_order * materials_count))
+    first_t = 1_600_000_000
+    last_t = first_t + days * 86400
+
+    with model.db.atomic():
+        orders = [{"id": i + 1, "r_name": "R", "volume": 8.0, "auto_number": i + 1, "t": rng.randint(first_t, last_t)} for i in range(orders_count)]
+        for rows in chunked(orders, 100):
+            model.Order.insert_many(rows).execute()
+
+        order_materials = [
+            {"id": o * materials_count + m + 1, "type": materials[m].type, "name": materials[m].name, "material": materials[m].id,
+             "sequence_number": m, "order": o + 1, "amount": 100.0}
+            for o in range(orders_count) for m in range(materials_count)
+        ]
+        for rows in chunked(order_materials, 100):
+            model.OrderMaterial.insert_many(rows).execute()
+
+        batches = [{"id": o * batches_per_order + b + 1, "order": o + 1, "volume": 1.6} for o in range(orders_count) for b in range(batches_per_order)]
+        for rows in chunked(batches, 200):
+            model.Batch.insert_many(rows).execute()
+
+        def batch_materials():
+            for batch_id in range(1, orders_count * batches_per_order + 1):
+                order_index = (batch_id - 1) // batches_per_order
+                for m in range(materials_count):
+                    amount = rng.uniform(10, 200)
+                    yield {
+                        "batch": batch_id, "material": order_index * materials_count + m + 1,
+                        "amount_recipe": amount, "amount_rq": amount, "amount_e1": amount * rng.uniform(0.98, 1.02),
+                    }
+        for rows in chunked(batch_materials(), 150):
+            model.BatchMaterial.insert_many(rows).execute()
+    return first_t, last_t
+
+
+def _consumptions_naive(material, from_t, to_t):
+    """Former implementation of Material.get_consumptions, for comparison"""
+    amount_recipe = amount_rq = amount_e1 = 0
+    order_materials = model.OrderMaterial.select().join(model.Order).where(model.Order.t.between(from_t, to_t)).filter(name=material.name)
+    for order_material in order_materials:
+        for bm in order_material.consumptions:
+            amount_recipe += bm.amount_recipe
+            amount_rq += bm.amount_rq
+            amount_e1 += bm.amount_e1
+    return amount_recipe, amount_rq, amount_e1
+
+
+def bench_consumption(batch_materials_count=1_000_000):
+    """Returns list of (case, seconds)"""
+    ret = []
+    with tempfile.TemporaryDirectory() as tmp:
+        model.mount_db(os.path.join(tmp, "bench.sqlite3"))
+        try:
+            model.db.create_tables(model.TABLES)
+            t = time.perf_counter()
+            first_t, last_t = populate_production(batch_materials_count)
+            ret.append(("populate", time.perf_counter() - t))
+            model.db.execute_sql("ANALYZE")
+
+            month = (last_t - 30 * 86400, last_t)
+            t = time.perf_counter()
+            month_sums = {x.name: (x.amount_recipe, x.amount_rq, x.amount_e1) for x in model.Material.select_consumptions(*month)}
+            ret.append(("month", time.perf_counter() - t))
+
+            t = time.perf_counter()
+            naive_sums = {x.name: _consumptions_naive(x, *month) for x in model.Material.select()}
+            ret.append(("month, former implementation", time.perf_counter() - t))
+            assert all(abs(a - b) < 1e-6 for name in naive_sums for a, b in zip(naive_sums[name], month_sums[name]))
+
+            t = time.perf_counter()
+            list(model.Material.select_consumptions(first_t, last_t))
+            ret.append(("entire history", time.perf_counter() - t))
+        finally:
+            model.db.close()
+    return ret
+
+
+def populate_suite(orders_count, seed):
+    """ Fills mounted (empty) DB by model_utils.bigdata(<orders_count>) and adds what bigdata does not generate:
+        prices, transport zones, a pump order and recipes with RECIPE_MATERIALS materials for produce case
+    """
+    # bigdata uses global random generator (also indirectly via func.random_string), seeding it makes DB reproducible
+    random.seed(seed)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):  # bigdata prints every record
+        model_utils.bigdata(orders_count)
+
+    rng = random.Random(seed)
+    with model.db.atomic():
+        model.Recipe.update(price=1000 + model.Recipe.id % 500).execute()  # bigdata leaves recipes without price
+        recipe_ids = [x.id for x in model.Recipe.select(model.Recipe.id)]
+        customer_ids = [x.id for x in model.Customer.select(model.Customer.id)]
+        site_ids = [x.id for x in model.ConstructionSite.select(model.ConstructionSite.id)]
+        material_ids = [x.id for x in model.Material.select(model.Material.id)]
+
+        prices = {}
+        for _ in range(max(1, orders_count // PRICES_PER_ORDERS)):
+            key = (rng.choice(recipe_ids), rng.choice([None, rng.choice(customer_ids)]), rng.choice([None, None, rng.choice(site_ids)]))
+            prices[key] = {
+                "recipe": key[0], "customer": key[1], "construction_site": key[2],
+                "type": rng.choice(model.Price.PRICE_TYPES), "amount": rng.uniform(-10, 100),
+            }
+        for rows in chunked(prices.values(), 100):
+            model.Price.insert_many(rows).execute()
+
+        transport_types = [model.TransportType.create(name=f"Type {i}") for i in range(3)]
+        for car in model.Car.select():
+            car.transport_type = rng.choice(transport_types)
+            car.save()
+        for i in range(TRANSPORT_ZONES):
+            model.TransportZone.create(
+                distance_km_min=i * 10, distance_km_max=(i + 1) * 10 + rng.randint(0, 15), price_per_m3=100 + i * 20,
+                transport_type=rng.choice(transport_types),
+            )
+
+        for recipe_id in recipe_ids[:PRODUCE_ORDERS]:
+            for material_id in rng.sample(material_ids, min(RECIPE_MATERIALS - 1, len(material_ids))):
+                model.RecipeMaterial.create(recipe=recipe_id, material=material_id, amount=rng.uniform(10, 1000))
+
+        model.PumpOrder.create(auto_number=1, kms=12, hours=3, pump_registration_number="1AB 2345", customer_name="Zakaznik")
+    model.invalidate_caches()
+
+
+def _printout_env():
+    """ Jinja environment for printouts, set up like the one of web UI: template filters are registered under their
+        function names. Globals of web UI are replaced by stand-ins (tran does not translate), and values of context
+        which the suite does not fill are rendered as empty
+    """
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(settings.TEMPLATE_FOLDER), autoescape=True, undefined=jinja2.ChainableUndefined,
+    )
+    env.filters.update({
+        name: f for name, f in inspect.getmembers(template_filters, inspect.isfunction) if f.__module__ == template_filters.__name__
+    })
+    env.globals.update(
+        tran=lambda s: s,
+        if_none=lambda x, default: default if x is None else x,
+        rounded=template_filters.round_me,
+    )
+    return env
+
+
+def _printout_contexts(order, from_t, to_t):
+    """Returns {template: context} for every printout template"""
+    setup = model.Setup.singleton()
+    materials = {}
+    for m in order.materials:
+        materials.setdefault(m.type, []).append(m)
+    dates = {
+        "date_from": arrow.get(from_t).format("YYYY-MM-DD"),
+        "date_to": arrow.get(to_t).format("YYYY-MM-DD"),
+        "date_now": arrow.now().format("YYYY-MM-DD"),
+    }
+    orders = list(model.Order.select().where(model.Order.t.between(from_t, to_t)).order_by(model.Order.t).limit(UX_ROWS))
+    # production overview: orders grouped by customer, site and recipe, with sums on every level
+    sums = {"volume": 0, "price_concrete": 0, "price_transport": 0, "price_surcharges": 0, "price": 0}
+    customers = {}
+    overview_totals = dict(sums)
+    for o in orders:
+        customer = customers.setdefault(o.customer, {"str": o.customer, "items": {}, "sum": dict(sums)})
+        site = customer["items"].setdefault(o.construction_site, {"items": {}, "sum": dict(sums)})
+        recipe = site["items"].setdefault(o.r_name, {"items": [], "sum": dict(sums)})
+        recipe["items"].append(o)
+        for level in (customer, site, recipe, {"sum": overview_totals}):
+            for k in sums:
+                level["sum"][k] += (o.calc_price() if k == "price" else getattr(o, k)) or 0
+
+    totals = {}  # consumption of every material in all batches of <order>
+    for bm in model.BatchMaterial.select().join(model.Batch).where(model.Batch.order == order):
+        t = totals.setdefault(bm.material.name, {"name": bm.material.name, "unit": bm.material.unit, "amount_recipe": 0, "amount_rq": 0, "amount_e1": 0})
+        for k in ("amount_recipe", "amount_rq", "amount_e1"):
+            t[k] += getattr(bm, k) or 0
+
+    ret = {}
+    for fn in sorted(os.listdir(os.path.join(settings.TEMPLATE_FOLDER, "printouts"))):
+        if fn.startswith("_"):
+            continue  # parts included in other templates
+        context = {"setup": setup, "record": order, "materials": materials, "batches": list(order.batches), "sheet_no": 1}
+        if fn == "pumping_sheet.html":
+            context["record"] = model.PumpOrder.get()
+        elif fn == "batch_protocol.html":
+            context["totals"] = list(totals.values())
+        elif fn == "consumption.html":
+            consumptions = list(model.Material.select_consumptions(from_t, to_t))
+            context.update(dates, materials=consumptions, totals={
+                k: sum(getattr(x, k) for x in consumptions) for k in ("amount_recipe", "amount_rq", "amount_e1")
+            })
+        elif fn == "stock.html":
+            context.update(dates, materials=list(model.Material.select_stock(from_t, to_t)))
+        elif fn == "production.html":
+            batches = model.Batch.select().join(model.Order).where(model.Order.t.between(from_t, to_t)).limit(UX_ROWS)
+            context.update(dates, batches=list(batches), material_names=[x.name for x in model.Material.select().limit(10)])
+        elif fn == "production_overview.html":
+            context.update(dates, customers=customers, totals=overview_totals)
+        ret[f"printouts/{fn}"] = context
+    return ret
+
+
+def _best_of(repeat, f, *args):
+    """Returns the best time of <repeat> calls of f(*args, <index of call>)"""
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        f(*args, i)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_suite(orders_count, seed=1, repeat=5, db_path=None):
+    """Returns ({case: {"seconds": best time, "ops": operations in one run}}, {table: rows}) for DB with <orders_count> orders"""
+    ret = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_fn = os.path.join(db_path or tmp, f"bigdata_{orders_count}_{seed}.sqlite3")
+        db_exists = os.path.isfile(db_fn)
+        model.mount_db(db_fn)
+        try:
+            if not db_exists:
+                model_utils.create_tables()
+                t = time.perf_counter()
+                populate_suite(orders_count, seed)
+                model.db.execute_sql("ANALYZE")
+                print(f"{orders_count} orders generated in {time.perf_counter() - t:.1f} sec")
+            # generated DB is kept for next runs, work on its copy, as produce and others write into it
+            work_fn = os.path.join(tmp, "work.sqlite3")
+            with contextlib.closing(sqlite3.connect(work_fn)) as dst:
+                model.db.connection().backup(dst)
+            model.db.close()
+            model.mount_db(work_fn)
+            rows = {x.__name__: x.select().count() for x in (model.Order, model.Recipe, model.Customer, model.Price)}
+            rng = random.Random(seed)
+            glo.setup = {"rounding_precision": 2}  # defaults of dispatch.load_setup(), config of this machine must not matter
+
+            # produce & update_material_consumption
+            recipes = list(model.Recipe.select().join(model.RecipeMaterial).group_by(model.Recipe.id).order_by(model.Recipe.id).limit(PRODUCE_ORDERS))
+            car_ids = [x.id for x in model.Car.select(model.Car.id)]
+            customer_ids = [x.id for x in model.Customer.select(model.Customer.id)]
+            site_ids = [x.id for x in model.ConstructionSite.select(model.ConstructionSite.id)]
+            produced = [[] for _ in range(repeat)]
+
+            def produce(i):
+                for recipe in recipes:
+                    order = {
+                        "volume": 8, "recipe_id": recipe.id, "car": rng.choice(car_ids),
+                        "customer_id": rng.choice(customer_ids), "site_id": rng.choice(site_ids),
+                    }
+                    produced[i].append(dispatch.produce(order, tmp, "benchmark"))
+            ret["produce"] = {"seconds": _best_of(repeat, produce), "ops": len(recipes)}
+
+            be2_fns = [[] for _ in range(repeat)]
+            for i, results in enumerate(produced):
+                for result in results:
+                    order = model.Delivery.get_by_id(result["delivery_id"]).order
+                    be2_fns[i].append(os.path.join(tmp, f"{order.id}.be2"))
+                    order_be2(be2_fns[i][-1], order)
+
+            def update_material_consumption(i):
+                for fn in be2_fns[i]:
+                    dispatch.update_material_consumption(BatchFile(fn))
+            ret["update_material_consumption"] = {"seconds": _best_of(repeat, update_material_consumption), "ops": len(be2_fns[0])}
+
+            # queryset_to_ux
+            for name in model.SD_TABLES:
+                model_class = getattr(model, name)
+                ret[f"ux/{name}"] = {
+                    "seconds": _best_of(repeat, lambda _: model.queryset_to_ux(model_class.select_ordered("!id").limit(UX_ROWS))),
+                    "ops": min(UX_ROWS, model_class.select().count()),
+                }
+
+            # prices and transport zones
+            recipe_ids = [x.id for x in model.Recipe.select(model.Recipe.id)]
+            combinations = [
+                (model.Recipe.get_by_id(rng.choice(recipe_ids)), model.Customer.get_by_id(rng.choice(customer_ids)),
+                 rng.choice([None, model.ConstructionSite.get_by_id(rng.choice(site_ids))]))
+                for _ in range(LOOKUPS)
+            ]
+
+            def get_best_price(_):
+                for recipe, customer, site in combinations:
+                    model.Price.get_best_price(recipe, customer, site)
+            model.Price.get_best_price(*combinations[0])  # cache is built by first call
+            ret["price/get_best_price"] = {"seconds": _best_of(repeat, get_best_price), "ops": LOOKUPS}
+
+            def build_price_cache(_):
+                model.Price.invalidate_cache()
+                model.Price.cached()
+            ret["price/build_cache"] = {"seconds": _best_of(repeat, build_price_cache), "ops": 1}
+
+            distances = [(rng.uniform(0, TRANSPORT_ZONES * 12), rng.choice([None] + car_ids)) for _ in range(LOOKUPS)]
+
+            def get_zones(_):
+                for distance, vehicle_id in distances:
+                    model.TransportZone.get_zones(distance, vehicle_id)
+            model.TransportZone.get_zones(0)
+            ret["transport_zone/get_zones"] = {"seconds": _best_of(repeat, get_zones), "ops": LOOKUPS}
+
+            # printouts
+            env = _printout_env()
+            order = model.Delivery.get_by_id(produced[0][0]["delivery_id"]).order
+            to_t = time.time()
+            for template, context in _printout_contexts(order, to_t - 30 * 86400, to_t).items():
+                ret[f"printout/{os.path.basename(template)}"] = {
+                    "seconds": _best_of(repeat, lambda _: env.get_template(template).render(**context)),
+                    "ops": 1,
+                }
+        finally:
+            model.db.close()
+    return ret, rows
+
+
+def compare(results, baseline, threshold):
+    """Returns list of (scale, case, baseline_seconds, seconds) of cases slower than in <baseline> by more than <threshold> percent"""
+    ret = []
+    for scale, cases in results["scales"].items():
+        for case, result in cases.items():
+            base = baseline["scales"].get(scale, {}).get(case)
+            if not base or base["ops"] != result["ops"]:
+                continue  # new case, or different amount of work - not comparable
+            slower = result["seconds"] - base["seconds"]
+            if slower > base["seconds"] * threshold / 100 and slower > REGRESSION_MIN_SECONDS:
+                ret.append((scale, case, base["seconds"], result["seconds"]))
+    return ret
+
+
+def main_micro():
+    print("be2_pairing")
+    print(f"{'materials':>10} {'sec/file':>10} {'us/material':>12}")
+    for count, per_file, per_material in bench_be2_pairing():
+        print(f"{count:>10} {per_file:>10.5f} {per_material:>12.2f}")
+
+    print("consumption (1M BatchMaterial rows)")
+    for case, seconds in bench_consumption():
+        print(f"{case:>30} {seconds:>10.3f} sec")
+
+
+def main():
+    args = docopt.docopt(__doc__, version=__version__)
+    if args["--micro"]:
+        main_micro()
+        return
+
+    results = {
+        "meta": {
+            "version": __version__,
+            "t": int(time.time()),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": int(args["--seed"]),
+            "repeat": int(args["--repeat"]),
+            "rows": {},
+        },
+        "scales": {},
+    }
+    for scale in args["--scales"].split(","):
+        cases, rows = bench_suite(int(scale), seed=int(args["--seed"]), repeat=int(args["--repeat"]), db_path=args["--db-path"])
+        results["scales"][scale] = cases
+        results["meta"]["rows"][scale] = rows
+        print(f"{scale} orders ({', '.join(f'{k}: {v}' for k, v in rows.items())})")
+        for case, result in cases.items():
+            print(f"{case:>40} {result['seconds']:>10.4f} sec {result['ops']:>6} ops")
+
+    if args["--output"]:
+        with open(args["--output"], "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args["--compare"]:
+        with open(args["--compare"]) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, float(args["--threshold"]))
+        for scale, case, base_seconds, seconds in regressions:
+            print(f"REGRESSION {scale} orders, {case}: {base_seconds:.4f} -> {seconds:.4f} sec ({(seconds / base_seconds - 1) * 100:+.0f} %)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args['--compare']} (version {baseline['meta']['version']})")
+
+
+if __name__ == "__main__":
+    main()
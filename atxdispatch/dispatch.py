@@ -15,19 +15,28 @@ Options:
   --import-minidisp-path=<path>  Import data from minidisp (specify path)
   --import-atxd300               Import data from atxd300 (autodetect path)
   --import-atxd300-path=<path>   Import data from atxd300 (specify path)
+  --import-dry-run               Only validate data imported from atxd300, do not write anything
   --clear                        Clears entire DB (after confirmation)
   --populate                     Populates database with test dummy data
   --bigdata <count>              Populates database with <count> of dummy data
                                  in orders, materials, recipes, cars, sites, customers and contracts
                                  (use it to stress test app on big amounts of data)
   --users                        Manage users
-  --integrity-check              Run database integrity check
+  --integrity-check              Run database integrity check (read-only), write report into --integrity-report
+  --integrity-report <fn>        Report of integrity check (JSON) [default: integrity_report.json]
+  --export <what>                Export orders, batches or stock_movements within date range (see --from, --to)
+                                 into file given by --export-fn, and exit
+  --from <date>                  Start of date range for export, YYYY-MM-DD (inclusive)
+  --to <date>                    End of date range for export, YYYY-MM-DD (inclusive)
+  --export-fn <fn>               Export file, format is given by extension (.csv or .xlsx) [default: export.csv]
   --from-kdx <path>              Path to where KDX writes files to
   --to-kdx <path>                Path to where KDX reads files from
   --kdx-material-ini <path>      Path to material.ini file being generated by KDX
 
 Note: to switch on/off modules, use HJSON configuration file. See manual.txt for details
 """
+import hashlib
+import io
 import json
 import sys
 import os
@@ -36,10 +45,10 @@ import threading
 import time
 import logging
 import docopt
-import datetime
 import arrow
 import shutil
-from peewee import DoesNotExist
+import concurrent.futures
+from peewee import DoesNotExist, chunked
 
 import sqlite3  # just to log the version later on
 
@@ -57,6 +66,13 @@ from . import model_utils
 from . import importer
 from . import func
 from . import bridges
+from . import watcher
+from . import backup
+from . import search
+from . import export
+from . import integrity
+from . import metrics
+from .batch_file import BatchFile
 from .exceptions import UserInputError
 
 
@@ -126,20 +142,11 @@ def new_pump_order(data):
              }
 
     """
-    # Auto numbering feature.
-    # FIXME This code should be atomic, but it is not (state is saved outside DB,
-    #   so decorator model.db.atomic does not handle it). Also copypasted with ```def produce()``` below. Options:
-    #       a) refactor state to class, and provide something like state.get_incremented_counter(counter_name)
-    #       b) create model.AutoNumbered mixin. Seems cleaner (counter name can be set in Meta class or so)
-    state = func.state_load(settings.STATE_FILE)
-    new_auto_number = int(state.get("pumporder_num_counter", 0)) + 1
-    state["pumporder_num_counter"] = new_auto_number
-    func.state_save(state, settings.STATE_FILE)
-
+    # Auto numbering feature. Counter is in DB, so it is part of this transaction
     record = model.PumpOrder(
         kms=data.get("kms", None),
         hours=data.get("hours", None),
-        auto_number=new_auto_number,
+        auto_number=model.Counter.next(model.Counter.PUMP_ORDER),
     )
     record.set_pump(data["pump"])
     record.set_customer(data.get("customer", None))
@@ -203,15 +210,17 @@ def produce(order, output_path, username):
     order_instance.temperature = temperature
     order_instance.set_transport_zone(order.pop("transport_zone", None))
 
-    # Update program state - auto numbering feature, save temperature
+    # Auto numbering feature. Counters are in DB, so they are part of this transaction
+    order_instance.auto_number = model.Counter.next(model.Counter.ORDER)
+    order_instance.invoice_number = model.Counter.next(model.Counter.INVOICE)
+
+    # Update program state - save temperature
     # FIXME This code should be atomic, but it is not (state is saved outside DB,
     #   so decorator model.db.atomic does not handle it)
-    state = func.state_load(settings.STATE_FILE)
-    state["order_num_counter"] = order_instance.auto_number = int(state.get("order_num_counter", 0)) + 1
-    state["invoice_num_counter"] = order_instance.invoice_number = int(state.get("invoice_num_counter", 0)) + 1
     if temperature:
+        state = func.state_load(settings.STATE_FILE)
         state["temperature_by_user"] = temperature
-    func.state_save(state, settings.STATE_FILE)
+        func.state_save(state, settings.STATE_FILE)
 
     try:
         customer_instance = model.Customer.get_by_id(order.pop("customer_id", None))
@@ -258,7 +267,7 @@ def produce(order, output_path, username):
         )
 
     # delivery is created here. theoretically it should be created after the car is full (after multiple batches - maybe after the order is complete) but some plants want this "in advance" as the concrete is being produced so that they can print it and hand it to the driver when he leaves the plant.
-    delivery = model.Delivery.create(order=order_instance)
+    delivery = model.Delivery(order=order_instance)  # saved below, just once
     if car_id:
         try:
             car = model.Car.get_by_id(car_id)
@@ -334,18 +343,21 @@ def produce(order, output_path, username):
     }
     atxcomm.recipe_to_ini_f(recipe_to_file, ord_fn)
 
+    metrics.ORDERS_PRODUCED.inc()
+    metrics.PRODUCE_SECONDS.observe(time.time() - t)
+
     return {
         "message": f"{{Order}} {recipe.name} {sanitized_volume} m3 {{sent_to_production}}.",  # TODO REF: this does not belong to backend!
         "delivery_id": delivery.id,
     }
 
 
-def _order_from_communication_file(fn):
-    """ Returns order instance corresponding to communication file <fn>, or None if error occurs. """
-    try:
-        order_id = atxcomm.order_from_ini_f(fn).get("ID")
-    except Exception:  # bad style, but comm module can afaik throw any exception, so catch it here
-        logging.warning(f"Recieved update request, but file seems broken or noexistent: {fn}")
+def _order_from_communication_file(comm_file):
+    """ Returns order instance corresponding to communication file <comm_file> (instance of BatchFile), or None if error occurs. """
+    fn = comm_file.fn
+    order_id = comm_file.order.get("ID")
+    if order_id is None:
+        logging.warning(f"Recieved update request, but file seems broken: {fn}")
         return
 
     try:
@@ -355,9 +367,10 @@ def _order_from_communication_file(fn):
 
 
 @model.db.atomic()
-def update_order_status(fn):
-    """Processes input file <fn> and updates corresponding order's status according to rules described in code"""
-    order = _order_from_communication_file(fn)
+def update_order_status(comm_file):
+    """Processes input file <comm_file> (instance of BatchFile) and updates corresponding order's status according to rules described in code"""
+    fn = comm_file.fn
+    order = _order_from_communication_file(comm_file)
     if not order:
         logging.info(f"no matching order for {fn} found, ignoring")
         return None
@@ -370,22 +383,22 @@ def update_order_status(fn):
 
 
 @model.db.atomic()
-def update_material_consumption(fn):
-    """Processes be2 input file <fn> and updates material consumption according to it's content.
+def update_material_consumption(comm_file):
+    """Processes be2 input file <comm_file> (instance of BatchFile) and updates material consumption according to it's content.
     Also changes Order status when production finished - not superclean, though, but reality is not clean anyway
     Due to specification, all this is done when mixing is complete (e.g. we are only interested in .be2 files, not .be1)
     """
+    fn = comm_file.fn
     if not fn.endswith("be2"):
         return None
-    order = _order_from_communication_file(fn)
+    order = _order_from_communication_file(comm_file)
     if not order:
         logging.info(f"no matching order for {fn} found, ignoring")
         return None
 
-    section_recipe = atxcomm.recipe_from_ini_f(fn)
-    section_request = atxcomm.batch_request_from_ini_f(fn)
-    section_evidence1 = atxcomm.batch_evidence1_from_ini_f(fn)
-    section_evidence2 = atxcomm.batch_evidence2_from_ini_f(fn)
+    section_request = comm_file.batch_request
+    section_evidence1 = comm_file.batch_evidence1
+    section_evidence2 = comm_file.batch_evidence2
 
     # Every .be2 file means that one batch was produced.
     # Save everything to Batch model.
@@ -416,63 +429,58 @@ def update_material_consumption(fn):
         cement_temperature=section_evidence2.get("Cement_Temperature"),
     )
 
-    def find_material(mid, section):
-        """ Returns material from <section>, which has corresponding <mid> (material ID from dispatch DB)
-            Because of materials in production sections ([Batch_Request], [Batch_Evidence1] and [Batch_Evidence2])
-            sometimes do not contain ID, they must be paired (via _k_orig part) to appropriate material in [Recipe] section, where ID is present.
-            FIXME Can be refactored to atxpylib function find_by, but it is undocummented and I do not know how it is meant
-        """
-        for m in section["materials"]:
-            try:
-                recipe_material = [x for x in section_recipe["materials"] if x["_k_orig"] == m["_k_orig"]][0]
-            except IndexError:
-                # There is material in production section, that is not in Recipe.
-                # This should be common case and we can safely ignore it. TODO QUE Review this assumption
-                continue
-
-            # This line SHOULD crash with KeyError, when there is material without ID in recipe_section (thus not existing in our DB):
-            # It can indicate integrity problem (someone deleted material from our DB) or it indicates
-            # that someone (propably manager) modified [Recipe] section, which is not permitted
-            if recipe_material["ID"] == mid:
-                return m
-
-        # There is no material with such ID. It means that manager sent us .be2 file without that material
-        # in one of production sections. This is propably not an error, maybe manager just does not used it
-        # for some reason - so we just log this situation and continue TODO QUE: review this assumptions
-        logging.warning(f"Can't find material {mid} in {fn}")
-
     # material consumptions: create BatchMaterial model AND new StockMovement
-    for material in section_recipe["materials"]:
+    # All referenced OrderMaterial records are fetched in one query and rows are inserted in bulk,
+    # so number of statements does not grow with number of materials
+    consumed = [(m, rq, ev1) for (m, rq, ev1) in comm_file.paired_materials() if rq and ev1]
+    ordermaterials = {
+        x.id: x for x in model.OrderMaterial.select().where(model.OrderMaterial.id.in_([m["ID"] for m, _, _ in consumed]))
+    }
+
+    batch_materials = []
+    stock_movements = []
+    for material, material_rq, material_ev1 in consumed:
         material_id = material["ID"]
-        material_rq = find_material(material_id, section_request)
-        material_ev1 = find_material(material_id, section_evidence1)
-
-        if material_rq and material_ev1:
-            amount_consumed = material_ev1.get("Weight")
-            ordermaterial = model.OrderMaterial.get_by_id(material_id)
-            model.BatchMaterial.create(
-                batch=batch,
-                material=ordermaterial,
-                amount_recipe=material["Weight"],
-                amount_rq=material_rq.get("Weight"),
-                amount_e1=amount_consumed,
-                silo_major_rq=material_rq.get("Silo_Major"),
-                silo_minor_rq=material_rq.get("Silo_Minor"),
-                humidity_rq=material_rq.get("Humidity"),
-                internal_humidity_rq=material_rq.get("Internal_Humidity"),
-                density_rq=material_rq.get("Density"),
-                temperature_rq=material_rq.get("Temperature"),
-                bin_rq=material_rq.get("Bin"),
-                delay_rq=material_rq.get("Delay"),
-                silo_major_e1=material_ev1.get("Silo_Major"),
-                silo_minor_e1=material_ev1.get("Silo_Minor"),
-                humidity_e1=material_ev1.get("Humidity"),
-            )
-            model.StockMovement.create(
-                material=ordermaterial.material,
-                amount=-float(amount_consumed),
-                comment=f"Used to produce order {order.id}, batch {batch.id}"
-            )
+        try:
+            ordermaterial = ordermaterials[material_id]
+        except KeyError:
+            raise model.OrderMaterial.DoesNotExist(f"OrderMaterial {material_id} referenced in {fn} does not exist")
+        amount_consumed = material_ev1.get("Weight")
+        batch_materials.append({
+            "batch": batch,
+            "material": ordermaterial,
+            "amount_recipe": material["Weight"],
+            "amount_rq": material_rq.get("Weight"),
+            "amount_e1": amount_consumed,
+            "silo_major_rq": material_rq.get("Silo_Major"),
+            "silo_minor_rq": material_rq.get("Silo_Minor"),
+            "humidity_rq": material_rq.get("Humidity"),
+            "internal_humidity_rq": material_rq.get("Internal_Humidity"),
+            "density_rq": material_rq.get("Density"),
+            "temperature_rq": material_rq.get("Temperature"),
+            "bin_rq": material_rq.get("Bin"),
+            "delay_rq": material_rq.get("Delay"),
+            "silo_major_e1": material_ev1.get("Silo_Major"),
+            "silo_minor_e1": material_ev1.get("Silo_Minor"),
+            "humidity_e1": material_ev1.get("Humidity"),
+        })
+        stock_movements.append({
+            "material": ordermaterial.material_id,
+            "amount": -float(amount_consumed),
+            "comment": f"Used to produce order {order.id}, batch {batch.id}",
+        })
+
+    # chunks keep number of SQL variables under SQLite limit (999 in older versions)
+    for rows in chunked(batch_materials, 50):
+        model.BatchMaterial.insert_many(rows).execute()
+    model.StockMovement.insert_movements(stock_movements)
+
+    # daily rollup of consumptions, see model.DailyConsumption
+    day = model.DailyConsumption.day_of(order.t)
+    model.DailyConsumption.add([
+        {"day": day, "material": x["material"].name, "amount_recipe": x["amount_recipe"], "amount_rq": x["amount_rq"], "amount_e1": x["amount_e1"]}
+        for x in batch_materials
+    ])
 
     # be2 file with sequence == total (in [Batch_Request] section)
     # means that entire production has ended (all batches are produced). Other be2 files are ignored
@@ -480,7 +488,33 @@ def update_material_consumption(fn):
         order.change_status(model.Order.STATUS_FINISHED)
 
 
+# When the first of pending requests to export material.ini came, see material_ini_export_due
+_material_ini_first_request_t = None
+
+
+def _material_ini_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _material_ini_file_hash(fn):
+    """ Returns hash of material.ini <fn> on disk (read in text mode, so line endings do not matter), None if it can't be read.
+        File is small and exported rarely (see material_ini_export_due), so it is read every time - it can be deleted
+        or edited by someone else meanwhile
+    """
+    try:
+        with open(fn, "r", encoding="cp1250") as f:
+            return _material_ini_hash(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, UnicodeDecodeError):
+        logging.warning(f"can not read {fn}, it will be rewritten")
+        return None
+
+
 def save_materials_to_ini(materials, allowed_types, fn):
+    """ Writes <materials> into material.ini <fn>. Controller software re-reads the file whenever it changes,
+        so it is not written if its content would be the same. Returns True if file was written
+    """
     logging.debug("will save %s materials to %s" % (len(materials), fn))
 
     cnt = {}
@@ -492,15 +526,41 @@ def save_materials_to_ini(materials, allowed_types, fn):
         to_save[f"{m_type}{cnt_}"] = m.as_ini_section()
     if not to_save:
         logging.debug("no materials to save? bailing out")
-        return
+        return False
 
     # TODO REF: we have a wrapper for this (in atxpylib?) - find it and use it
     ini = AtxConfigParser()
     for k, v in to_save.items():
         atxcomm.generic_to_ini(v, ini, k)
+    buf = io.StringIO()
+    ini.write(buf)
+    text = buf.getvalue()
+
+    if _material_ini_file_hash(fn) == _material_ini_hash(text):
+        logging.debug(f"materials not changed, {fn} not written")
+        return False
+
     with open(f"{fn}_", "w", encoding="cp1250") as f:
-        ini.write(f)
+        f.write(text)
     os.replace(f"{fn}_", fn)
+    logging.info(f"{len(to_save)} materials written to {fn}")
+    return True
+
+
+def material_ini_export_due(last_request_t):
+    """ Debouncing of material.ini export: returns True if material.ini should be exported now, i.e. nothing
+        was requested for settings.MATERIAL_INI_DEBOUNCE seconds since <last_request_t> (so that many changes
+        in short time are coalesced into single write), or the first request waits settings.MATERIAL_INI_MAX_DELAY
+        seconds already (so that stream of changes does not postpone the export forever)
+    """
+    global _material_ini_first_request_t
+    now = time.time()
+    if _material_ini_first_request_t is None:
+        _material_ini_first_request_t = min(now, last_request_t)
+    if now - last_request_t >= settings.MATERIAL_INI_DEBOUNCE or now - _material_ini_first_request_t >= settings.MATERIAL_INI_MAX_DELAY:
+        _material_ini_first_request_t = None
+        return True
+    return False
 
 
 def quit_callback():
@@ -513,26 +573,100 @@ def confirm(message):
     return input(f"WARNING: {message}. Proceed (yes/no)?") == "yes"
 
 
-def process_input_folder(input_path, to_kdx_path):
-    """Process all files in input communication folder: update database according to them
-    and move everything to subfolder archive"""
+def _forward_and_archive(ffn, to_kdx_path):
+    """Copies processed input file to KDX (if bridge is active) and moves it to archive"""
+    if to_kdx_path:
+        bn = os.path.basename(ffn)
+        ffn2 = f"{to_kdx_path}/{bn}"
+        logging.debug(f"copying {ffn} to {ffn2}")
+        shutil.copy(ffn, ffn2)
+    func.archive_input_file(ffn)
 
-    for ffn in func.list_of_files(input_path):
+
+def process_input_files(ffns, to_kdx_path):
+    """Process given files from input communication folder: update database according to them
+    and move them to subfolder archive.
+    Returns number of files processed (temporary files are not counted)"""
+    ret = 0
+    for ffn in ffns:
         logging.debug(f"found file {ffn}")
         if func.is_fn_temporary(ffn):
             logging.debug(f"skipping {ffn} - assuming it is temporary")
             continue
+        ret += 1
+        extension = metrics.extension(ffn)
         try:
-            update_order_status(ffn)
-            update_material_consumption(ffn)
-            if to_kdx_path:
-                bn = os.path.basename(ffn)
-                ffn2 = f"{to_kdx_path}/{bn}"
-                logging.debug(f"copying {ffn} to {ffn2}")
-                shutil.copy(ffn, ffn2)
-            func.archive_input_file(ffn)
+            with metrics.INPUT_PARSE_SECONDS.time(extension=extension):
+                comm_file = BatchFile(ffn)  # file is parsed once and shared by all processors
+            with metrics.INPUT_APPLY_SECONDS.time(extension=extension):
+                update_order_status(comm_file)
+                update_material_consumption(comm_file)
+            _forward_and_archive(ffn, to_kdx_path)
+            metrics.FILES_PROCESSED.inc(extension=extension)
         except FileNotFoundError:
             logging.warning(f"file {ffn} disappeared!?!")
+    return ret
+
+
+def _parse_input_file(ffn):
+    """Returns BatchFile for <ffn>, or None if file disappeared. Runs in worker thread"""
+    try:
+        with metrics.INPUT_PARSE_SECONDS.time(extension=metrics.extension(ffn)):
+            return BatchFile(ffn)
+    except FileNotFoundError:
+        logging.warning(f"file {ffn} disappeared!?!")
+
+
+def _apply_input_files(comm_files, to_kdx_path):
+    """Updates DB according to <comm_files> in one transaction, then archives them.
+    Files are archived only after commit, so they are processed again if anything fails"""
+    with model.db.atomic():
+        for comm_file in comm_files:
+            with metrics.INPUT_APPLY_SECONDS.time(extension=metrics.extension(comm_file.fn)):
+                update_order_status(comm_file)
+                update_material_consumption(comm_file)
+    for comm_file in comm_files:
+        try:
+            _forward_and_archive(comm_file.fn, to_kdx_path)
+            metrics.FILES_PROCESSED.inc(extension=metrics.extension(comm_file.fn))
+        except FileNotFoundError:
+            logging.warning(f"file {comm_file.fn} disappeared!?!")
+
+
+def process_input_backlog(ffns, to_kdx_path):
+    """Catch-up mode of process_input_files, for large amount of waiting files.
+    Files are parsed in parallel, grouped by order and applied in batched transactions.
+    Files of the same order keep filename order (manager names them by timestamp), so status transitions stay valid.
+    Returns number of files processed (temporary files are not counted)"""
+    t = time.time()
+    ffns = [ffn for ffn in ffns if not func.is_fn_temporary(ffn)]
+    logging.info(f"{len(ffns)} files waiting in input folder, processing them in catch-up mode")
+
+    with concurrent.futures.ThreadPoolExecutor(settings.CATCHUP_WORKERS) as executor:
+        comm_files = [x for x in executor.map(_parse_input_file, sorted(ffns, key=os.path.basename)) if x]
+
+    by_order = {}
+    for comm_file in comm_files:
+        by_order.setdefault(comm_file.order.get("ID"), []).append(comm_file)
+
+    batch = []
+    for order_files in by_order.values():
+        batch.extend(order_files)  # files of one order are never split between transactions
+        if len(batch) >= settings.CATCHUP_TRANSACTION_SIZE:
+            _apply_input_files(batch, to_kdx_path)
+            batch = []
+    if batch:
+        _apply_input_files(batch, to_kdx_path)
+
+    elapsed = time.time() - t
+    logging.info(f"catch-up mode: {len(ffns)} files of {len(by_order)} orders processed in {elapsed:.1f} sec ({len(ffns) / max(elapsed, 1e-6):.1f} files/s)")
+    return len(ffns)
+
+
+def process_input_folder(input_path, to_kdx_path):
+    """Process all files in input communication folder: update database according to them
+    and move everything to subfolder archive"""
+    return process_input_files(func.list_of_files(input_path), to_kdx_path)
 
 
 def manage_users():
@@ -634,6 +768,7 @@ def main():
 
     database_fn = model.db_file(args["--db"])
     model.mount_and_migrate_db(database_fn)
+    search.ensure_search_indexes()
 
     if args["--clear"]:
         if confirm("This will irreversibly clear entire database"):
@@ -653,16 +788,26 @@ def main():
 
     if args["--integrity-check"]:
         logging.info("Integrity check started")
-        errors = 0
-        for table in model.TABLES:
-            if not table.integrity_check():
-                errors += 1
-        logging.info(f"Integrity check ended, found problems in {errors} table(s)")
-        return 1 if errors else 0
+        report = integrity.check_db(model.db.database)
+        with open(args["--integrity-report"], "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        healthy = report["quick_check"] == ["ok"] and not report["problems_count"]
+        logging.info(f"Integrity check ended in {report['duration']:.1f} sec, found {report['problems_count']} problem(s), report written to {args['--integrity-report']}")
+        return 0 if healthy else 1
 
     if args["--users"]:
         return manage_users()
 
+    if args["--export"]:
+        if not (args["--from"] and args["--to"]):
+            raise AssertionError("--export requires --from and --to")
+        from_t = arrow.get(args["--from"], "YYYY-MM-DD", tzinfo=settings.TIMEZONE).timestamp()
+        to_t = arrow.get(args["--to"], "YYYY-MM-DD", tzinfo=settings.TIMEZONE).shift(days=1).timestamp() - 1
+        t = time.time()
+        size = export.export_file(args["--export"], from_t, to_t, args["--export-fn"])
+        logging.info(f"Exported {args['--export']} into {args['--export-fn']} ({size} bytes) in {time.time() - t:.1f} sec")
+        return 0
+
     atxd300_path = args["--import-atxd300-path"]
     if atxd300_path:
         assert os.path.isdir(atxd300_path)
@@ -670,8 +815,10 @@ def main():
         atxd300_path = atxutils.try_dir(["/asterix/atxd300/data"])
         assert atxd300_path
     if atxd300_path:
-        ret = importer.import_atxd300_data(atxd300_path)
-        _rename_after_import(atxd300_path)
+        dry_run = args["--import-dry-run"]
+        ret = importer.import_atxd300_data(atxd300_path, dry_run=dry_run)
+        if not dry_run:
+            _rename_after_import(atxd300_path)
         return ret
 
     minidisp_path = args["--import-minidisp-path"]
@@ -700,6 +847,8 @@ def main():
     glo.setup = load_setup(settings.CONFIG_FILE)  # TODO REF: not very nice
     glo.cfg = cfg  # TODO REF: not very nice
 
+    model.update_stored_prices()  # needs setup, so it is not done in mount_and_migrate_db
+
     logging.debug("setup: %s" % glo.setup)
     logging.debug("cfg: %s" % cfg)
 
@@ -710,6 +859,10 @@ def main():
     else:
         thr_web = None
 
+    # Backup thread: periodic backups (if configured) and final backup on exit
+    backup_thread = backup.BackupThread(database_fn, settings.DB_BACKUP_INTERVAL, settings.DB_BACKUP_ON_EXIT)
+    backup_thread.start()
+
     quit_fn = "quit"
     qf = QuitFile(quit_fn)
     if qf.check_and_delete():
@@ -719,18 +872,25 @@ def main():
     kdx_material_ini_mod_t = None  # TODO REF: define this elsewhere
     kdx_failed_fns = []  # TODO REF: define this elsewhere
 
+    input_watcher = watcher.get_watcher(cfg.get("input_path"))
+
     global _run
     while _run:
-        process_input_folder(cfg.get("input_path"), to_kdx_path)
+        loop_t = time.perf_counter()
+        ffns = input_watcher.pending()
+        if len(ffns) >= settings.CATCHUP_THRESHOLD:
+            processed = process_input_backlog(ffns, to_kdx_path)
+        else:
+            processed = process_input_files(ffns, to_kdx_path)
 
         if kdx_material_ini_fn:
             x = _get_mtime(kdx_material_ini_fn)
             if x is not None and x != kdx_material_ini_mod_t:
                 bridges.kdx_material_ini(kdx_material_ini_fn)
                 kdx_material_ini_mod_t = x
-                glo.export_material_ini = 1
+                glo.export_material_ini = time.time()
 
-        if glo.export_material_ini:
+        if glo.export_material_ini and material_ini_export_due(glo.export_material_ini):
             glo.export_material_ini = 0
             save_materials_to_ini(model.Material.select(), model.Material.ALLOWED_TYPES, cfg["material_ini_fn"])
 
@@ -739,20 +899,25 @@ def main():
             # Note: exceptions in (pretty complex) bridge code are not caught, philosophy is: let program crash
             kdx_failed_fns = bridges.kdx(from_kdx_path, cfg.get("output_path"), kdx_failed_fns)
 
-        # TODO: don't just guard time.sleep for KeyboardInterrupt, it can come at any time
-        try:
-            time.sleep(settings.SLEEP_INTERVAL)
-        except KeyboardInterrupt:
-            break
+        metrics.MAIN_LOOP_SECONDS.observe(time.perf_counter() - loop_t)
 
+        # Sleep only if there was nothing to do - new files could arrive in the meantime
+        # TODO: don't just guard waiting for KeyboardInterrupt, it can come at any time
+        if not processed:
+            try:
+                input_watcher.wait(settings.SLEEP_INTERVAL)
+            except KeyboardInterrupt:
+                break
+
+    input_watcher.close()
     logging.debug("after loop")
 
-    # Backup database on exit
-    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    backup_fn = func.asterixed_path(settings.DB_BACKUP_PATH, f"{timestamp}.sqlite3")
-    os.makedirs(settings.DB_BACKUP_PATH, exist_ok=True)
-    shutil.copy(database_fn, backup_fn)
-    logging.info(f"Database backed up to {backup_fn}")
+    # Export postponed by debouncing
+    if glo.export_material_ini:
+        save_materials_to_ini(model.Material.select(), model.Material.ALLOWED_TYPES, cfg["material_ini_fn"])
+
+    # Backup database on exit (if configured, stop() waits for it)
+    backup_thread.stop(settings.DB_BACKUP_EXIT_TIMEOUT)
 
     if thr_web:
         web.stop()
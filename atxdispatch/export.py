@@ -0,0 +1,286 @@
+""" Bulk export of orders, batches and stock movements for a date range, into CSV or XLSX
+
+    Exports are streamed: rows are read from DB by cursor (no caching in peewee) and written out in small chunks,
+    so memory stays flat no matter how many rows are exported. iter_export() yields chunks of bytes, which can be
+    passed directly to HTTP response (see response()) or written to file (see export_file()).
+
+    XLSX is written without any library - sheet with inline strings is enough for accounting software and Excel.
+
+    Texts are typed by users (customer names, comments...), so CSV cells which spreadsheet would take for formula are
+    prefixed by apostrophe, and characters not allowed in XML are left out of XLSX.
+"""
+import csv
+import functools
+import io
+import os
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+import flask
+
+from . import func
+from . import model
+from . import settings
+
+# Formatting timestamps is the slowest part of export. Consecutive rows often share the timestamp (materials of one batch)
+_human_datetime = functools.lru_cache(maxsize=1024)(func.human_datetime)
+
+# CSV cells starting with these are taken for formula by spreadsheet applications (CSV injection)
+_CSV_FORMULA_START = ("=", "+", "-", "@", "\t", "\r")
+
+# characters not allowed in XML 1.0, one of them would make the workbook corrupt
+_XML_ILLEGAL_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+FORMATS = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def _orders(from_t, to_t):
+    query = model.Order.select(
+        model.Order.id,
+        model.Order.auto_number,
+        model.Order.invoice_number,
+        model.Order.t,
+        model.Order.customer,
+        model.Order.construction_site,
+        model.Order.contract_name,
+        model.Order.r_name,
+        model.Order.r_number,
+        model.Order.volume,
+        model.Order.status,
+        model.Order.payment_type,
+        model.Order.r_price,
+        *[getattr(model.Order, x) for x in model.Order.PRICE_FIELDS],
+        model.Order.comment,
+    ).\
+        where(model.Order.t.between(from_t, to_t)).\
+        order_by(model.Order.t, model.Order.id)
+    header = [
+        "id", "number", "invoice_number", "time", "customer", "construction_site", "contract", "recipe", "recipe_number",
+        "volume", "status", "payment_type", "unit_price", *model.Order.PRICE_FIELDS, "comment",
+    ]
+
+    def convert(row):
+        row = list(row)
+        row[3] = _human_datetime(row[3])
+        row[10] = model.Order.STATUS_NAMES.get(row[10], row[10])
+        row[11] = model.PAYMENT_TYPE_NAMES.get(row[11], row[11])
+        return row
+    return header, query, convert
+
+
+def _batches(from_t, to_t):
+    """One row per consumed material in batch. Date range applies to orders (as in consumption printout)"""
+    query = model.BatchMaterial.select(
+        model.Batch.id,
+        model.Order.auto_number,
+        model.Order.r_name,
+        model.Batch.batch_number,
+        model.Batch.batch_count,
+        model.Batch.volume,
+        model.Batch.production_start_t,
+        model.Batch.production_end_t,
+        model.OrderMaterial.name,
+        model.BatchMaterial.amount_recipe,
+        model.BatchMaterial.amount_rq,
+        model.BatchMaterial.amount_e1,
+    ).\
+        join(model.Batch).\
+        join(model.Order).\
+        switch(model.BatchMaterial).\
+        join(model.OrderMaterial).\
+        where(model.Order.t.between(from_t, to_t)).\
+        order_by(model.Order.t, model.Batch.id, model.BatchMaterial.id)
+    header = [
+        "batch_id", "order_number", "recipe", "batch_number", "batch_count", "volume", "production_start", "production_end",
+        "material", "amount_recipe", "amount_rq", "amount_e1",
+    ]
+
+    def convert(row):
+        row = list(row)
+        row[6] = _human_datetime(row[6])
+        row[7] = _human_datetime(row[7])
+        return row
+    return header, query, convert
+
+
+def _stock_movements(from_t, to_t):
+    query = model.StockMovement.select(
+        model.StockMovement.id,
+        model.StockMovement.t,
+        model.Material.name,
+        model.Material.unit,
+        model.StockMovement.amount,
+        model.StockMovement.comment,
+    ).\
+        join(model.Material).\
+        where(model.StockMovement.t.between(from_t, to_t)).\
+        order_by(model.StockMovement.t, model.StockMovement.id)
+    header = ["id", "time", "material", "unit", "amount", "comment"]
+
+    def convert(row):
+        row = list(row)
+        row[1] = _human_datetime(row[1])
+        return row
+    return header, query, convert
+
+
+# export name -> function returning (header, query, row converter)
+EXPORTS = {
+    "orders": _orders,
+    "batches": _batches,
+    "stock_movements": _stock_movements,
+}
+
+
+def iter_rows(name, from_t, to_t):
+    """Yields header and then all rows of export <name> within date range (inclusive)"""
+    if name not in EXPORTS:
+        raise ValueError(f"Unknown export '{name}', use one of [{', '.join(EXPORTS)}]")
+    header, query, convert = EXPORTS[name](from_t, to_t)
+    yield header
+    # iterator() does not keep rows in memory, sqlite3 cursor fetches them as needed
+    for row in query.tuples().iterator():
+        yield convert(row)
+
+
+class _Chunks(io.RawIOBase):
+    """Unseekable writable stream, which just collects written data until taken by take()"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def take(self):
+        ret = b"".join(self._chunks)
+        self._chunks = []
+        return ret
+
+
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(_CSV_FORMULA_START):
+        return f"'{value}"
+    return value
+
+
+def _iter_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=settings.EXPORT_CSV_DELIMITER)
+    yield "\ufeff".encode()  # BOM, so Excel recognizes UTF-8
+    for i, row in enumerate(rows, 1):
+        writer.writerow([_csv_cell(x) for x in row])
+        if i % settings.EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue().encode()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode()
+
+
+_XLSX_STATIC = {
+    "[Content_Types].xml":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    "_rels/.rels":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    "xl/workbook.xml":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="export" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>',
+    "xl/_rels/workbook.xml.rels":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+
+def _xlsx_cell(value):
+    if value is None:
+        return "<c/>"
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f"<c><v>{value}</v></c>"
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(_XML_ILLEGAL_RE.sub("", str(value)))}</t></is></c>'
+
+
+def _iter_xlsx(rows):
+    out = _Chunks()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for fn, content in _XLSX_STATIC.items():
+            zf.writestr(fn, content)
+        yield out.take()
+        with zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            lines = []
+            for i, row in enumerate(rows, 1):
+                lines.append(f"<row>{''.join(_xlsx_cell(x) for x in row)}</row>")
+                if i % settings.EXPORT_CHUNK_ROWS == 0:
+                    sheet.write("".join(lines).encode())
+                    lines = []
+                    yield out.take()
+            sheet.write("".join(lines).encode())
+            sheet.write(b"</sheetData></worksheet>")
+    yield out.take()
+
+
+def iter_export(name, fmt, from_t, to_t):
+    """Yields chunks of bytes of export <name> (see EXPORTS) in format <fmt> (see FORMATS) within date range (inclusive)"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}', use one of [{', '.join(FORMATS)}]")
+    rows = iter_rows(name, from_t, to_t)
+    # header is taken here already, so wrong export name raises error before any data are sent
+    header = next(rows)
+
+    def all_rows():
+        yield header
+        yield from rows
+    return _iter_csv(all_rows()) if fmt == "csv" else _iter_xlsx(all_rows())
+
+
+def export_file(name, from_t, to_t, fn):
+    """Writes export <name> within date range into file <fn>, format is taken from extension. Returns size in bytes"""
+    fmt = os.path.splitext(fn)[1].lstrip(".").lower()
+    chunks = iter_export(name, fmt, from_t, to_t)
+    size = 0
+    # write into temporary file first, so there is never a half-written export with a valid name
+    with open(f"{fn}_", "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+            size += len(chunk)
+    os.replace(f"{fn}_", fn)
+    return size
+
+
+def response(name, fmt, from_t, to_t):
+    """Returns streamed flask response with export, offered as file download"""
+    chunks = iter_export(name, fmt, from_t, to_t)
+    fn = f"{name}_{func.human_datetime(from_t, 'YYYYMMDD')}-{func.human_datetime(to_t, 'YYYYMMDD')}.{fmt}"
+    return flask.Response(
+        flask.stream_with_context(chunks),
+        mimetype=FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{fn}"'},
+    )
@@ -1,6 +1,6 @@
 # global stuff - all of this is ugly - TODO REF: try to get rid of it!
 
-export_material_ini = 0
+export_material_ini = 0  # time of last request to export material.ini (0 = nothing to export), see dispatch.main
 cfg = {}
 setup = {}
 captions = {}
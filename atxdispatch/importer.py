@@ -4,13 +4,16 @@
         import_atxd300_data
     (the rest of module are helpers)
 """
+import itertools
 import os
 import logging
-from peewee import DoesNotExist
+import time
+from peewee import DoesNotExist, IntegrityError, fn
 from atxpylib import configparser
 
 from . import model
 from . import func
+from . import settings
 from .func import DBFReader
 import dbf
 
@@ -175,197 +178,376 @@ def import_minidisp_data(path):
     return 0
 
 
-def _import_materials_from_dbf(fn):
-    dbf_id_to_new_id_map = {}
-    with DBFReader(fn) as reader:
-        for record in reader:
+# atxd300 DBF import
+#
+# Records are streamed from DBF files in chunks of settings.IMPORT_CHUNK_SIZE and every chunk is written
+# by single insert_many(). Everything needed to validate a record (existing material ids, driver names, values
+# of unique columns...) is loaded into _Atxd300Import at start and kept up to date as records are imported,
+# so there are no queries per record. Primary keys are assigned here (materials keep their atxd300 ID_MAT),
+# so that recipe materials and cars can refer to records inserted in the same chunk.
+#
+# Invalid records are logged and skipped. In dry run, records are validated the same way, but nothing is written.
+
+ATXD300_MATERIAL_TYPES = {
+    1: "Aggregate",
+    2: "Cement",
+    3: "Admixture",
+    4: "Addition",
+    5: "Water",  # CleanWater
+    6: "Water",  # RecycledWater
+}
+
+# (material type, abbreviation used in names of RECEPTURA.DBF fields, count of material slots)
+ATXD300_RECIPE_MATERIAL_SLOTS = [
+    ("Aggregate", "KAM", 9),
+    ("Cement", "CEM", 1),
+    ("Addition", "POJ", 2),
+    ("Admixture", "PRI", 8),
+    ("Water", "VOD", 4),
+]
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def _get(record, field_name, default=None):
+    """Returns value of <field_name> of DBF <record>, or <default> when the field is not in the file"""
+    try:
+        return record[field_name]
+    except dbf.FieldMissingError:  # TODO REF: leaky abstraction
+        return default
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while chunk := list(itertools.islice(it, size)):
+        yield chunk
+
+
+def _checked(func, *args):
+    """Returns <func>(*args), ValueError or TypeError raised by <func> (a conversion or model check) is raised as InvalidRecord"""
+    try:
+        return func(*args)
+    except (ValueError, TypeError) as e:
+        raise InvalidRecord(e)
+
+
+def _db_values(model_class, data):
+    """ Returns <data> (field name -> value) converted as they would be written into DB,
+        i.e. validated by custom fields (see model_fields.py). Raises InvalidRecord
+    """
+    return _checked(lambda: {k: model_class._meta.fields[k].db_value(v) for k, v in data.items()})
+
+
+class _Progress:
+    """Counts and logs progress of import of one table"""
+
+    def __init__(self, table, dry_run=False):
+        self.table = table
+        self.dry_run = dry_run
+        self.t = time.perf_counter()
+        self.read = 0
+        self.imported = 0
+        self.invalid = 0
+
+    def log(self, done=False):
+        duration = time.perf_counter() - self.t
+        rate = self.read / duration if duration else 0
+        action = ("Validated" if done else "Validating") if self.dry_run else ("Imported" if done else "Importing")
+        logging.info(f"{action} {self.table}: {self.read} records read, {self.imported} {'valid' if self.dry_run else 'imported'}, {self.invalid} invalid, {rate:.0f} records/s")
+
+
+class _Atxd300Import:
+    """Import of atxd300 data from DBF files in <path>, see import_atxd300_data()"""
+
+    def __init__(self, path, dry_run=False):
+        self.path = path
+        self.dry_run = dry_run
+        self.progress = []
+
+        # lookup maps, filled with existing records and updated by imported ones
+        self.material_types = dict(model.Material.select(model.Material.id, model.Material.type).tuples())
+        self.material_names = self._existing(model.Material.name)
+        self.material_long_names = self._existing(model.Material.long_name)
+        self.recipe_names = self._existing(model.Recipe.name)
+        self.recipe_numbers = self._existing(model.Recipe.number)
+        self.driver_ids = dict(model.Driver.select(model.Driver.name, model.Driver.id).tuples())
+        self.registration_numbers = self._existing(model.Car.registration_number)
+        self.customer_keys = set(model.Customer.select(model.Customer.name, model.Customer.company_idnum).tuples())
+        self.site_names = self._existing(model.ConstructionSite.name)
+
+        self.next_recipe_id = self._next_id(model.Recipe)
+        self.next_driver_id = self._next_id(model.Driver)
+
+    @staticmethod
+    def _existing(field):
+        return {x for (x,) in field.model.select(field).where(field.is_null(False)).tuples()}
+
+    @staticmethod
+    def _next_id(model_class):
+        return (model_class.select(fn.MAX(model_class.id)).scalar() or 0) + 1
+
+    @staticmethod
+    def _check_unique(values, value, what):
+        if value is not None and value in values:
+            raise InvalidRecord(f"{what} {value} already exists")
+
+    def _insert(self, model_class, rows, progress=None):
+        """ Inserts <rows> by one query. If that fails (e.g. due to constraint not checked in advance),
+            rows are inserted one by one and the failing ones are logged and skipped (and counted in <progress>)
+
+            Returns list of inserted rows
+        """
+        inserted = rows
+        if not self.dry_run and rows:
+            try:
+                with model.db.atomic():
+                    model_class.insert_many(rows).execute()
+            except IntegrityError as e:
+                logging.warning(f"Bulk insert into {model_class.__name__} failed ({e}), inserting row by row")
+                inserted = []
+                for row in rows:
+                    try:
+                        with model.db.atomic():
+                            model_class.insert(row).execute()
+                        inserted.append(row)
+                    except IntegrityError as e:
+                        logging.warning(f"{model_class.__name__} {row} not imported: {e}")
+        if progress:
+            progress.imported += len(inserted)
+            progress.invalid += len(rows) - len(inserted)
+        return inserted
+
+    def _import_table(self, dbf_fn, table, import_chunk):
+        """ Streams records of <dbf_fn> in chunks into <import_chunk>(records, progress)
+            which is expected to update <progress>
+        """
+        dbf_path = f"{self.path}/{dbf_fn}"
+        progress = _Progress(table, self.dry_run)
+        self.progress.append(progress)
+        with DBFReader(dbf_path) as reader:
+            for records in _chunks(reader, settings.IMPORT_CHUNK_SIZE):
+                progress.read += len(records)
+                import_chunk(records, progress)
+                progress.log()
+        progress.log(done=True)
+
+    def _invalid(self, progress, what, e):
+        logging.warning(f"{what} not imported: {e}")
+        progress.invalid += 1
+
+    def import_materials(self, records, progress):
+        rows = []
+        for record in records:
             id_mat = record["ID_MAT"]
-            logging.info(f"Importing material {id_mat} from DBF file {fn}")
-            type_ = {
-                1: "Aggregate",
-                2: "Cement",
-                3: "Admixture",
-                4: "Addition",
-                5: "Water",  # CleanWater
-                6: "Water",  # RecycledWater
-            }.get(record["TYP"])
-            if type_ is None:
-                logging.warning("unknown type")
-                continue
             try:
-                m = model.Material.create(
-                    id=id_mat,
-                    long_name=record["NAZEV"].strip(),
-                    name=record["NAZEV_RIZE"].strip(),
-                    type=type_,
-                    unit=record["MNOZ_JEDNO"].strip(),
-                )
-                dbf_id_to_new_id_map[id_mat] = m.id
-            except Exception as e:
-                logging.exception(f"Error importing material from DBF: {e}")
-    return dbf_id_to_new_id_map
-
-
-def _import_recipes_from_dbf(fn):
-    with DBFReader(fn) as reader:
-        for record in reader:
+                type_ = ATXD300_MATERIAL_TYPES.get(record["TYP"])
+                if type_ is None:
+                    raise InvalidRecord(f"unknown type {record['TYP']}")
+                _checked(model.Material.check_type, type_)
+                row = _db_values(model.Material, {
+                    "id": id_mat,
+                    "long_name": record["NAZEV"],
+                    "name": record["NAZEV_RIZE"],
+                    "type": type_,
+                    "unit": record["MNOZ_JEDNO"],
+                })
+                if row["name"] is None:
+                    raise InvalidRecord("empty name")
+                self._check_unique(self.material_types, id_mat, "id")
+                self._check_unique(self.material_names, row["name"], "name")
+                self._check_unique(self.material_long_names, row["long_name"], "long name")
+            except InvalidRecord as e:
+                self._invalid(progress, f"Material {id_mat}", e)
+                continue
+            self.material_types[id_mat] = type_
+            self.material_names.add(row["name"])
+            self.material_long_names.add(row["long_name"])
+            rows.append(row)
+        self._insert(model.Material, rows, progress)
+
+    def _recipe_materials(self, record, recipe_id):
+        """Returns rows of RecipeMaterial of recipe <record>, raises InvalidRecord"""
+        ret = []
+        for (mat_type, mat_abbrev, cnt) in ATXD300_RECIPE_MATERIAL_SLOTS:
+            for i in range(1, cnt + 1):
+                id_ = _get(record, f"ID_{mat_abbrev}_{i}")
+                if not id_:
+                    continue
+                if id_ not in self.material_types:
+                    logging.debug(f"recipe {recipe_id}: material {id_} does not exist, skipped")
+                    continue
+                row = _db_values(model.RecipeMaterial, {
+                    "recipe": recipe_id,
+                    "material": id_,
+                    "amount": record[f"MNOZ_{mat_abbrev}_{i}"],
+                    "delay": _get(record, f"ZPOZ_{mat_abbrev}_{i}"),
+                    "k_value": _get(record, f"ACCAWR_{mat_abbrev}_{i}"),
+                    "k_ratio": _get(record, f"POMER_{mat_abbrev}_{i}"),
+                })
+                _checked(model.RecipeMaterial.check_k, self.material_types[id_], row["k_value"], row["k_ratio"])
+                ret.append(row)
+        return ret
+
+    def import_recipes(self, records, progress):
+        rows = []
+        material_rows = []
+        for record in records:
             id_rec = record["ID_REC"]
-            logging.info(f"Importing recipe {id_rec} from DBF file {fn}")
             try:
                 # TODO - finish all fields
                 number = record["CISLO"]
-                number = None if number == 0 else str(number)
-                recipe = model.Recipe.create(
-                    name=record["NAZEV"].strip(),
-                    recipe_class=record["TRIDA"].strip(),
+                row = _db_values(model.Recipe, {
+                    "id": self.next_recipe_id,
+                    "name": record["NAZEV"],
+                    "recipe_class": record["TRIDA"],
                     #exposure_classes=
                     #description= - VARIANTA?
-                    comment=record["POZNAMKA"].strip(),
-                    consistency_class=record["KONZISTENC"].strip(),
-                    batch_volume_limit=record["MAX_MNOZST"],
-                    lift_pour_duration=record["DOBA_VYSYP"],  # ???
-                    lift_semi_pour_duration=record["DOBA_SKORO"],  # ???
-                    mixer_semi_opening_duration=record["DOBA_POOTE"],
-                    mixer_semi_opening2_duration=record["DOBA_POOT2"],  # ???
-                    mixer_opening_duration=record["DOBA_OTEVR"],
-                    mixing_duration=record["DOBA_MICHA"],
-                    workability_time=record["ZPRACOVAT"],  # ???
-                    price=record["CENA"],
-                    k_value=record["ACCAWR_1"],  # ???
-                    k_ratio=record["POMER_1"],  # ???
-                    number=number,
+                    "comment": record["POZNAMKA"],
+                    "consistency_class": record["KONZISTENC"],
+                    "batch_volume_limit": record["MAX_MNOZST"],
+                    "lift_pour_duration": record["DOBA_VYSYP"],  # ???
+                    "lift_semi_pour_duration": record["DOBA_SKORO"],  # ???
+                    "mixer_semi_opening_duration": record["DOBA_POOTE"],
+                    "mixer_semi_opening2_duration": record["DOBA_POOT2"],  # ???
+                    "mixer_opening_duration": record["DOBA_OTEVR"],
+                    "mixing_duration": record["DOBA_MICHA"],
+                    "workability_time": record["ZPRACOVAT"],  # ???
+                    "price": record["CENA"],
+                    "k_value": record["ACCAWR_1"],  # ???
+                    "k_ratio": record["POMER_1"],  # ???
+                    "number": None if number == 0 else str(number),
                     #d_max=record["ZRNITOST"].strip(),
-                    cl_content=record["OBSAH_CL"],
-                )
-
-                #mats = []
-                for (mat_type, mat_abbrev, cnt) in [
-                    ("Aggregate", "KAM", 9),
-                    ("Cement", "CEM", 1),
-                    ("Addition", "POJ", 2),
-                    ("Admixture", "PRI", 8),
-                    ("Water", "VOD", 4),
-                ]:
-                    for i in range(1, cnt + 1):
-                        k_id = f"ID_{mat_abbrev}_{i}"
-                        try:
-                            id_ = record[k_id]
-                        except dbf.FieldMissingError:  # TODO REF: leaky abstraction
-                            continue
-                        if id_ == 0:
-                            continue
-                        try:
-                            material = model.Material.get_by_id(id_)
-                        except:
-                            continue
-                        try:
-                            delay = record[f"ZPOZ_{mat_abbrev}_{i}"]
-                        except dbf.FieldMissingError:
-                            delay = None
-                        try:
-                            k_value = record[f"ACCAWR_{mat_abbrev}_{i}"]
-                        except dbf.FieldMissingError:
-                            k_value = None
-                        try:
-                            k_ratio = record[f"POMER_{mat_abbrev}_{i}"]
-                        except dbf.FieldMissingError:
-                            k_ratio = None
-                        rec_mat = model.RecipeMaterial.create(
-                            recipe=recipe,
-                            material=material,
-                            amount=record[f"MNOZ_{mat_abbrev}_{i}"],
-                            delay=delay,
-                            k_value=k_value,
-                            k_ratio=k_ratio,
-                            #k_value=record.get(f"ACCAWR_{i}"),
-                            #k_ratio=record.get(f"POMER_{i}"),
-                        )
-                        print("IMPORTED MATERIAL DUMP:", rec_mat.as_json())
-            except Exception as e:
-                logging.exception(f"Error importing recipe from DBF: {e}")
-
-
-def _import_cars_from_dbf(fn):
-    with DBFReader(fn) as reader:
-        for record in reader:
+                    "cl_content": record["OBSAH_CL"],
+                })
+                if row["name"] is None:
+                    raise InvalidRecord("empty name")
+                self._check_unique(self.recipe_names, row["name"], "name")
+                self._check_unique(self.recipe_numbers, row["number"], "number")
+                recipe_materials = self._recipe_materials(record, row["id"])
+            except InvalidRecord as e:
+                self._invalid(progress, f"Recipe {id_rec}", e)
+                continue
+            self.next_recipe_id += 1
+            self.recipe_names.add(row["name"])
+            self.recipe_numbers.add(row["number"])
+            rows.append(row)
+            material_rows += recipe_materials
+        recipe_ids = {x["id"] for x in self._insert(model.Recipe, rows, progress)}
+        # materials of recipes, which failed to insert, are skipped (they would fail on foreign key or hit another recipe)
+        self._insert(model.RecipeMaterial, [x for x in material_rows if x["recipe"] in recipe_ids])
+
+    def import_cars(self, records, progress):
+        driver_rows = []
+        rows = []
+        for record in records:
             spz = record["SPZ"].strip()
-            logging.info(f"Importing Car {spz} from DBF file {fn}")
-            driver_name = record["JMENO"].strip()
-            if not driver_name:
-                driver = None
-            else:
-                driver = model.Driver.create(
-                    name=driver_name,
-                    contact=record["TELEFON"].strip(),
-                )
-            model.Car.create(
-                registration_number=spz,
-                driver=driver,
-                operator=record["PROVOZOVAT"].strip() or None,
-                car_type=record["VOZIDLO_TY"].strip() or None,
-            )
-
-
-def _import_customers_from_dbf(fn):
-    with DBFReader(fn) as reader:
-        for record in reader:
+            try:
+                row = _db_values(model.Car, {
+                    "registration_number": spz,
+                    "operator": record["PROVOZOVAT"],
+                    "car_type": record["VOZIDLO_TY"],
+                })
+                if not row["registration_number"]:
+                    raise InvalidRecord("empty registration number")
+                self._check_unique(self.registration_numbers, row["registration_number"], "registration number")
+                driver = _db_values(model.Driver, {"name": record["JMENO"], "contact": record["TELEFON"]})
+            except InvalidRecord as e:
+                self._invalid(progress, f"Car {spz}", e)
+                continue
+            # drivers are shared by cars, the first record of driver wins
+            if driver["name"] is not None and driver["name"] not in self.driver_ids:
+                driver["id"] = self.driver_ids[driver["name"]] = self.next_driver_id
+                self.next_driver_id += 1
+                driver_rows.append(driver)
+            row["driver"] = self.driver_ids.get(driver["name"])
+            self.registration_numbers.add(row["registration_number"])
+            rows.append(row)
+        self._insert(model.Driver, driver_rows)
+        self._insert(model.Car, rows, progress)
+
+    def import_customers(self, records, progress):
+        rows = []
+        for record in records:
             name = record["NAZEV"].strip()
             if not name:
                 continue
-            logging.info(f"Importing Customer {name} from DBF file {fn}")
-            model.Customer.create(
-                name=name,
-                address=record["ULICE"].strip(),
-                city=record["MESTO"].strip(),
-                zip=record["PSC"].strip(),
-                phone=record["TEL"].strip(),
-                fax=record["FAX"].strip(),
-                company_idnum=record["ICO"].strip(),
-                vat_idnum=record["DIC"].strip(),
-                payment_type=model.PAYMENT_INVOICE if record["UHRADA"].strip() == "fakturou" else model.PAYMENT_CASH,
-                comment=record["NAZEV2"].strip(),
-            )
-
+            try:
+                row = _db_values(model.Customer, {
+                    "name": name,
+                    "address": record["ULICE"],
+                    "city": record["MESTO"],
+                    "zip": record["PSC"],
+                    "phone": record["TEL"],
+                    "fax": record["FAX"],
+                    "company_idnum": record["ICO"],
+                    "vat_idnum": record["DIC"],
+                    "payment_type": model.PAYMENT_INVOICE if record["UHRADA"].strip() == "fakturou" else model.PAYMENT_CASH,
+                    "comment": record["NAZEV2"],
+                })
+                key = (row["name"], row["company_idnum"])
+                if row["company_idnum"] is not None:  # NULLs are never equal in unique index
+                    self._check_unique(self.customer_keys, key, "name and company id")
+            except InvalidRecord as e:
+                self._invalid(progress, f"Customer {name}", e)
+                continue
+            self.customer_keys.add(key)
+            rows.append(row)
+        self._insert(model.Customer, rows, progress)
 
-def _import_sites_from_dbf(fn):
-    with DBFReader(fn) as reader:
-        for record in reader:
+    def import_sites(self, records, progress):
+        rows = []
+        for record in records:
             name = record["NAZEV"].strip()
             if not name:
                 continue
-            logging.info(f"Importing ConstructionSite {name} from DBF file {fn}")
-            phone = record["TEL"].strip()
             try:
-                model.ConstructionSite.create(
-                    name=name,
-                    address=record["ULICE"].strip(),
-                    city=record["MESTO"].strip(),
-                    zip=record["PSC"].strip(),
-                    comment=f"Tel.: {phone}" if phone else None,
-                    distance=int(record["VZDALENOST"]),
-                )
-            except Exception as e:
-                logging.exception(f"Error importing site from DBF: {e}")
-
-
-#@model.db.atomic()
-def import_atxd300_data(path):
+                phone = record["TEL"].strip()
+                row = _db_values(model.ConstructionSite, {
+                    "name": name,
+                    "address": record["ULICE"],
+                    "city": record["MESTO"],
+                    "zip": record["PSC"],
+                    "comment": f"Tel.: {phone}" if phone else None,
+                    "distance": _checked(int, record["VZDALENOST"]),
+                })
+                self._check_unique(self.site_names, row["name"], "name")
+            except InvalidRecord as e:
+                self._invalid(progress, f"ConstructionSite {name}", e)
+                continue
+            self.site_names.add(row["name"])
+            rows.append(row)
+        self._insert(model.ConstructionSite, rows, progress)
+
+    def run(self):
+        # TODO: also import the "hidden" attribute for all entities
+        # order matters: recipes refer to materials
+        self._import_table("MATERIAL.DBF", "Material", self.import_materials)
+        self._import_table("RECEPTURA.DBF", "Recipe", self.import_recipes)
+        self._import_table("DOPRAVA.DBF", "Car", self.import_cars)
+        self._import_table("ODBERATEL.DBF", "Customer", self.import_customers)
+        self._import_table("STAVBA.DBF", "ConstructionSite", self.import_sites)
+
+
+def import_atxd300_data(path, dry_run=False):
     """ Imports data from legacy DBF format used in atxd300
-        Imported directory is afterwards renamed to <original>_imported, in order to
+        Imported directory is afterwards renamed (by caller) to <original>_imported, in order to
             1) prevent importing the file again
             2) prevent atxd300 to run, applying naked IT brutality
+        With <dry_run>, records are only validated and nothing is written into DB
+
+        Return value: 0 if success, 1 if some records are invalid in dry run
     """
-    logging.info(f"will try to import atxd300 data from {path}")
+    logging.info(f"will try to {'validate' if dry_run else 'import'} atxd300 data from {path}")
 
-    # TODO: also import the "hidden" attribute for all entities
     with model.db.atomic():
-        mat_id_map = _import_materials_from_dbf(f"{path}/MATERIAL.DBF")
-        print("ID_MAP", mat_id_map)
-        _import_recipes_from_dbf(f"{path}/RECEPTURA.DBF")
-        _import_cars_from_dbf(f"{path}/DOPRAVA.DBF")
-        _import_customers_from_dbf(f"{path}/ODBERATEL.DBF")
-        _import_sites_from_dbf(f"{path}/STAVBA.DBF")
-
-    logging.info("atxd300 import complete")
-
+        imp = _Atxd300Import(path, dry_run=dry_run)
+        imp.run()
+
+    invalid = sum(x.invalid for x in imp.progress)
+    if dry_run:
+        logging.info(f"atxd300 data validated, {invalid} invalid records, nothing was imported")
+        return 1 if invalid else 0
+    logging.info(f"atxd300 import complete, {invalid} invalid records skipped")
     return 0
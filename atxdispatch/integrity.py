@@ -0,0 +1,187 @@
+""" Read-only integrity check of database
+
+    Constraints of custom fields (see model_fields.py) and rules of models (see model_checks()), which are otherwise
+    enforced only when a record is saved from Python, are checked by SQL - one scan of every table counts all kinds
+    of invalid values at once.
+    Foreign keys are checked by PRAGMA foreign_key_check, and the whole file by PRAGMA quick_check.
+
+    Nothing is written into DB: tables are checked in settings.INTEGRITY_CHECK_WORKERS threads, each check opens
+    its own read-only connection, so the check can run on a live DB (in WAL mode, readers do not block the writer).
+
+    Result is a report (see check_db()), which is written as JSON by dispatch --integrity-check.
+"""
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import time
+
+from peewee import BooleanField
+
+from . import model
+from . import settings
+from .model_fields import EnumField, RegistrationNumberField, StrictDoubleField, StrictIntegerField, StrippedTextField
+
+# what str.strip() removes (at least the ASCII part of it)
+_WHITESPACE = "' ' || char(9, 10, 11, 12, 13)"
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def field_checks(field):
+    """Returns list of (check name, SQL condition true for invalid value) of <field>"""
+    column = _quote(field.column_name)
+    ret = []
+    if not field.null and not field.primary_key:
+        ret.append(("not_null", f"{column} IS NULL"))
+    # order matters, more specific classes first (e.g. EnumField is StrictIntegerField too)
+    if isinstance(field, EnumField):
+        allowed = ", ".join(str(int(x)) for x in field._allowed_values)
+        ret.append(("enum", f"typeof({column}) != 'null' AND (typeof({column}) != 'integer' OR {column} NOT IN ({allowed}))"))
+    elif isinstance(field, StrictIntegerField):
+        ret.append(("integer", f"typeof({column}) NOT IN ('integer', 'null')"))
+    elif isinstance(field, StrictDoubleField):
+        ret.append(("number", f"typeof({column}) NOT IN ('real', 'integer', 'null')"))
+    elif isinstance(field, BooleanField):
+        ret.append(("boolean", f"{column} NOT IN (0, 1)"))
+    elif isinstance(field, RegistrationNumberField):
+        ret.append(("registration_number", f"{column} != upper(trim({column}))"))
+    elif isinstance(field, StrippedTextField):
+        ret.append(("stripped_text", f"{column} = '' OR {column} != trim({column}, {_WHITESPACE})"))
+    return ret
+
+
+def _in(values):
+    """SQL list of string <values>, for IN operator"""
+    return ", ".join("'" + x.replace("'", "''") + "'" for x in values)
+
+
+def model_checks(model_class):
+    """ Returns list of (column, check name, SQL condition true for invalid row) of rules, which save() of <model_class> enforces.
+        Conditions refer to the table of <model_class> by its name
+    """
+    table = _quote(model_class._meta.table_name)
+
+    def col(name):
+        return f"{table}.{_quote(model_class._meta.fields[name].column_name)}"
+
+    if model_class is model.Material:
+        return [("type", "allowed_type", f"{col('type')} IS NULL OR {col('type')} NOT IN ({_in(model.Material.ALLOWED_TYPES)})")]
+    if model_class is model.Order:
+        return [("volume", "positive", f"{col('volume')} IS NULL OR {col('volume')} <= 0")]
+    if model_class in (model.RecipeMaterial, model.OrderMaterial):
+        material = _quote(model.Material._meta.table_name)
+        return [("k_value", "addition_only", (
+            f"(COALESCE({col('k_value')}, 0) != 0 OR COALESCE({col('k_ratio')}, 0) != 0) AND "
+            f"(SELECT {material}.type FROM {material} WHERE {material}.id = {col('material')}) IS NOT 'Addition'"
+        ))]
+    if model_class in (model.PumpSurcharge, model.CompanySurcharge):
+        return [("unit_name", "unit_price_type", f"{col('unit_name')} IS NOT NULL AND {col('price_type')} != {model.SURCHARGE_PRICE_PER_OTHER_UNIT}")]
+    if model_class is model.LockedTable:
+        return [("table_name", "lockable", f"{col('table_name')} NOT IN ({_in(model.LockedTable.LOCKABLE_TABLES)})")]
+    if model_class is model.Price:
+        def other(name):
+            return f"other.{_quote(model_class._meta.fields[name].column_name)}"
+        others = f"SELECT 1 FROM {table} AS other WHERE {other('id')} != {col('id')} AND {other('customer')} IS {col('customer')}"
+        return [
+            ("customer_id", "not_null", f"{col('customer')} IS NULL"),
+            ("recipe_id", "unique_without_recipe", f"{col('recipe')} IS NULL AND EXISTS ({others} AND {other('recipe')} IS NULL)"),
+            ("construction_site_id", "unique_without_construction_site", (
+                f"{col('construction_site')} IS NULL AND "
+                f"EXISTS ({others} AND {other('recipe')} IS {col('recipe')} AND {other('construction_site')} IS NULL)"
+            )),
+        ]
+    return []
+
+
+def _connect(db_fn):
+    return sqlite3.connect(f"file:{db_fn}?mode=ro", uri=True, timeout=settings.DB_TIMEOUT, check_same_thread=False)
+
+
+def check_table(db_fn, model_class):
+    """Returns {"rows": count of rows, "problems": list of problems} of table of <model_class>"""
+    table = model_class._meta.table_name
+    pk = _quote(model_class._meta.primary_key.column_name)
+    problems = []
+    conn = _connect(db_fn)
+    try:
+        columns = {x[1] for x in conn.execute(f"PRAGMA table_info({_quote(table)})")}
+        if not columns:
+            return {"rows": 0, "problems": [{"check": "missing_table", "column": None, "count": 1, "examples": []}]}
+
+        checks = []  # (column, check, condition)
+        for field in model_class._meta.sorted_fields:
+            if field.column_name not in columns:
+                problems.append({"check": "missing_column", "column": field.column_name, "count": 1, "examples": []})
+                continue
+            checks += [(field.column_name, name, condition) for name, condition in field_checks(field)]
+        if not problems:  # rules of model can refer to any column
+            checks += model_checks(model_class)
+
+        # single scan of table counts rows violating every check
+        counts = [f"COUNT(CASE WHEN {condition} THEN 1 END)" for _, _, condition in checks]
+        rows, *invalid = conn.execute(f"SELECT {', '.join(['COUNT(*)'] + counts)} FROM {_quote(table)}").fetchone()
+        for (column, name, condition), count in zip(checks, invalid):
+            if count:
+                examples = [x[0] for x in conn.execute(
+                    f"SELECT {pk} FROM {_quote(table)} WHERE {condition} LIMIT {settings.INTEGRITY_CHECK_EXAMPLES}"
+                )]
+                problems.append({"check": name, "column": column, "count": count, "examples": examples})
+
+        foreign_keys = {x[0]: x[3] for x in conn.execute(f"PRAGMA foreign_key_list({_quote(table)})")}  # id -> column
+        violations = {}
+        for _, rowid, parent, fkid in conn.execute(f"PRAGMA foreign_key_check({_quote(table)})"):
+            violations.setdefault((foreign_keys.get(fkid), parent), []).append(rowid)
+        for (column, parent), rowids in violations.items():
+            problems.append({
+                "check": "foreign_key", "column": column, "parent": parent, "count": len(rowids),
+                "examples": rowids[:settings.INTEGRITY_CHECK_EXAMPLES],
+            })
+    finally:
+        conn.close()
+    return {"rows": rows, "problems": problems}
+
+
+def quick_check(db_fn):
+    """Returns list of messages of PRAGMA quick_check, which is ["ok"] for healthy DB file"""
+    conn = _connect(db_fn)
+    try:
+        return [x[0] for x in conn.execute("PRAGMA quick_check")]
+    finally:
+        conn.close()
+
+
+def check_db(db_fn, tables=None):
+    """ Checks DB file <db_fn> (all model.TABLES, or just <tables>), returns report:
+        {
+            "db": <db_fn>, "t": <timestamp of start>, "duration": <seconds>,
+            "quick_check": [...], "problems_count": <count of problems in all tables>,
+            "tables": {<model name>: {"rows": ..., "problems": [{"check", "column", "count", "examples"}, ...]}},
+        }
+        "examples" are primary keys (rowids for foreign_key check) of up to settings.INTEGRITY_CHECK_EXAMPLES
+        invalid rows
+    """
+    if not os.path.isfile(db_fn):
+        raise ValueError(f"Integrity check needs DB file, {db_fn} is not a file")
+    t = time.time()
+    tables = model.TABLES if tables is None else tables
+    with concurrent.futures.ThreadPoolExecutor(settings.INTEGRITY_CHECK_WORKERS) as executor:
+        quick_check_future = executor.submit(quick_check, db_fn)  # the longest one, so it goes first
+        futures = {x.__name__: executor.submit(check_table, db_fn, x) for x in tables}
+        report = {
+            "db": db_fn,
+            "t": int(t),
+            "quick_check": quick_check_future.result(),
+            "tables": {name: future.result() for name, future in futures.items()},
+        }
+    report["problems_count"] = sum(len(x["problems"]) for x in report["tables"].values())
+    report["duration"] = time.time() - t
+
+    for name, result in report["tables"].items():
+        for problem in result["problems"]:
+            logging.warning(f"Integrity check: {name}.{problem['column']}: {problem['count']} row(s) failed {problem['check']} check, e.g. {problem['examples']}")
+    if report["quick_check"] != ["ok"]:
+        logging.error(f"Integrity check: quick_check of {db_fn} failed: {report['quick_check']}")
+    return report
@@ -0,0 +1,184 @@
+""" Operational metrics in Prometheus text format, served at /metrics
+
+    Counters and histograms are updated where things happen (input files, produce, main loop), gauges
+    (input folder backlog, DB and WAL size) are read when metrics are scraped. Values live in memory of the process,
+    so counters start from zero after restart (Prometheus handles that, see rate() and increase()).
+
+    Input files are labelled by extension, e.g. latency of .be2 files (batch produced) is
+    dispatch_input_file_parse_seconds{extension="be2"} and dispatch_input_file_apply_seconds{extension="be2"}.
+
+    Alerting example: plant falls behind the batch controller when dispatch_input_backlog_files stays above zero,
+    or dispatch_main_loop_seconds grows.
+
+    Metrics are registered by init_app(app), to be called by web.py when the Flask app is created.
+"""
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+import flask
+
+from . import func
+from . import glo
+from . import model
+from . import settings
+
+_REGISTRY = []
+
+blueprint = flask.Blueprint("metrics", __name__)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    escaped = [str(x).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n") for x in values]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labelnames, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Common ancestor of metrics. Values are kept per combination of label values (in order of <labelnames>)"""
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} needs labels [{', '.join(self.labelnames)}], got [{', '.join(labels)}]")
+        return tuple(labels[x] for x in self.labelnames)
+
+    def samples(self):
+        """Returns list of (name, labels string, value)"""
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, k), v) for k, v in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge with value computed by <function> when scraped"""
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        return [] if value is None else [(self.name, "", value)]
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets or settings.METRICS_BUCKETS)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0, "count": 0}
+            h = self._values[key]
+            h["buckets"][bisect.bisect_left(self.buckets, value)] += 1  # last one is +Inf
+            h["sum"] += value
+            h["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes duration of with-block, in seconds"""
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t, **labels)
+
+    def samples(self):
+        ret = []
+        with self._lock:
+            values = [(k, dict(v, buckets=list(v["buckets"]))) for k, v in self._values.items()]
+        for key, h in values:
+            cumulative = 0
+            for le, count in zip(self.buckets + ["+Inf"], h["buckets"]):
+                cumulative += count
+                ret.append((f"{self.name}_bucket", _format_labels(self.labelnames + ("le",), key + (le,)), cumulative))
+            ret.append((f"{self.name}_sum", _format_labels(self.labelnames, key), h["sum"]))
+            ret.append((f"{self.name}_count", _format_labels(self.labelnames, key), h["count"]))
+        return ret
+
+
+def _input_backlog():
+    input_path = glo.cfg.get("input_path")
+    if not input_path or not os.path.isdir(input_path):
+        return None
+    return sum(1 for x in func.list_of_files(input_path) if not func.is_fn_temporary(x))
+
+
+def _db_file_size(suffix=""):
+    def size():
+        db_fn = model.db.database
+        if not db_fn or not os.path.isfile(db_fn):
+            return None  # not mounted, or in-memory DB
+        try:
+            return os.path.getsize(f"{db_fn}{suffix}")
+        except OSError:
+            return 0  # there is no WAL file after clean shutdown
+    return size
+
+
+FILES_PROCESSED = Counter("dispatch_input_files_processed_total", "Files processed from input folder", ["extension"])
+INPUT_PARSE_SECONDS = Histogram("dispatch_input_file_parse_seconds", "Parsing of file from input folder", ["extension"])
+INPUT_APPLY_SECONDS = Histogram("dispatch_input_file_apply_seconds", "Update of DB according to file from input folder", ["extension"])
+ORDERS_PRODUCED = Counter("dispatch_orders_produced_total", "Orders sent to production")
+PRODUCE_SECONDS = Histogram("dispatch_produce_seconds", "Creating order and sending it to production")
+MAIN_LOOP_SECONDS = Histogram("dispatch_main_loop_seconds", "Iteration of main loop (without waiting for new files)")
+INPUT_BACKLOG = Gauge("dispatch_input_backlog_files", "Files waiting in input folder", _input_backlog)
+DB_SIZE = Gauge("dispatch_db_size_bytes", "Size of DB file", _db_file_size())
+DB_WAL_SIZE = Gauge("dispatch_db_wal_size_bytes", "Size of DB write-ahead log", _db_file_size("-wal"))
+
+
+def extension(fn):
+    return os.path.splitext(fn)[1].lstrip(".").lower()
+
+
+def render():
+    """Returns all metrics in Prometheus text format"""
+    return "\n".join(x.render() for x in _REGISTRY) + "\n"
+
+
+@blueprint.route("/metrics")
+def metrics():
+    return flask.Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    app.register_blueprint(blueprint)
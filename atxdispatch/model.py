@@ -15,7 +15,11 @@
 """
 # TODO NTH: use strict pragma. WAIT until Windows have Python 3.11
 
+import base64
+import bisect
+import json
 import os
+import threading
 import time
 import logging
 from decimal import Decimal, ROUND_HALF_UP
@@ -25,14 +29,23 @@ from hashlib import sha256
 from peewee import (
     AutoField,
     BooleanField,
+    Case,
     DoesNotExist,
+    EXCLUDED,
     ForeignKeyField,
     IntegrityError,
+    JOIN,
     Model,
+    SQL,
+    Value,
     SqliteDatabase,
     TextField,
+    chunked,
+    fn,
+    prefetch,
 )
 from peewee_migrate import Router
+from playhouse.migrate import SqliteMigrator, migrate
 
 from . import glo
 from .func import expand_user_or_none
@@ -49,8 +62,86 @@ DEL_TABLES = ["Order", "Material", "Recipe", "Defaults", "Car", "Pump", "Driver"
 # List of model names supporting universal endpoints for 'add/update' queries.
 AU_TABLES = ["PumpOrder", "Material", "Defaults", "Car", "Pump", "Driver", "ConstructionSite", "Customer", "Contract", "PumpSurcharge", "TransportZone", "CompanySurcharge", "Price", "TransportType", "LockedTable"]
 
+_query_counters = threading.local()
+
+
+class QueryCounter:
+    """Context manager counting SQL queries (and time spent in them) executed by current thread within the block:
+
+        with QueryCounter() as qc:
+            ...
+        print(qc.count, qc.time)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+
+    def __enter__(self):
+        if not hasattr(_query_counters, "active"):
+            _query_counters.active = []
+        _query_counters.active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _query_counters.active.remove(self)
+
+
+class CountingSqliteDatabase(SqliteDatabase):
+    """SqliteDatabase reporting every executed query to active QueryCounter(s) of current thread.
+    Also calls callbacks registered by on_transaction_end() and begins transactions as settings.DB_TRANSACTION_MODE says
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._transaction_end_callbacks = threading.local()
+
+    def on_transaction_end(self, callback):
+        """Calls <callback>() after transaction of current thread is committed or rolled back (now, if there is no transaction)"""
+        if not self.in_transaction():
+            callback()
+            return
+        callbacks = self._transaction_end_callbacks.__dict__.setdefault("list", [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+
+    def _transaction_ended(self):
+        callbacks = self._transaction_end_callbacks.__dict__.pop("list", [])
+        for callback in callbacks:
+            callback()
+
+    def begin(self, lock_type=None):
+        """Transactions take lock given by settings.DB_TRANSACTION_MODE, unless <lock_type> is specified"""
+        return super().begin(lock_type or settings.DB_TRANSACTION_MODE)
+
+    def commit(self):
+        try:
+            return super().commit()
+        finally:
+            self._transaction_ended()
+
+    def rollback(self):
+        try:
+            return super().rollback()
+        finally:
+            self._transaction_ended()
+
+    def execute_sql(self, sql, *args, **kwargs):
+        counters = getattr(_query_counters, "active", None)
+        if not counters:
+            return super().execute_sql(sql, *args, **kwargs)
+        t = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t
+            for counter in counters:
+                counter.count += 1
+                counter.time += elapsed
+
+
 # Singleton - database connection. Initialized at runtime via mount_db
-db = SqliteDatabase(None)
+db = CountingSqliteDatabase(None)
 
 # Change loging level to INFO to avoid logging every query in DEV enviroment
 logger = logging.getLogger("peewee")
@@ -105,16 +196,21 @@ def mount_db(db_file):
         os.makedirs(os.path.dirname(db_file), exist_ok=True)
 
     # SQLite by default reuses auto increment field after delete, pragma "foreign_keys" avoids this
-    # check_same_thread solves threading problem
-    db.init(db_file, pragmas=[("foreign_keys", "on")], check_same_thread=False)
+    # Pragmas (see settings.DB_PRAGMAS) are applied to every new connection. Peewee opens separate connection
+    # for each thread (web, main loop, workers), so readers do not share connection (and transaction) with writer.
+    # check_same_thread is kept just for safety, connection should not cross threads anyway
+    db.init(db_file, pragmas=list(settings.DB_PRAGMAS.items()), timeout=settings.DB_TIMEOUT, check_same_thread=False)
 
     # Test connection - it should fail here, if something is wrong
-    db.connect()
+    db.connect(reuse_if_open=True)
+    invalidate_caches()  # caches could be filled from previously mounted db
 
     logging.info(f"DB Pragma cache_size: {db.cache_size}")
     logging.info(f"DB Pragma journal_mode: {db.journal_mode}")
     logging.info(f"DB Pragma journal_size_limit: {db.journal_size_limit}")
     logging.info(f"DB Pragma page_size: {db.page_size}")
+    logging.info(f"DB Pragma synchronous: {db.synchronous}")
+    logging.info(f"DB Pragma mmap_size: {db.mmap_size}")
 
 
 def mount_and_migrate_db(db_fn):
@@ -128,6 +224,54 @@ def mount_and_migrate_db(db_fn):
     logging.info("will run db migrations")
     router = Router(SqliteDatabase(db_fn))
     router.run()
+    ensure_schema()
+
+
+def ensure_schema():
+    """Creates tables introduced outside of peewee_migrate migrations, if they do not exist yet.
+    Also performs one-time data migrations bound to creation of such table. Safe to call repeatedly.
+    """
+    if not Counter.table_exists():
+        logging.info("creating table for counters")
+        with db.atomic():
+            Counter.create_table()
+            Counter.import_state(settings.STATE_FILE)
+
+    if not StockBalance.table_exists():
+        logging.info("creating table for stock balances")
+        with db.atomic():
+            StockBalance.create_table()
+            StockBalance.rebuild()
+    # tables exist already, this creates just indexes (from Meta.indexes and fields with index=True), which are missing
+    for model_class in (StockMovement, Order, BatchMaterial):
+        model_class.create_table(safe=True)
+
+    # Data derived from prices are calculated later by update_stored_prices(), setup they depend on is not loaded yet
+    if not StateValue.table_exists():
+        StateValue.create_table()
+    with db.atomic():
+        if _add_missing_columns(Order, Order.PRICE_FIELDS):
+            StateValue.set(StateValue.PRICES_SETUP, None)
+
+    if missing_rollups := [x for x in ROLLUPS if not x.table_exists()]:
+        logging.info("creating daily rollup tables")
+        with db.atomic():
+            db.create_tables(missing_rollups)
+            StateValue.set(StateValue.PRICES_SETUP, None)
+    for rollup in ROLLUPS:
+        rollup.create_table(safe=True)  # unique keys (see _DailyRollup.unique_key) missing in tables created by older version
+
+
+def _add_missing_columns(model_class, field_names):
+    """Adds columns for <field_names> of <model_class>, which are not in DB table yet. Returns list of added field names"""
+    table_name = model_class._meta.table_name
+    existing = {x.name for x in db.get_columns(table_name)}
+    missing = [x for x in field_names if model_class._meta.fields[x].column_name not in existing]
+    if missing:
+        logging.info(f"adding columns {missing} to table {table_name}")
+        migrator = SqliteMigrator(db)
+        migrate(*[migrator.add_column(table_name, model_class._meta.fields[x].column_name, model_class._meta.fields[x]) for x in missing])
+    return missing
 
 
 class BaseModel(Model):
@@ -141,16 +285,19 @@ class BaseModel(Model):
         # https://docs.python.org/3/whatsnew/changelog.html
         # strict_tables = True
 
-    def as_json(self):
+    def as_json(self, setup=None):
         """Returns database fields as JSON serializable hashtable
         For all TimestampField is also added a human representation (with suffix '_human')
+        <setup> is Setup record, pass it when serializing many records to avoid loading it again and again
         TODO REF NTH - this _human thing is also handled by _human properties in particular models, so here is most propably obsolete
             Should be left only in models, because as_json properties are not available in printouts
         """
-        ret = self.__data__
-        for field_name, field in self._meta.fields.items():
-            if isinstance(field, TimestampField):
-                ret[f"{field_name}_human"] = func.human_datetime(ret[field_name], Setup.singleton().datetime_format)
+        ret = dict(self.__data__)  # copy - record can be shared (cached) by more threads
+        timestamp_fields = [k for k, v in self._meta.fields.items() if isinstance(v, TimestampField)]
+        if timestamp_fields:
+            datetime_format = (setup or Setup.singleton()).datetime_format
+            for field_name in timestamp_fields:
+                ret[f"{field_name}_human"] = func.human_datetime(ret[field_name], datetime_format)
         return ret
 
     def as_endpoint(self):
@@ -161,6 +308,18 @@ class BaseModel(Model):
         """
         return self.as_json()
 
+    @classmethod
+    def bulk_load(cls, queryset):
+        """ Returns list of records in queryset, ready for as_endpoint().
+            Models with related data in as_endpoint override this to load relations in bulk (avoiding query per record).
+        """
+        return list(queryset.objects())
+
+    @classmethod
+    def bulk_as_endpoint(cls, queryset):
+        """ Returns list of as_endpoint() of all records in queryset, loaded by bulk_load() """
+        return [x.as_endpoint() for x in cls.bulk_load(queryset)]
+
     def update_from_json(self, json_data):
         """Updates internal data from json. Keys in json are model field names."""
         for k, v in json_data.items():
@@ -214,25 +373,122 @@ class BaseModel(Model):
         return errors == 0
 
     @classmethod
-    def select_ordered(cls, order_by):
+    def _field(cls, name):
+        """ Returns model field <name> (or column name, e.g. customer_id). Raises AttributeError, if there is no such field
+            (methods and properties are not fields)
+        """
+        try:
+            return cls._meta.combined[name]
+        except KeyError:
+            raise AttributeError(f"'{name}' is not a field of {cls.__name__}")
+
+    @classmethod
+    def _parse_order_by(cls, order_by):
+        """ Returns tuple (field, reversed) from <order_by> in "endpoint format" (see select_ordered) """
+        order_reversed = order_by.startswith("!")
+        try:
+            return cls._field(order_by[1:] if order_reversed else order_by), order_reversed
+        except AttributeError:
+            raise AttributeError(f"Can't order by '{order_by}'")
+
+    @classmethod
+    def _filter_condition(cls, filters):
+        """ Returns SQL condition from <filters>, hashtable in "endpoint format": column name -> value.
+                {"name": "foo"}     exact match
+                {"~name": "foo"}    name contains "foo" (case insensitive)
+                {"name": [1, 2]}    one of values
+                {"name": None}      empty value
+            Raises AttributeError, if column does not exist
+        """
+        ret = None
+        for name, value in filters.items():
+            if name.startswith("~"):
+                condition = cls._field(name[1:]).contains(value)
+            elif isinstance(value, (list, tuple)):
+                condition = cls._field(name).in_(value)
+            elif value is None:
+                condition = cls._field(name).is_null()
+            else:
+                condition = cls._field(name) == value
+            ret = condition if ret is None else ret & condition
+        return ret
+
+    @classmethod
+    def select_ordered(cls, order_by, filters=None):
         """ Returns cls.select().order_by(foo), where 'foo' is constructed from parameter
             order_by, which is in "endpoint format", e.g. column name optionally prefixed with "!"
             order_by can be empty or None
+            <filters> restrict records, see _filter_condition for format
             Raises AttributeError, if order_by column does not exists or is not "orderable by"
         """
         dataset = cls.select()
+        if filters:
+            dataset = dataset.where(cls._filter_condition(filters))
         if order_by:
-            order_reversed = order_by.startswith("!")
-            order_field = getattr(cls, order_by[1:] if order_reversed else order_by)
-
-            if isinstance(order_field, property):  # not a great style, but it shouldn't bite us back
-                raise AttributeError(f"Can't order by property '{order_by}'")
-
+            order_field, order_reversed = cls._parse_order_by(order_by)
             if order_reversed:
                 order_field = order_field.desc()
             dataset = dataset.order_by(order_field)
         return dataset
 
+    @classmethod
+    def select_page(cls, order_by=None, filters=None, limit=None, after=None, with_total=False):
+        """ Same as queryset_to_ux(cls.select_ordered(order_by, filters)), but returns at most <limit> records.
+            Uses keyset pagination: result contains key "next" with cursor (opaque string) of the next page, or None for
+            the last page. Pass it as <after> to get the next page - query then starts right after the last returned record
+            (via index, no matter how deep the page is) and is not confused by records inserted meanwhile.
+            With <with_total>, result contains key "total" with count of all records matching <filters>.
+            Raises AttributeError for unknown columns, ValueError for invalid cursor
+        """
+        if order_by:
+            order_field, order_reversed = cls._parse_order_by(order_by)
+        else:
+            order_field, order_reversed = cls._meta.primary_key, False
+        pk = cls._meta.primary_key
+
+        dataset = cls.select()
+        if filters:
+            dataset = dataset.where(cls._filter_condition(filters))
+        ret = {"total": dataset.count()} if with_total else {}
+
+        if after:
+            try:
+                last_value, last_id = json.loads(base64.urlsafe_b64decode(after.encode()))
+            except (ValueError, TypeError):
+                raise ValueError(f"Invalid cursor '{after}'")
+            # SQLite puts NULL values first in ascending order (last in descending)
+            if order_reversed and last_value is None:
+                condition = order_field.is_null() & (pk < last_id)
+            elif order_reversed:
+                condition = (order_field < last_value) | ((order_field == last_value) & (pk < last_id)) | order_field.is_null()
+            elif last_value is None:
+                condition = (order_field.is_null() & (pk > last_id)) | order_field.is_null(False)
+            else:
+                condition = (order_field > last_value) | ((order_field == last_value) & (pk > last_id))
+            dataset = dataset.where(condition)
+
+        # primary key makes ordering unique, which is necessary for cursor
+        if order_reversed:
+            dataset = dataset.order_by(order_field.desc(), pk.desc())
+        else:
+            dataset = dataset.order_by(order_field, pk)
+
+        if limit is None:
+            ret["data"] = cls.bulk_as_endpoint(dataset)
+            ret["next"] = None
+            return ret
+
+        records = cls.bulk_load(dataset.limit(limit + 1))  # one more record tells whether there is next page
+        ret["data"] = [x.as_endpoint() for x in records[:limit]]
+        if len(records) > limit:
+            # raw values, as_endpoint() of some models replaces or formats them
+            last = records[limit - 1].__data__
+            cursor = [last.get(order_field.name), last[pk.name]]
+            ret["next"] = base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+        else:
+            ret["next"] = None
+        return ret
+
 
 class HiddeableModel(BaseModel):
     """Table, where record is hideable - contains 'hidden' field"""
@@ -258,6 +514,84 @@ class AuditedModel(BaseModel):
         self.audit_changed_at = TimestampField.now()
 
 
+_transaction_caches = threading.local()  # {_CachedModel subclass: cache} of tables changed by transaction of the thread
+
+
+def invalidate_caches():
+    """Forgets data cached by all _CachedModel subclasses. Call it after writing into DB other way than through model"""
+    for cls in _CachedModel.__subclasses__():
+        cls.invalidate_cache()
+
+
+class _CachedModel(BaseModel):
+    """Model with data derived from entire table cached in process (see _build_cache), for tables read often and written rarely.
+       Cache is invalidated by every write through model (save, delete_instance). After writing by bulk query
+       (Model.update(), Model.delete()...) call invalidate_cache() (or invalidate_caches()) manually.
+       Transaction, which changed the table, uses its own cache until it ends and the shared cache is invalidated again
+       after commit (or rollback): other threads have their own connections and must not see uncommitted data, but they
+       could rebuild the cache from data committed before the change meanwhile.
+       ! Abstract model, see note in README.md
+    """
+
+    _cache = None
+    _cache_generation = 0  # protects against storing cache built from data, which was changed in the meantime
+
+    @classmethod
+    def _build_cache(cls):
+        raise NotImplementedError
+
+    @classmethod
+    def cached(cls):
+        """Returns cached data, builds them if necessary"""
+        changed = _transaction_caches.__dict__.get("changed", {})
+        if cls in changed:
+            if changed[cls] is None:
+                changed[cls] = cls._build_cache()
+            return changed[cls]
+        if (ret := cls._cache) is None:
+            generation = cls._cache_generation
+            ret = cls._build_cache()
+            if generation == cls._cache_generation:
+                cls._cache = ret
+        return ret
+
+    @classmethod
+    def _forget_cache(cls):
+        cls._cache_generation += 1
+        cls._cache = None
+
+    @classmethod
+    def _transaction_ended(cls):
+        _transaction_caches.__dict__.get("changed", {}).pop(cls, None)
+        cls._forget_cache()
+
+    @classmethod
+    def invalidate_cache(cls):
+        cls._forget_cache()
+        if db.in_transaction():
+            _transaction_caches.__dict__.setdefault("changed", {})[cls] = None
+            db.on_transaction_end(cls._transaction_ended)
+
+    def save(self, force_insert=False, only=None):
+        try:
+            return super().save(force_insert, only)
+        finally:
+            self.invalidate_cache()
+
+    def update_from_json(self, json_data):
+        """Cached record is updated in place, so cache must be invalidated even if update fails (before save)"""
+        try:
+            return super().update_from_json(json_data)
+        finally:
+            self.invalidate_cache()
+
+    def delete_instance(self, *args, **kwargs):
+        try:
+            return super().delete_instance(*args, **kwargs)
+        finally:
+            self.invalidate_cache()
+
+
 class Material(BaseModel):
     ALLOWED_TYPES = ["Admixture", "Aggregate", "Cement", "Water", "Addition"]
 
@@ -280,51 +614,103 @@ class Material(BaseModel):
     def delete_record(cls, record_id):
         """Deletes record and updates inifile with materials. Errors in INI file creation are logged"""
         ret = super(cls, cls).delete_record(record_id)
-        glo.export_material_ini = 1
+        glo.export_material_ini = time.time()
         return ret
 
     def update_from_json(self, json_data):
         """Updates record and inifile with materials. Errors in INI file creation are logged"""
         ret = super().update_from_json(json_data)
-        glo.export_material_ini = 1
+        glo.export_material_ini = time.time()
         return ret
 
+    @staticmethod
+    def _select_consumptions(from_t, to_t, *columns):
+        """ Returns query summing up consumptions (amount_recipe, amount_rq, amount_e1) of orders within given date range
+            by material name. Uses indexes on Order.t, OrderMaterial.order and BatchMaterial.material
+            <columns> are selected before material name
+        """
+        return OrderMaterial.select(
+            *columns,
+            OrderMaterial.name,
+            fn.COALESCE(fn.SUM(BatchMaterial.amount_recipe), 0).alias("amount_recipe"),
+            fn.COALESCE(fn.SUM(BatchMaterial.amount_rq), 0).alias("amount_rq"),
+            fn.COALESCE(fn.SUM(BatchMaterial.amount_e1), 0).alias("amount_e1"),
+        ).\
+            join(Order).\
+            switch(OrderMaterial).\
+            join(BatchMaterial).\
+            where(Order.t.between(from_t, to_t)).\
+            group_by(OrderMaterial.name)
+
     def get_consumptions(self, from_t, to_t):
         """Returns tuple with consumptions of that material within given date range: from recipe, requested, real
         Consumptions are taken from model OrderMaterial, linked to Material (this model) by "name" field
         """
-        amount_recipe = 0
-        amount_rq = 0
-        amount_e1 = 0
-        order_materials = OrderMaterial.select().join(Order).where(Order.t.between(from_t, to_t)).filter(name=self.name)
-        for order_material in order_materials:
-            for bm in order_material.consumptions:
-                amount_recipe += bm.amount_recipe
-                amount_rq += bm.amount_rq
-                amount_e1 += bm.amount_e1
-        return amount_recipe, amount_rq, amount_e1
+        row = self._select_consumptions(from_t, to_t).where(OrderMaterial.name == self.name).tuples().first()
+        return row[1:] if row else (0, 0, 0)
+
+    @classmethod
+    def select_consumptions(cls, from_t, to_t):
+        """ Returns query of all materials, each enhanced with consumptions within date range (amount_recipe, amount_rq, amount_e1),
+            for consumption printout. All consumptions are summed up by single query, see get_consumptions
+        """
+        consumptions = cls._select_consumptions(from_t, to_t).alias("consumptions")
+        return cls.select(
+            cls,
+            fn.COALESCE(consumptions.c.amount_recipe, 0).alias("amount_recipe"),
+            fn.COALESCE(consumptions.c.amount_rq, 0).alias("amount_rq"),
+            fn.COALESCE(consumptions.c.amount_e1, 0).alias("amount_e1"),
+        ).\
+            join(consumptions, JOIN.LEFT_OUTER, on=(consumptions.c.name == cls.name)).\
+            order_by(cls.name)
 
     def get_stock(self):
-        """ Sum of all StockMovements related to this material."""
-        return sum([x.amount for x in self.stock_movements])
+        """ Sum of all StockMovements related to this material (kept in StockBalance)."""
+        balance = StockBalance.get_or_none(StockBalance.material == self)
+        return balance.amount if balance else 0
 
     def get_stock_sums(self, from_t, to_t):
         """Returns tuple of (positive, negative) stock movements of that material within given date range
            Note: negative sum is negative number, e.g total=positive+negative
         """
-        amount_positive = 0
-        amount_negative = 0
-        for x in self.stock_movements.where(StockMovement.t.between(from_t, to_t)):
-            if x.amount > 0:
-                amount_positive += x.amount
-            else:
-                amount_negative += x.amount
-        return amount_positive, amount_negative
+        return StockMovement.select(*StockMovement.sums()).\
+            where(StockMovement.material == self).\
+            where(StockMovement.t.between(from_t, to_t)).\
+            tuples().get()
+
+    @classmethod
+    def select_stock(cls, from_t, to_t):
+        """ Returns query of all materials, each enhanced with stock values for stock printout:
+                stock_initial   stock at <from_t>
+                stock_positive  sum of positive movements within date range
+                stock_negative  sum of negative movements within date range (negative number)
+                stock_sum       stock at <to_t>
+            Only movements since <from_t> are read (via index on material and t), the older ones are summed up in StockBalance
+        """
+        positive, negative = StockMovement.sums(StockMovement.t <= to_t)
+        initial = fn.COALESCE(StockBalance.amount, 0) - fn.COALESCE(fn.SUM(StockMovement.amount), 0)
+        return cls.select(
+            cls,
+            initial.alias("stock_initial"),
+            positive.alias("stock_positive"),
+            negative.alias("stock_negative"),
+            (initial + positive + negative).alias("stock_sum"),
+        ).\
+            join(StockBalance, JOIN.LEFT_OUTER, on=(StockBalance.material == cls.id)).\
+            switch(cls).\
+            join(StockMovement, JOIN.LEFT_OUTER, on=((StockMovement.material == cls.id) & (StockMovement.t >= from_t))).\
+            group_by(cls.id).\
+            order_by(cls.name)
+
+    @classmethod
+    def check_type(cls, type_):
+        """Raises ValueError if <type_> is not allowed"""
+        if type_ not in cls.ALLOWED_TYPES:
+            raise ValueError(f"Material type '{type_}' not allowed, use one of [{', '.join(cls.ALLOWED_TYPES)}]")
 
     def save(self, force_insert=False, only=None):
         """ Do not allow saving material of wrong type."""
-        if self.type not in self.ALLOWED_TYPES:
-            raise ValueError(f"Material type '{self.type}' not allowed, use one of [{', '.join(self.ALLOWED_TYPES)}]")
+        self.check_type(self.type)
         return super().save(force_insert, only)
 
     def as_endpoint(self):
@@ -340,6 +726,81 @@ class StockMovement(BaseModel):
     t = TimestampField(default=TimestampField.now)
     comment = StrippedTextField(null=True)
 
+    class Meta:
+        indexes = (
+            # covers sums of amount by material and date range (there are millions of movements in long running plant)
+            (('material', 't', 'amount'), False),
+        )
+
+    @staticmethod
+    def sums(condition=None):
+        """ Returns SQL expressions (positive, negative) summing up movements (matching <condition>, if given) by sign """
+        def summed(sign_condition):
+            if condition is not None:
+                sign_condition &= condition
+            return fn.COALESCE(fn.SUM(Case(None, [(sign_condition, StockMovement.amount)], 0)), 0)
+        return summed(StockMovement.amount > 0), summed(StockMovement.amount <= 0)
+
+    @db.atomic()
+    def save(self, force_insert=False, only=None):
+        """ Keeps StockBalance up to date, in the same transaction """
+        amounts = {}
+        if self.id is not None and not force_insert:
+            old = StockMovement.select(StockMovement.material, StockMovement.amount).where(StockMovement.id == self.id).tuples().get()
+            amounts[old[0]] = -old[1]
+        ret = super().save(force_insert, only)
+        amounts[self.material_id] = amounts.get(self.material_id, 0) + self.amount
+        StockBalance.add(amounts)
+        return ret
+
+    @db.atomic()
+    def delete_instance(self, *args, **kwargs):
+        ret = super().delete_instance(*args, **kwargs)
+        StockBalance.add({self.material_id: -self.amount})
+        return ret
+
+    @classmethod
+    @db.atomic()
+    def insert_movements(cls, rows):
+        """ Inserts many movements at once (<rows> are hashtables as for insert_many) and updates StockBalance
+            Use this instead of plain insert_many, which would leave StockBalance out of sync
+        """
+        # chunks keep number of SQL variables under SQLite limit (999 in older versions)
+        for chunk in chunked(rows, 200):
+            cls.insert_many(chunk).execute()
+        amounts = {}
+        for x in rows:
+            material_id = x["material"].id if isinstance(x["material"], Material) else x["material"]
+            amounts[material_id] = amounts.get(material_id, 0) + x["amount"]
+        StockBalance.add(amounts)
+
+
+class StockBalance(BaseModel):
+    """ Running sum of StockMovements per material, so current stock does not need to sum up all movements ever made.
+        Updated by StockMovement in the same transaction as the movement itself.
+        After modifying StockMovement by bulk queries (other than StockMovement.insert_movements) call rebuild()
+    """
+    material = ForeignKeyField(Material, primary_key=True, backref="stock_balance", on_delete="CASCADE")
+    amount = StrictDoubleField(default=0)
+
+    @classmethod
+    def add(cls, amounts):
+        """ Adds amounts to balances of materials, <amounts> is hashtable {material_id: amount}. Upserts all materials at once """
+        rows = [{"material": k, "amount": v} for k, v in amounts.items() if v]
+        # chunks keep number of SQL variables under SQLite limit (999 in older versions)
+        for chunk in chunked(rows, 200):
+            cls.insert_many(chunk).\
+                on_conflict(conflict_target=[cls.material], update={cls.amount: cls.amount + EXCLUDED.amount}).\
+                execute()
+
+    @classmethod
+    @db.atomic()
+    def rebuild(cls):
+        """ Calculates all balances from scratch """
+        cls.delete().execute()
+        movements = StockMovement.select(StockMovement.material, fn.SUM(StockMovement.amount)).group_by(StockMovement.material)
+        cls.insert_from(movements, [cls.material, cls.amount]).execute()
+
 
 class Defaults(BaseModel):
     name = StrippedTextField()
@@ -373,7 +834,19 @@ class Defaults(BaseModel):
         return super().save(force_insert, only)
 
 
-class Recipe(BaseModel):
+class _PriceSubject(BaseModel):
+    """ Model, which Price records refer to. Deleting the record deletes its prices (CASCADE in DB), so Price cache must be rebuilt
+        ! Abstract model, see note in README.md
+    """
+
+    def delete_instance(self, *args, **kwargs):
+        try:
+            return super().delete_instance(*args, **kwargs)
+        finally:
+            Price.invalidate_cache()
+
+
+class Recipe(_PriceSubject):
     name = StrippedTextField(unique=True)
     recipe_class = StrippedTextField(null=True)
     exposure_classes = StrippedTextField(null=True)
@@ -509,11 +982,16 @@ class RecipeMaterial(BaseModel):
     k_value = StrictDoubleField(null=True)  # Named "ACCAWR" in .ORD files
     k_ratio = StrictDoubleField(null=True)
 
+    @staticmethod
+    def check_k(material_type, k_value, k_ratio):
+        """Raises ValueError if <k_value> or <k_ratio> is set for material of other type than Addition"""
+        if (k_value or k_ratio) and material_type != "Addition":
+            raise ValueError("Cannot set k_value or k_ratio for RecipeMaterial, which is not of type 'Addition'")
+
     def save(self, force_insert=False, only=None):
         """ Constraint: Do not allow k_value and k_ratio for other materials than Addition."""
         if self.k_value or self.k_ratio:
-            if self.material.type != "Addition":
-                raise ValueError("Cannot set k_value or k_ratio for RecipeMaterial, which is not of type 'Addition'")
+            self.check_k(self.material.type, self.k_value, self.k_ratio)
         return super().save(force_insert, only)
 
 
@@ -531,7 +1009,7 @@ class Sample(AuditedModel):
         return data
 
 
-class Customer(HiddeableModel):
+class Customer(_PriceSubject, HiddeableModel):
     name = StrippedTextField()
     address = StrippedTextField(null=True)
     city = StrippedTextField(null=True)
@@ -550,7 +1028,7 @@ class Customer(HiddeableModel):
         )
 
 
-class ConstructionSite(HiddeableModel):
+class ConstructionSite(_PriceSubject, HiddeableModel):
     name = StrippedTextField(unique=True)
     address = StrippedTextField(null=True)
     city = StrippedTextField(null=True)
@@ -559,8 +1037,11 @@ class ConstructionSite(HiddeableModel):
     comment = StrippedTextField(null=True)
 
 
-class Price(BaseModel):
-    """ Discounts and custom concrete prices. Prices can be specified per Recipe and/or per Customer """
+class Price(_CachedModel):
+    """ Discounts and custom concrete prices. Prices can be specified per Recipe and/or per Customer
+        Entire table is cached in process as hashtable for get_best_price (see _build_cache). Changes of prices (and deleted
+        customers, sites and recipes, see _PriceSubject) invalidate it after commit, see _CachedModel
+    """
 
     PRICE_TYPE_ABSOLUTE = 1             # Absolute (new) price of Recipe, e.g. 5000 (CZK)
     PRICE_TYPE_RELATIVE = 2             # Change against listed price of Recipe, e.g. -500 (CZK)
@@ -673,17 +1154,38 @@ class Price(BaseModel):
     @property
     def price(self):
         """ Returns price in currency unit (e.g. calculates actual price from all that percents and relative values)"""
+        return self.price_of(self.recipe)
+
+    def price_of(self, recipe):
+        """ Same as price, but relative prices are counted from given <recipe> (needed for prices valid for every recipe) """
         if self.type == self.PRICE_TYPE_ABSOLUTE:
             return self.amount
         elif self.type == self.PRICE_TYPE_RELATIVE:
-            return self.recipe.price + self.amount
+            return recipe.price + self.amount
         elif self.type == self.PRICE_TYPE_PERCENT:
-            return self.recipe.price * self.amount / 100
+            return recipe.price * self.amount / 100
         elif self.type == self.PRICE_TYPE_RELATIVE_PERCENT:
-            return self.recipe.price * (100 + self.amount) / 100
+            return recipe.price * (100 + self.amount) / 100
         else:
             raise NotImplementedError(f"Unknown combination of type '{self.type}' and amount '{self.amount}'")
 
+    # Key part of cache standing for "any construction site"
+    _ANY_SITE = "*"
+
+    @classmethod
+    def _build_cache(cls):
+        """ Returns hashtable (recipe_id, customer_id, construction_site_id) -> Price.
+            Besides exact keys, there is key (recipe_id, customer_id, _ANY_SITE) for every recipe and customer (recipe_id is None
+            for prices valid for every recipe), with the same record the former SQL query returned: price without construction site
+            if exists, otherwise the one with lowest construction site id (order of unique index)
+        """
+        ret = {}
+        prices = cls.select().order_by(cls.recipe, cls.customer, cls.construction_site.is_null(False), cls.construction_site, cls.id)
+        for x in prices:
+            ret.setdefault((x.recipe_id, x.customer_id, x.construction_site_id), x)
+            ret.setdefault((x.recipe_id, x.customer_id, cls._ANY_SITE), x)
+        return ret
+
     @classmethod
     def get_best_price(cls, recipe, customer, construction_site):
         """ Returns tuple (price, reason_as_string) of appropriate concrete price for given recipe, customer
@@ -694,21 +1196,32 @@ class Price(BaseModel):
             even if the latter is lower)
         """
 
+        return cls._best_price(cls.cached(), recipe, customer, construction_site)
+
+    @classmethod
+    def get_best_prices(cls, combinations):
+        """ Same as get_best_price for every (recipe, customer, construction_site) tuple in <combinations>, returns list of results.
+            Price table is not read again in between, so all results come from the same version of prices
+        """
+        prices = cls.cached()
+        return [cls._best_price(prices, *x) for x in combinations]
+
+    @classmethod
+    def _best_price(cls, prices, recipe, customer, construction_site):
+        """ Implements get_best_price, <prices> is the hashtable from _build_cache """
+        recipe_id = recipe.id if recipe else None
+
         if customer and recipe and construction_site:
-            prices = cls.select().where(cls.recipe == recipe).where(cls.customer == customer).where(cls.construction_site == construction_site)
-            if prices.count():
-                return prices[0].price, f"Using special price defined for recipe, customer '{customer.name}' and construction site '{construction_site.name}'"
+            if price := prices.get((recipe_id, customer.id, construction_site.id)):
+                return price.price_of(recipe), f"Using special price defined for recipe, customer '{customer.name}' and construction site '{construction_site.name}'"
 
         if customer:
-            prices = cls.select().where(cls.recipe == recipe).where(cls.customer == customer)
-            if prices.count():
-                return prices[0].price, f"Using special price defined for recipe and customer '{customer.name}'"
+            if price := prices.get((recipe_id, customer.id, cls._ANY_SITE)):
+                return price.price_of(recipe), f"Using special price defined for recipe and customer '{customer.name}'"
 
             # Price for recipe not found. Try to find general Price for every recipe
-            prices = cls.select().where(cls.customer == customer).where(cls.recipe.is_null())
-            if prices.count():
-                prices[0].recipe = recipe  # must tell the record from what recipe it should count the price
-                return prices[0].price, f"Using special price defined for customer '{customer.name}' and every recipe"
+            if price := prices.get((None, customer.id, cls._ANY_SITE)):
+                return price.price_of(recipe), f"Using special price defined for customer '{customer.name}' and every recipe"
 
         if recipe:
             # no special price for given customer was found, default to price in recipe
@@ -721,8 +1234,52 @@ class TransportType(HiddeableModel):
     """ E.g. "sklopka", "mix"  ... just names """
     name = StrippedTextField(unique=True)
 
+    def save(self, force_insert=False, only=None):
+        """Cached zones hold their (lazily loaded) transport type, so zone cache must be rebuilt after rename"""
+        try:
+            return super().save(force_insert, only)
+        finally:
+            TransportZone.invalidate_cache()
+
+    def delete_instance(self, *args, **kwargs):
+        """Deleting type modifies TransportZone.transport_type (SET NULL in DB), so zone index must be rebuilt"""
+        try:
+            return super().delete_instance(*args, **kwargs)
+        finally:
+            TransportZone.invalidate_cache()
+
+
+class _TransportZoneIndex:
+    """ Interval index of TransportZone records, answers "which zones match distance" by binary search.
+        Zone limits are integers, so every zone is converted to closed interval of integers [lo, hi].
+        Number line is split into segments at every lo and hi+1; within a segment the set of matching zones does not change,
+        so it is precomputed (in get_zones order) for every segment.
+    """
+
+    def __init__(self, zones):
+        self.zones = zones  # all zones, in DB order
+
+        def closed_interval(z):
+            return (
+                z.distance_km_min if z.distance_min_inclusive else z.distance_km_min + 1,
+                z.distance_km_max if z.distance_max_inclusive else z.distance_km_max - 1,
+            )
+
+        # get_zones used to run one query per inclusivity combination: exclusive/exclusive, exclusive/inclusive... and concatenate results
+        ordered = sorted(zones, key=lambda z: 2 * bool(z.distance_min_inclusive) + bool(z.distance_max_inclusive))
+        intervals = [(z, *closed_interval(z)) for z in ordered]
+        intervals = [x for x in intervals if x[1] <= x[2]]
+
+        self.starts = sorted({lo for (_, lo, _) in intervals} | {hi + 1 for (_, _, hi) in intervals})
+        self.segments = [[z for (z, lo, hi) in intervals if lo <= start <= hi] for start in self.starts]
+
+    def zones_of_distance(self, distance):
+        """Returns zones matching <distance>, which must be int"""
+        i = bisect.bisect_right(self.starts, distance) - 1
+        return self.segments[i] if i >= 0 else []
+
 
-class TransportZone(BaseModel):
+class TransportZone(_CachedModel):
     """ Transport zones. Some facilities use transport zones instead of vehicle price per km
         (actual mode how transport price is calculated is set up in config.hjson)
     """
@@ -752,47 +1309,59 @@ class TransportZone(BaseModel):
             - then zones that match only distance
             - then rest of zones
         """
-        try:
-            transport_type = Car.get_by_id(vehicle_id).transport_type
-        except DoesNotExist:
-            transport_type = None
-
-        zones_of_distance = \
-            TransportZone.select() \
-                .where(TransportZone.distance_km_max > distance) \
-                .where(TransportZone.distance_km_min < distance) \
-                .where(TransportZone.distance_min_inclusive == False) \
-                .where(TransportZone.distance_max_inclusive == False) \
-            + TransportZone.select() \
-                .where(TransportZone.distance_km_max >= distance) \
-                .where(TransportZone.distance_km_min < distance) \
-                .where(TransportZone.distance_min_inclusive == False) \
-                .where(TransportZone.distance_max_inclusive == True) \
-            + TransportZone.select() \
-                .where(TransportZone.distance_km_max > distance) \
-                .where(TransportZone.distance_km_min <= distance) \
-                .where(TransportZone.distance_min_inclusive == True) \
-                .where(TransportZone.distance_max_inclusive == False) \
-            + TransportZone.select() \
-                .where(TransportZone.distance_km_max >= distance) \
-                .where(TransportZone.distance_km_min <= distance) \
-                .where(TransportZone.distance_min_inclusive == True) \
-                .where(TransportZone.distance_max_inclusive == True)
-
-        # TODO: does this filter out some results after we did the database query?
-        zones_of_distance_and_type = [x for x in zones_of_distance if x.transport_type == transport_type] if transport_type else []
-
-        # Now put found zones in proper order into <ret>. Ugly, but works
+        transport_type_id = None
+        if vehicle_id is not None:
+            try:
+                transport_type_id = Car.get_by_id(vehicle_id).transport_type_id
+            except DoesNotExist:
+                pass
+
+        index = TransportZone.cached()
+        # Zone limits are StrictIntegerField, which always converted <distance> to int when comparing in SQL - keep that behaviour
+        zones_of_distance = index.zones_of_distance(int(distance))
+        zones_of_distance_and_type = [x for x in zones_of_distance if x.transport_type_id == transport_type_id] if transport_type_id else []
+
+        # Now put found zones in proper order into <ret>
         # I do not use shortcut like list(set()), because need to prevent order
         ret = zones_of_distance_and_type.copy()
-
-        for x in zones_of_distance:
-            if x not in ret:
-                ret.append(x)
-        for x in TransportZone.select():
-            if x not in ret:
+        used = {x.id for x in ret}
+        for x in zones_of_distance + index.zones:
+            if x.id not in used:
+                used.add(x.id)
                 ret.append(x)
+        return ret
+
+    @staticmethod
+    def best_zone(distance):
+        """ Returns the same as get_zones(distance)[0], but without building entire list. Raises LookupError if there are no zones """
+        index = TransportZone.cached()
+        return (index.zones_of_distance(int(distance)) or index.zones)[0]
+
+    @classmethod
+    def _build_cache(cls):
+        return _TransportZoneIndex(list(cls.select().order_by(cls.id)))
+
+    def _recalculate_order_prices(self):
+        """ Recalculates stored prices of orders, which transport price may depend on this zone (see Order.calc_price_transport).
+            Called in the transaction of the change, after the cache was invalidated (so the transaction sees changed zones, see _CachedModel)
+        """
+        if not glo.setup.get("transport_zones", False):
+            return
+        Order.recalculate_prices(Order.select().where(
+            Order.price_transport_modified.is_null() & ~Order.without_transport &
+            (Order.transport_zone_modified.is_null() | (Order.transport_zone_modified == self.id))
+        ))
 
+    def save(self, force_insert=False, only=None):
+        with db.atomic():
+            ret = super().save(force_insert, only)
+            self._recalculate_order_prices()
+        return ret
+
+    def delete_instance(self, *args, **kwargs):
+        with db.atomic():
+            ret = super().delete_instance(*args, **kwargs)
+            self._recalculate_order_prices()
         return ret
 
     def as_endpoint(self):
@@ -1002,8 +1571,8 @@ class Order(HiddeableModel, AuditedModel):
 
     volume = StrictDoubleField(null=True)
     comment = StrippedTextField(null=True)
-    auto_number = StrictIntegerField()   # Auto numbering feature: numbers beginning with state/dispatch.json["order_num_counter"]
-    invoice_number = StrictIntegerField(null=True)  # invoice auto number, state/dispatch.json["invoice_num_counter"]
+    auto_number = StrictIntegerField()   # Auto numbering feature: Counter "order_num_counter" (formerly in state/dispatch.json)
+    invoice_number = StrictIntegerField(null=True)  # invoice auto number, Counter "invoice_num_counter"
     without_water = BooleanField(default=False)
     payment_type = EnumField(allowed_values=PAYMENT_TYPE_NAMES.keys(), default=PAYMENT_CASH, null=True)  # TODO default ma byt 'nezadano'
     temperature = StrictDoubleField(null=True)  # in Celsius, in time of order creation
@@ -1031,7 +1600,7 @@ class Order(HiddeableModel, AuditedModel):
     # TODO NTH NEXTLIFE na dodaci list pouzit :virtualni: property best_known_temperature, ktera je prednostne z Batch, a sekundarne z Order.
 
     status = EnumField(allowed_values=STATUS_NAMES.keys(), default=STATUS_SENT)
-    t = TimestampField(default=TimestampField.now)
+    t = TimestampField(default=TimestampField.now, index=True)  # reports are filtered by date range
 
     recipe_record = ForeignKeyField(Recipe, null=True, backref="orders", on_delete="SET NULL")
 
@@ -1068,6 +1637,28 @@ class Order(HiddeableModel, AuditedModel):
     r_price = StrictDoubleField(null=True)
     r_price_note = StrippedTextField(null=True)
 
+    # Resulting prices for accounting purposes, VAT-less and currency-less (except price_grand_total).
+    # Those are calculated from the order, its surcharges and deliveries whenever their inputs change (see update_prices),
+    # so printouts and lists do not need to calculate them again and again, and reports can sum them in SQL.
+    # Modified (aka user-set) prices are preferred. Note: test against None value (meaning 'not set') when preferring them,
+    # do not use simple "or", because self.price_*_modified==0 meant that user want the price to be zero.
+    price_concrete = StrictDoubleField(null=True)
+    price_transport = StrictDoubleField(null=True)
+    price_surcharges = StrictDoubleField(null=True)
+    price_total = StrictDoubleField(null=True)  # concrete, transport and surcharges
+    price_grand_total = StrictDoubleField(null=True)  # price with vat, rounded - that means amount "to be paid"
+
+    PRICE_FIELDS = ["price_concrete", "price_transport", "price_surcharges", "price_total", "price_grand_total"]
+
+    # Fields of the order stored prices are calculated from (others are surcharges, deliveries, VAT rate and transport zones)
+    PRICE_INPUT_FIELDS = [
+        "volume", "r_price", "without_transport", "transport_zone_modified", "distance_driven_modified", "price_per_km_modified",
+        "price_concrete_modified", "price_transport_modified", "price_surcharges_modified",
+    ]
+
+    # Fields daily rollups of orders are calculated from (see _DailyRollup)
+    ROLLUP_FIELDS = ["t", "volume", "r_name", "customer", "construction_site", "payment_type", "price_total", "price_grand_total"]
+
     def archive(self):
         """Moves order to 'archived' state and saves modified record into DB
         (Instead of deleting, just set up 'Archive' flag to hide it from view)
@@ -1160,7 +1751,7 @@ class Order(HiddeableModel, AuditedModel):
             # As a fallback it uses 1st zone found, which is random in case there is more zones for given distance.
             # But this seems to be OK - user can change required zone explicitly in expedition form
             try:
-                zone = self.transport_zone_modified or TransportZone.get_zones(kms)[0]
+                zone = self.transport_zone_modified or TransportZone.best_zone(kms)
             except LookupError:
                 return None
             try:
@@ -1185,7 +1776,7 @@ class Order(HiddeableModel, AuditedModel):
                 pass
 
     def calc_price(self):
-        return sum([self.price_concrete or 0, self.price_transport or 0, self.price_surcharges or 0])
+        return self.price_total
 
     def calc_price_surcharges(self):
         """ total price of surcharges (VAT-less, currency-less)"""
@@ -1193,28 +1784,65 @@ class Order(HiddeableModel, AuditedModel):
             return 0
         return sum([x.price_total for x in self.surcharges])
 
-    @property
-    def price_concrete(self):
-        """ Concrete price for accounting purposes. Due to workflow, modified (aka user-set) price is preferred. """
-        # note: test against None value (meaning 'not set'). Do not use simple "or",
-        # because self.price_*_modified==0 meant that user want the price to be zero. Ditto for next two properties.
-        if (x := self.price_concrete_modified) is not None:
-            return x
-        return self.calc_price_concrete()
+    def update_prices(self):
+        """ Calculates stored prices (see PRICE_FIELDS), does not save them """
+        self.price_concrete = self.price_concrete_modified if self.price_concrete_modified is not None else self.calc_price_concrete()
+        self.price_transport = self.price_transport_modified if self.price_transport_modified is not None else self.calc_price_transport()
+        self.price_surcharges = self.price_surcharges_modified if self.price_surcharges_modified is not None else self.calc_price_surcharges()
+        self.price_total = sum([self.price_concrete or 0, self.price_transport or 0, self.price_surcharges or 0])
+        try:
+            self.price_grand_total = with_vat(self.price_total) + self.calc_rounding()
+        except TypeError:
+            self.price_grand_total = self.price_total
 
-    @property
-    def price_transport(self):
-        """ Transport price for accounting purposes. Due to workflow, modified (aka user-set) price is preferred. """
-        if (x := self.price_transport_modified) is not None:
-            return x
-        return self.calc_price_transport()
+    def save_prices(self):
+        """ Recalculates stored prices and saves them, if they changed. Called when surcharges or deliveries of the order change """
+        old_prices = [getattr(self, x) for x in self.PRICE_FIELDS]
+        self.update_prices()
+        if [getattr(self, x) for x in self.PRICE_FIELDS] == old_prices:
+            return 0
+        return self.save(only=self.PRICE_FIELDS)
 
-    @property
-    def price_surcharges(self):
-        """ Surcharges price for accounting purposes. Due to workflow, modified (aka user-set) price is preferred. """
-        if (x := self.price_surcharges_modified) is not None:
-            return x
-        return self.calc_price_surcharges()
+    @staticmethod
+    def prices_setup():
+        """ Returns setup (config file and Setup), which stored prices are calculated with. See update_stored_prices() """
+        return {
+            "vat_rate": Setup.singleton().vat_rate,
+            "transport_zones": bool(glo.setup.get("transport_zones", False)),
+            "rounding_precision": glo.setup.get("rounding_precision"),
+        }
+
+    @classmethod
+    def recalculate_prices(cls, queryset=None, chunk_size=500):
+        """ Recalculates stored prices of orders in <queryset> (all orders by default). Returns number of orders.
+            Prices are recalculated automatically when their inputs are saved through model (order, its surcharges and
+            deliveries, VAT rate in Setup, transport zones). Call this after changing them other way (bulk queries...)
+            Recalculation of all orders records the setup it was done with (see update_stored_prices)
+        """
+        all_orders = queryset is None
+        queryset = (cls.select() if all_orders else queryset).order_by(cls.id)
+        ret = 0
+        days = set()
+        with db.atomic():
+            while orders := prefetch(queryset.paginate(ret // chunk_size + 1, chunk_size), OrderSurcharge, Delivery, TransportZone):
+                for x in orders:
+                    x.update_prices()
+                    days.add(_DailyRollup.day_of(x.t))
+                cls.bulk_update(orders, fields=cls.PRICE_FIELDS)
+                ret += len(orders)
+                if len(orders) < chunk_size:
+                    break
+            for day in sorted(days):
+                DailyRevenue.update_day(day)
+            if all_orders:
+                StateValue.set(StateValue.PRICES_SETUP, cls.prices_setup())
+        return ret
+
+    @classmethod
+    def sum_prices(cls, queryset):
+        """ Returns hashtable with sums of stored prices (see PRICE_FIELDS) of orders in <queryset>, calculated by DB """
+        query = queryset.select(*[fn.COALESCE(fn.SUM(cls._meta.fields[x]), 0).alias(x) for x in cls.PRICE_FIELDS]).order_by()
+        return query.dicts().get()
 
     @property
     def price_concrete_correction(self):
@@ -1233,6 +1861,7 @@ class Order(HiddeableModel, AuditedModel):
     def calc_rounding(self):
         """ Returns amount of currency unit that has to be added to price_total with VAT applied, so
             the result is rounded to int.
+            Note: uses stored price_total, see update_prices
         """
         total_with_vat = with_vat(self.price_total)
         try:
@@ -1242,21 +1871,9 @@ class Order(HiddeableModel, AuditedModel):
         except TypeError:
             return 0
 
-    @property
-    def price_grand_total(self):
-        """ Returns price with vat, rounded - that means amount "to be paid" """
-        try:
-            return with_vat(self.price_total) + self.calc_rounding()
-        except TypeError:
-            return self.price_total
-
-    @property
-    def price_total(self):
-        """ total price of order, including concrete, transport and surcharges. If something is missing, returns None """
-        return sum([self.price_concrete or 0, self.price_transport or 0, self.price_surcharges or 0])
-
-    def as_endpoint(self):
-        data = super().as_endpoint()
+    def as_endpoint(self, setup=None):
+        """ <setup> is passed by bulk_as_endpoint, to load it just once for entire list """
+        data = self.as_json(setup)
         data["surcharges"] = [x.as_endpoint() for x in self.surcharges]
         data["status_name"] = self.get_status_name()
 
@@ -1271,11 +1888,24 @@ class Order(HiddeableModel, AuditedModel):
         try:
             delivery = self.deliveries[0]  # TODO: what about multiple deliveries?
             data["vehicle_id"] = delivery.car_registration_number
-            data["vehicle_record"] = delivery.car_record.id if delivery.car_record else None
+            data["vehicle_record"] = delivery.car_record_id
         except IndexError:
             pass
         return data
 
+    @classmethod
+    def bulk_load(cls, queryset):
+        """ Orders with surcharges, deliveries and modified transport zones loaded by a few queries for entire queryset,
+            instead of several queries per order
+        """
+        return prefetch(queryset, OrderSurcharge, Delivery, TransportZone)
+
+    @classmethod
+    def bulk_as_endpoint(cls, queryset):
+        """ Same result as as_endpoint() of every order, see bulk_load() """
+        setup = Setup.singleton()
+        return [x.as_endpoint(setup) for x in cls.bulk_load(queryset)]
+
     def get_status_name(self):
         return self.STATUS_NAMES[self.status]
 
@@ -1294,10 +1924,51 @@ class Order(HiddeableModel, AuditedModel):
     def t_human(self):
         return func.human_datetime(self.t)
 
+    def _select_rollup_values(self):
+        """ Returns hashtable with values of ROLLUP_FIELDS stored in DB, None if order is not there """
+        return Order.select(*[Order._meta.fields[x] for x in self.ROLLUP_FIELDS]).where(Order.id == self.id).dicts().first()
+
+    @staticmethod
+    def _move_in_rollups(old, new):
+        """ Moves order from <old> to <new> values of ROLLUP_FIELDS in daily rollups (None if order did not / does not exist) """
+        DailyVolume.move_order(old, new)
+        DailyRevenue.move_order(old, new)
+        # consumptions are added by dispatch.update_material_consumption(), they depend on order just by its day
+        if old is not None and new is not None:
+            days = {_DailyRollup.day_of(old["t"]), _DailyRollup.day_of(new["t"])}
+            if len(days) > 1:
+                for day in days:
+                    DailyConsumption.update_day(day)
+
     def save(self, force_insert=False, only=None):
         if float(self.volume) <= 0:
             raise ValueError("Order.volume must be a positive number")
-        return super().save(force_insert, only)
+        if self.id is None or force_insert or any(x.name in self.PRICE_INPUT_FIELDS for x in self.dirty_fields):
+            self.update_prices()
+            if only is not None:
+                only = list(only) + [x for x in self.PRICE_FIELDS if x not in only]
+        inserting = self.id is None or force_insert
+        with db.atomic():
+            old = None
+            if not inserting and any(x.name in self.ROLLUP_FIELDS for x in self.dirty_fields):
+                old = self._select_rollup_values()
+            ret = super().save(force_insert, only)
+            if inserting or old is not None:
+                new = {x: self._meta.fields[x].db_value(getattr(self, x)) for x in self.ROLLUP_FIELDS}
+                if old is not None and only is not None:
+                    saved = {x if isinstance(x, str) else x.name for x in only}
+                    new.update({k: v for k, v in old.items() if k not in saved})
+                self._move_in_rollups(old, new)
+        return ret
+
+    @db.atomic()
+    def delete_instance(self, *args, **kwargs):
+        old = self._select_rollup_values()
+        ret = super().delete_instance(*args, **kwargs)
+        if old is not None:
+            self._move_in_rollups(old, None)
+            DailyConsumption.update_day(_DailyRollup.day_of(old["t"]))  # order materials are deleted with the order
+        return ret
 
     def change_status(self, new_status):
         # TODO QUE review this constraints
@@ -1328,15 +1999,20 @@ class Order(HiddeableModel, AuditedModel):
         """
         OrderSurcharge.delete().where(OrderSurcharge.order == self).execute()
         nonempty_surcharges = [x for x in data if x.get("name")]
-        for surcharge in nonempty_surcharges:
-            OrderSurcharge.create(
-                order=self,
-                name=surcharge["name"],
-                price=float(surcharge["price"]),
-                price_type=int(surcharge["price_type"]),
-                unit_name=surcharge["unit_name"],
-                amount=int(surcharge.get("amount", 1))
-            )
+        rows = [
+            {
+                "order": self,
+                "name": surcharge["name"],
+                "price": float(surcharge["price"]),
+                "price_type": int(surcharge["price_type"]),
+                "unit_name": surcharge["unit_name"],
+                "amount": int(surcharge.get("amount", 1)),
+            }
+            for surcharge in nonempty_surcharges
+        ]
+        if rows:
+            OrderSurcharge.insert_many(rows).execute()
+        self.save_prices()  # bulk queries above do not do it, prices are recalculated just once for all surcharges
 
 
 class Delivery(BaseModel):
@@ -1373,6 +2049,22 @@ class Delivery(BaseModel):
 
     order = ForeignKeyField(Order, backref="deliveries", on_delete="CASCADE")
 
+    # Fields of the delivery stored prices of order are calculated from (see Order.calc_price_transport)
+    PRICE_INPUT_FIELDS = ["order", "distance_driven", "car_price_per_km"]
+
+    def save(self, force_insert=False, only=None):
+        """ Transport price of order depends on delivery, so stored prices of order must be updated when it changes """
+        recalculate = self.id is None or force_insert or any(x.name in self.PRICE_INPUT_FIELDS for x in self.dirty_fields)
+        ret = super().save(force_insert, only)
+        if recalculate:
+            self.order.save_prices()
+        return ret
+
+    def delete_instance(self, *args, **kwargs):
+        ret = super().delete_instance(*args, **kwargs)
+        self.order.save_prices()
+        return ret
+
     @property
     def construction_site_arrival_human(self):
         return func.human_datetime(self.construction_site_arrival_t)
@@ -1676,6 +2368,22 @@ class OrderSurcharge(BaseModel):
             (('name', 'order'), True),
         )
 
+    # Fields of the surcharge stored prices of order are calculated from (see price_total)
+    PRICE_INPUT_FIELDS = ["order", "price", "price_type", "amount"]
+
+    def save(self, force_insert=False, only=None):
+        """ Stored prices of order include surcharges, so they must be updated when surcharge changes """
+        recalculate = self.id is None or force_insert or any(x.name in self.PRICE_INPUT_FIELDS for x in self.dirty_fields)
+        ret = super().save(force_insert, only)
+        if recalculate:
+            self.order.save_prices()
+        return ret
+
+    def delete_instance(self, *args, **kwargs):
+        ret = super().delete_instance(*args, **kwargs)
+        self.order.save_prices()
+        return ret
+
     @property
     def price_total(self):
         if self.price_type == SURCHARGE_PRICE_FIXED:
@@ -1694,7 +2402,7 @@ class OrderSurcharge(BaseModel):
             raise NotImplementedError(f"OrderSurcharge: can't figure out total_price due to unknown price type '{self.price_type}'")
 
 
-class Setup(BaseModel):
+class Setup(_CachedModel):
     """Setup values editable by user"""
 
     company_name = StrippedTextField()
@@ -1739,15 +2447,30 @@ class Setup(BaseModel):
         """
         return 2 if self.count_distance_doubled else 1
 
+    def save(self, force_insert=False, only=None):
+        """ Stored prices of orders include VAT (see Order.update_prices), so they are recalculated when VAT rate changes """
+        old_vat_rate = None if self.id is None else Setup.select(Setup.vat_rate).where(Setup.id == self.id).scalar()
+        with db.atomic():
+            ret = super().save(force_insert, only)
+            if Setup.vat_rate.db_value(self.vat_rate) != old_vat_rate:
+                Order.recalculate_prices()
+        return ret
+
     @staticmethod
     def singleton():
         """Setup is the model with single row. So there is a method to access this row
-        or to create a new one if no rows exists
+        or to create a new one if no rows exists.
+        Setup is read for nearly every record serialized or printed, but written rarely, so the record is cached
+        (see _CachedModel). Do not modify returned record without saving it.
         """
+        return __class__.cached()
+
+    @classmethod
+    def _build_cache(cls):
         try:
-            return __class__.select()[0]
+            return cls.select()[0]
         except IndexError:
-            return __class__()
+            return cls()
 
 
 class User(BaseModel):
@@ -1851,7 +2574,7 @@ class BatchMaterial(BaseModel):
     """
 
     batch = ForeignKeyField(Batch, backref="materials", on_delete="CASCADE")
-    material = ForeignKeyField(OrderMaterial, backref="consumptions", on_delete="CASCADE")
+    material = ForeignKeyField(OrderMaterial, backref="consumptions", on_delete="CASCADE", index=True)  # consumption reports join by this
 
     amount_recipe = StrictDoubleField(null=True)  # how many units was set in recipe (and required by Dispatch)
     amount_rq = StrictDoubleField(null=True)  # how much was required by Manager
@@ -1871,6 +2594,257 @@ class BatchMaterial(BaseModel):
     humidity_e1 = StrictDoubleField(null=True)
 
 
+class Counter(BaseModel):
+    """Named auto numbering counters (order number, invoice number...).
+    Counters used to live in state file (settings.STATE_FILE), which was not atomic with DB changes.
+    Now the number is allocated in the same transaction as the record using it.
+    """
+    ORDER = "order_num_counter"
+    INVOICE = "invoice_num_counter"
+    PUMP_ORDER = "pumporder_num_counter"
+
+    NAMES = [ORDER, INVOICE, PUMP_ORDER]
+
+    name = TextField(unique=True)
+    value = StrictIntegerField(default=0)
+
+    @classmethod
+    @db.atomic()
+    def next(cls, name):
+        """Increments counter <name> and returns its new value. Counter is created (starting at 1) if it does not exist.
+        Call it inside the transaction which uses the number, so concurrent writers never get the same value.
+        """
+        if not cls.update(value=cls.value + 1).where(cls.name == name).execute():
+            cls.create(name=name, value=1)
+        return cls.get(cls.name == name).value
+
+    @classmethod
+    def import_state(cls, fn):
+        """One-time migration: seeds counters from JSON state file <fn>"""
+        state = func.state_load(fn)
+        for name in cls.NAMES:
+            if name in state:
+                logging.info(f"Counter {name} imported from {fn} with value {state[name]}")
+                cls.insert(name=name, value=int(state[name])).on_conflict_replace().execute()
+
+
+class StateValue(BaseModel):
+    """Named values of program state, which are not editable by user (e.g. setup, with which derived data were calculated).
+    Value is stored as JSON. Kept in DB (not in settings.STATE_FILE), so it is consistent with data it describes.
+    """
+    PRICES_SETUP = "prices_setup"  # see update_stored_prices()
+
+    name = TextField(unique=True)
+    value = TextField(null=True)
+
+    @classmethod
+    def get_value(cls, name, default=None):
+        """Returns value of <name>, or <default> if it is not set"""
+        value = cls.select(cls.value).where(cls.name == name).scalar()
+        return default if value is None else json.loads(value)
+
+    @classmethod
+    def set(cls, name, value):
+        """Sets (or with None value removes) value of <name>"""
+        if value is None:
+            cls.delete().where(cls.name == name).execute()
+        else:
+            cls.insert(name=name, value=json.dumps(value)).on_conflict_replace().execute()
+
+
+class _DailyRollup(BaseModel):
+    """ Aggregates of production per day, so reports over months or years read a few hundred rows instead of entire history.
+        Day is local date (settings.TIMEZONE) of Order.t, stored as integer YYYYMMDD.
+        Rollups are kept up to date in the same transaction as the data they are calculated from: Order.save() and
+        Order.delete_instance() add differences of the order (see add()), consumptions are added by dispatch.update_material_consumption().
+        After changing data other way (bulk queries, OrderMaterial edits...) call update_rollups() or rebuild_rollups()
+        ! Abstract model, see note in README.md
+    """
+    KEYS = []  # names of fields identifying row within a day, see unique_key()
+    MEASURES = []  # names of summable fields, see sum_by()
+
+    day = StrictIntegerField(index=True)
+
+    @staticmethod
+    def day_of(t):
+        return None if t is None else int(arrow.get(t).to(settings.TIMEZONE).format("YYYYMMDD"))
+
+    @staticmethod
+    def day_range(day):
+        """Returns tuple (start_t, end_t) of <day>, end_t is the start of next day"""
+        start = arrow.get(str(day), "YYYYMMDD", tzinfo=settings.TIMEZONE)
+        return start.timestamp(), start.shift(days=1).timestamp()
+
+    @classmethod
+    def _select_day(cls, day, start_t, end_t):
+        """Returns query calculating rows of <day> from raw data, columns in the order of non-id fields of the model"""
+        raise NotImplementedError
+
+    @classmethod
+    def update_day(cls, day):
+        """Recalculates rows of <day> from raw data"""
+        start_t, end_t = cls.day_range(day)
+        with db.atomic():
+            cls.delete().where(cls.day == day).execute()
+            cls.insert_from(cls._select_day(day, start_t, end_t), [x for x in cls._meta.sorted_fields if x is not cls._meta.primary_key]).execute()
+
+    @classmethod
+    def unique_key(cls):
+        """ Returns expressions of unique index on day and KEYS. NULLs are distinct in SQLite unique index, so nullable keys
+            are coalesced (StrippedTextField never stores empty string, enumerations are not negative)
+        """
+        fields = [cls._meta.fields[x] for x in cls.KEYS]
+        return [cls.day] + [fn.COALESCE(x, SQL("''" if isinstance(x, TextField) else "-1")) if x.null else x for x in fields]
+
+    @classmethod
+    def add(cls, rows):
+        """ Adds MEASURES of <rows> (hashtables with day, KEYS and MEASURES, which can be negative, empty ones count as zero)
+            to the rows of the same day and keys, missing rows are created. All rows are written by one multi-row upsert.
+            Rows left without orders are deleted (in rollups counting orders)
+        """
+        merged = {}
+        for row in rows:
+            measures = merged.setdefault((row["day"], *[row[x] for x in cls.KEYS]), dict.fromkeys(cls.MEASURES, 0))
+            for x in cls.MEASURES:
+                measures[x] += row.get(x) or 0
+        data = [{"day": k[0], **dict(zip(cls.KEYS, k[1:])), **v} for k, v in merged.items() if any(v.values())]
+        update = {getattr(cls, x): getattr(cls, x) + getattr(EXCLUDED, x) for x in cls.MEASURES}
+        with db.atomic():
+            # chunks keep number of SQL variables under SQLite limit (999 in older versions)
+            for chunk in chunked(data, 100):
+                cls.insert_many(chunk).on_conflict(conflict_target=cls.unique_key(), update=update).execute()
+            if "orders_count" in cls.MEASURES and any(x["orders_count"] < 0 for x in data):
+                cls.delete().where(cls.day.in_({x["day"] for x in data}) & (cls.orders_count <= 0)).execute()
+
+    @classmethod
+    def _order_row(cls, values):
+        """ Returns row (see add()) of single order, with <values> of Order.ROLLUP_FIELDS. Just for rollups of orders """
+        raise NotImplementedError
+
+    @classmethod
+    def move_order(cls, old, new):
+        """ Moves order from <old> to <new> values of Order.ROLLUP_FIELDS (None if order did not / does not exist) """
+        rows = []
+        if old is not None:
+            rows.append({k: -v if k in cls.MEASURES else v for k, v in cls._order_row(old).items()})
+        if new is not None:
+            rows.append(cls._order_row(new))
+        cls.add(rows)
+
+    @classmethod
+    def sum_by(cls, from_t, to_t, *fields):
+        """Returns query summing measures over days of date range (including days of both <from_t> and <to_t>), grouped by <fields>"""
+        measures = [fn.COALESCE(fn.SUM(getattr(cls, x)), 0).alias(x) for x in cls.MEASURES]
+        query = cls.select(*fields, *measures).where(cls.day.between(cls.day_of(from_t), cls.day_of(to_t)))
+        return query.group_by(*fields).order_by(*fields) if fields else query
+
+
+class DailyVolume(_DailyRollup):
+    """Ordered volume per day, recipe, customer and construction site (texts copied into Order, see Order)"""
+    KEYS = ["recipe", "customer", "construction_site"]
+    MEASURES = ["orders_count", "volume"]
+
+    recipe = StrippedTextField()
+    customer = StrippedTextField(null=True)
+    construction_site = StrippedTextField(null=True)
+    orders_count = StrictIntegerField()
+    volume = StrictDoubleField()
+
+    @classmethod
+    def _select_day(cls, day, start_t, end_t):
+        return Order.select(Value(day), Order.r_name, Order.customer, Order.construction_site, fn.COUNT(Order.id), fn.SUM(Order.volume)).\
+            where((Order.t >= start_t) & (Order.t < end_t)).\
+            group_by(Order.r_name, Order.customer, Order.construction_site)
+
+    @classmethod
+    def _order_row(cls, values):
+        return {
+            "day": cls.day_of(values["t"]), "recipe": values["r_name"], "customer": values["customer"],
+            "construction_site": values["construction_site"], "orders_count": 1, "volume": values["volume"],
+        }
+
+
+class DailyRevenue(_DailyRollup):
+    """Revenue (stored prices of orders, see Order.PRICE_FIELDS) per day and payment type"""
+    KEYS = ["payment_type"]
+    MEASURES = ["orders_count", "price_total", "price_grand_total"]
+
+    payment_type = StrictIntegerField(null=True)
+    orders_count = StrictIntegerField()
+    price_total = StrictDoubleField()
+    price_grand_total = StrictDoubleField()
+
+    @classmethod
+    def _select_day(cls, day, start_t, end_t):
+        return Order.select(
+            Value(day), Order.payment_type, fn.COUNT(Order.id),
+            fn.COALESCE(fn.SUM(Order.price_total), 0), fn.COALESCE(fn.SUM(Order.price_grand_total), 0),
+        ).\
+            where((Order.t >= start_t) & (Order.t < end_t)).\
+            group_by(Order.payment_type)
+
+    @classmethod
+    def _order_row(cls, values):
+        return {
+            "day": cls.day_of(values["t"]), "payment_type": values["payment_type"], "orders_count": 1,
+            "price_total": values["price_total"] or 0, "price_grand_total": values["price_grand_total"] or 0,
+        }
+
+
+class DailyConsumption(_DailyRollup):
+    """Material consumption per day and material name (as in OrderMaterial), the same as Material.get_consumptions() sums up"""
+    KEYS = ["material"]
+    MEASURES = ["amount_recipe", "amount_rq", "amount_e1"]
+
+    material = StrippedTextField()
+    amount_recipe = StrictDoubleField(default=0)
+    amount_rq = StrictDoubleField(default=0)
+    amount_e1 = StrictDoubleField(default=0)
+
+    @classmethod
+    def _select_day(cls, day, start_t, end_t):
+        return Material._select_consumptions(start_t, end_t - 1, Value(day))  # Order.t is integer, date range is inclusive
+
+
+ROLLUPS = [DailyVolume, DailyRevenue, DailyConsumption]
+for _rollup in ROLLUPS:
+    _rollup.add_index(_rollup.index(*_rollup.unique_key(), unique=True, name=f"{_rollup._meta.table_name}_key"))
+
+
+def update_stored_prices():
+    """ Recalculates stored prices of orders (and rollups, which sum them), if setup they depend on (see Order.prices_setup)
+        differs from the one they were calculated with, e.g. after "transport_zones" was changed in config file.
+        Also performs the first calculation after price columns or rollup tables were added by ensure_schema().
+        Call it after glo.setup is loaded.
+    """
+    stored = StateValue.get_value(StateValue.PRICES_SETUP)
+    if stored == Order.prices_setup():
+        return
+    logging.info(f"calculating stored prices of orders, setup changed from {stored} to {Order.prices_setup()}")
+    with db.atomic():
+        Order.recalculate_prices()
+        if stored is None:  # first calculation, rollup tables may be new as well
+            rebuild_rollups()
+
+
+def update_rollups(day):
+    """Recalculates all rollups of <day> from raw data"""
+    with db.atomic():
+        for rollup in ROLLUPS:
+            rollup.update_day(day)
+
+
+@db.atomic()
+def rebuild_rollups():
+    """Recalculates all rollups from raw data, day by day"""
+    days = {_DailyRollup.day_of(t) for (t,) in Order.select(Order.t).tuples()}
+    for rollup in ROLLUPS:
+        rollup.delete().execute()
+    for day in sorted(days):
+        update_rollups(day)
+    logging.info(f"Rollups rebuilt for {len(days)} days")
+
+
 # Hold table list for creation and deletion of tables (where proper order is necessary)
 TABLES = [
     Setup,
@@ -1894,6 +2868,7 @@ TABLES = [
     OrderMaterial,
     RecipeMaterial,
     StockMovement,
+    StockBalance,
     Material,
     RecipeProduction,
     Recipe,
@@ -1901,11 +2876,16 @@ TABLES = [
     LockedTable,
     User,
     TransportZone,
-    CompanySurcharge
+    CompanySurcharge,
+    Counter,
+    StateValue,
+    DailyVolume,
+    DailyRevenue,
+    DailyConsumption,
 ]
 
 
 # TODO: move this to web?
 def queryset_to_ux(queryset):
     """Converts peewee queryset to structure used in UX"""
-    return {"data": [x.as_endpoint() for x in queryset.objects()]}
+    return {"data": queryset.model.bulk_as_endpoint(queryset)}
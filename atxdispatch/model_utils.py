@@ -5,6 +5,7 @@ import time
 import peewee
 
 import atxdispatch.model as model
+import atxdispatch.search as search
 import atxdispatch.func as func
 
 
@@ -12,14 +13,19 @@ import atxdispatch.func as func
 def create_tables():
     model.db.drop_tables(model.TABLES)
     model.db.create_tables(model.TABLES)
+    search.ensure_search_indexes(rebuild=True)
+    model.invalidate_caches()
 
 
 @model.db.atomic()
 def clear_db():
-    """Clears all tables in DB"""
+    """Clears all tables in DB, except of counters - numbering of orders and invoices continues, so numbers are never reused"""
     for table in model.TABLES:
+        if table is model.Counter:
+            continue
         logging.debug("will delete data from %s" % table)
         table.delete().execute()
+    model.invalidate_caches()
 
 
 @model.db.atomic()
@@ -163,7 +169,6 @@ def clear_and_populate_db():
 
 
 
-@model.db.atomic()
 def bigdata(amount):
     """Populates DB with <amount> of test data in most tables"""
 
@@ -174,22 +179,24 @@ def bigdata(amount):
     # !! so do not dare to use it as a performance issue quickfix, especially in production !!!
     model.db.journal_mode = "off"
 
-    # It is very naive implementation just for DEV purposes:
-    # slow and sometimes can fail on "non unique" constraint (because names are generated randomly)
-    for i in range(amount):
-        try:
-            m = model.Material.create(type=random.choice(model.Material.ALLOWED_TYPES), name=f"Material {func.random_string()[:20]}", unit="kg")
-            r = model.Recipe.create(name=f"Recipe {func.random_string()[:20]}", recipe_class="c1", consistency_class="S4")
-            model.RecipeMaterial.create(material=m, recipe=r, amount=random.random() * 100, delay=random.choice([None, 0, 2, 3.3]))
-            model.Order.create(customer=f"For customer {func.random_string()[:20]}", volume=random.random() * 100, recipe=r, auto_number=1000 + i, r_name=r.name, r_recipe_class=r.recipe_class)
-            d = model.Driver.create(name=f"John Doe {func.random_string()[:20]}", contact="603 22 33 11", comment="Driver")
-            model.Car.create(registration_number=f"2AA {func.random_string()[:20]}", driver=d, comment="Car")
-            site = model.ConstructionSite.create(name=f"Stavba {func.random_string()[:30]}", city="Praha", distance=random.random() * 100)
-            customer = model.Customer.create(name=f"Zakaznik {func.random_string()[:30]}", comment="Foo")
-            model.Contract.create(name=f"Kontrakt {func.random_string()[:30]}", site=site, customer=customer)
-            print(f"Generated {i} of {amount} dummy data")
-        except peewee.IntegrityError:
-            print("integrity error!")
+    # Journal mode can not be changed within transaction (at least not out of WAL), so transaction starts only now
+    with model.db.atomic():
+        # It is very naive implementation just for DEV purposes:
+        # slow and sometimes can fail on "non unique" constraint (because names are generated randomly)
+        for i in range(amount):
+            try:
+                m = model.Material.create(type=random.choice(model.Material.ALLOWED_TYPES), name=f"Material {func.random_string()[:20]}", unit="kg")
+                r = model.Recipe.create(name=f"Recipe {func.random_string()[:20]}", recipe_class="c1", consistency_class="S4")
+                model.RecipeMaterial.create(material=m, recipe=r, amount=random.random() * 100, delay=random.choice([None, 0, 2, 3.3]))
+                model.Order.create(customer=f"For customer {func.random_string()[:20]}", volume=random.random() * 100, recipe=r, auto_number=1000 + i, r_name=r.name, r_recipe_class=r.recipe_class)
+                d = model.Driver.create(name=f"John Doe {func.random_string()[:20]}", contact="603 22 33 11", comment="Driver")
+                model.Car.create(registration_number=f"2AA {func.random_string()[:20]}", driver=d, comment="Car")
+                site = model.ConstructionSite.create(name=f"Stavba {func.random_string()[:30]}", city="Praha", distance=random.random() * 100)
+                customer = model.Customer.create(name=f"Zakaznik {func.random_string()[:30]}", comment="Foo")
+                model.Contract.create(name=f"Kontrakt {func.random_string()[:30]}", site=site, customer=customer)
+                print(f"Generated {i} of {amount} dummy data")
+            except peewee.IntegrityError:
+                print("integrity error!")
 
     model.db.journal_mode = old_journal_mode
 
@@ -0,0 +1,167 @@
+""" Opt-in profiling of web requests, with diagnostics page showing the slow ones
+
+    Switched on by "profiling": true in config file (see settings.CONFIG_FILE). For every request, wall time,
+    count of SQL queries and time spent in SQL (see model.QueryCounter) is recorded. Last settings.PROFILING_WINDOW
+    requests are kept in memory, diagnostics page (/diagnostics, superuser only) shows statistics per endpoint
+    and settings.PROFILING_TOP_N slowest requests.
+
+    With "profiling_cprofile": true every request also runs under cProfile (which makes it noticeably slower),
+    and stats of requests slower than settings.PROFILING_SLOW_SEC are dumped into settings.PROFILING_DUMP_PATH.
+    Dumps can be downloaded from diagnostics page and examined e.g. by snakeviz or python -m pstats.
+    Only one request is profiled at a time (cProfile can not run in more threads at once in newer Pythons),
+    concurrent requests are just timed.
+
+    Hooks are registered by init_app(app), to be called by web.py when the Flask app is created.
+"""
+import collections
+import cProfile
+import datetime
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+
+import flask
+
+from . import func
+from . import glo
+from . import model
+from . import settings
+from .decorators import superuser_required
+
+_PROFILE_FN_RE = re.compile(r"^\d{8}-\d{6}-\d{6}_[\w.-]+\.prof$")
+
+# One profiled request, last settings.PROFILING_WINDOW of them are kept in _requests
+ProfiledRequest = collections.namedtuple("ProfiledRequest", "t endpoint method path status wall_time sql_count sql_time profile_fn")
+_requests = collections.deque(maxlen=settings.PROFILING_WINDOW)
+_requests_lock = threading.Lock()
+
+# Held by the request running under cProfile
+_profiler_lock = threading.Lock()
+
+blueprint = flask.Blueprint("diagnostics", __name__)
+
+
+def is_enabled():
+    return bool(glo.setup.get("profiling", False))
+
+
+def _before_request():
+    if not is_enabled() or flask.request.endpoint == "static":
+        return
+    g = flask.g
+    g.profiling_query_counter = model.QueryCounter().__enter__()
+    g.profiling_profiler = None
+    if glo.setup.get("profiling_cprofile", False) and _profiler_lock.acquire(blocking=False):
+        g.profiling_profiler = cProfile.Profile()
+        g.profiling_profiler.enable()
+    g.profiling_t = time.perf_counter()
+
+
+def _after_request(response):
+    if "profiling_t" in flask.g:
+        flask.g.profiling_status = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    g = flask.g
+    if "profiling_t" not in g:
+        return
+    wall_time = time.perf_counter() - g.profiling_t
+    query_counter = g.profiling_query_counter
+    query_counter.__exit__(None, None, None)
+    profile_fn = None
+    if g.profiling_profiler:
+        g.profiling_profiler.disable()
+        _profiler_lock.release()
+        if wall_time > settings.PROFILING_SLOW_SEC:
+            profile_fn = _dump_profile(g.profiling_profiler, flask.request.endpoint)
+
+    request = ProfiledRequest(
+        t=time.time(),
+        endpoint=flask.request.endpoint or "-",
+        method=flask.request.method,
+        path=flask.request.full_path.rstrip("?"),
+        status=g.get("profiling_status", 500 if exc else None),
+        wall_time=wall_time,
+        sql_count=query_counter.count,
+        sql_time=query_counter.time,
+        profile_fn=profile_fn,
+    )
+    with _requests_lock:
+        _requests.append(request)
+    if wall_time > settings.PROFILING_SLOW_SEC:
+        logging.warning(f"Slow request {request.method} {request.path}: {wall_time:.2f} sec, {request.sql_count} SQL queries in {request.sql_time:.2f} sec")
+
+
+def _dump_profile(profiler, endpoint):
+    """Writes stats of <profiler> into PROFILING_DUMP_PATH, rotates old dumps. Returns filename (without path)"""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    endpoint = re.sub(r"[^\w.-]", "_", endpoint or "-")
+    fn = f"{timestamp}_{endpoint}.prof"
+    try:
+        os.makedirs(settings.PROFILING_DUMP_PATH, exist_ok=True)
+        profiler.dump_stats(func.asterixed_path(settings.PROFILING_DUMP_PATH, fn))
+        dumps = sorted(x for x in os.listdir(settings.PROFILING_DUMP_PATH) if _PROFILE_FN_RE.match(x))
+        for old_fn in dumps[:-settings.PROFILING_DUMP_KEEP]:
+            os.remove(func.asterixed_path(settings.PROFILING_DUMP_PATH, old_fn))
+    except OSError:
+        logging.exception(f"Can not write profile {fn}")
+        return None
+    return fn
+
+
+def endpoint_stats(requests):
+    """Returns list of statistics per endpoint of <requests>, sorted by total time (i.e. what is worth optimizing)"""
+    stats = {}
+    for r in requests:
+        s = stats.setdefault(r.endpoint, {"endpoint": r.endpoint, "count": 0, "wall_time": 0, "max_wall_time": 0, "sql_count": 0, "sql_time": 0})
+        s["count"] += 1
+        s["wall_time"] += r.wall_time
+        s["max_wall_time"] = max(s["max_wall_time"], r.wall_time)
+        s["sql_count"] += r.sql_count
+        s["sql_time"] += r.sql_time
+    for s in stats.values():
+        s["avg_wall_time"] = s["wall_time"] / s["count"]
+        s["avg_sql_count"] = s["sql_count"] / s["count"]
+        s["avg_sql_time"] = s["sql_time"] / s["count"]
+    return sorted(stats.values(), key=lambda x: x["wall_time"], reverse=True)
+
+
+def report():
+    """Returns everything shown at diagnostics page"""
+    with _requests_lock:
+        requests = list(_requests)
+    return {
+        "enabled": is_enabled(),
+        "cprofile": bool(glo.setup.get("profiling_cprofile", False)),
+        "requests_count": len(requests),
+        "slow_sec": settings.PROFILING_SLOW_SEC,
+        "endpoints": endpoint_stats(requests),
+        "slowest": heapq.nlargest(settings.PROFILING_TOP_N, requests, key=lambda x: x.wall_time),
+    }
+
+
+@blueprint.route("/diagnostics")
+@superuser_required
+def diagnostics():
+    return flask.render_template("diagnostics.html", **report())
+
+
+@blueprint.route("/diagnostics/profiles/<fn>")
+@superuser_required
+def diagnostics_profile(fn):
+    if not _PROFILE_FN_RE.match(fn):
+        flask.abort(404)
+    return flask.send_from_directory(settings.PROFILING_DUMP_PATH, fn, as_attachment=True)
+
+
+def init_app(app):
+    """Registers request hooks and diagnostics page in Flask <app>. Hooks do nothing unless profiling is switched on"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.register_blueprint(blueprint)
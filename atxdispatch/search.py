@@ -0,0 +1,120 @@
+""" Full-text search over records picked by user in forms (customers, construction sites, contracts, cars, orders)
+
+    Every searchable table has SQLite FTS5 index (virtual table <table>_search), which does not hold copy of data
+    (external content table), just the index. Indexes are kept in sync by triggers, so it works for any way of writing
+    into the table (model save, bulk queries, import...).
+
+    Text is searched by prefixes of words, diacritics and case are ignored, e.g. "stav brn" finds "Stavby Brno, a.s."
+    Results are ranked by relevance (bm25).
+"""
+import logging
+import re
+
+from peewee import Case
+
+from . import model
+from . import settings
+
+# model name -> searched columns
+SEARCH_TABLES = {
+    "Customer": ["name", "address", "city", "company_idnum", "comment"],
+    "ConstructionSite": ["name", "address", "city", "comment"],
+    "Contract": ["name", "comment"],
+    "Car": ["registration_number"],
+    "Order": ["customer", "construction_site", "r_name", "comment"],
+}
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _index_name(model_class):
+    return f"{model_class._meta.table_name}_search"
+
+
+def _model(model_name):
+    if model_name not in SEARCH_TABLES:
+        raise KeyError(f"Model {model_name} does not support search")
+    return getattr(model, model_name)
+
+
+def _ensure_trigger(name, sql):
+    """Creates trigger <name> by <sql> (CREATE TRIGGER statement), existing trigger with another definition is replaced"""
+    row = model.db.execute_sql("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).fetchone()
+    if row and row[0] == sql:
+        return
+    if row:
+        logging.info(f"replacing trigger {name}")
+        model.db.execute_sql(f"DROP TRIGGER {name}")
+    model.db.execute_sql(sql)
+
+
+def ensure_search_indexes(rebuild=False):
+    """Creates search indexes and their triggers, if they do not exist (outdated triggers are replaced). New indexes (or all with <rebuild>)
+    are filled from tables
+    """
+    for model_name, columns in SEARCH_TABLES.items():
+        model_class = _model(model_name)
+        table = model_class._meta.table_name
+        index = _index_name(model_class)
+        cols = ", ".join(columns)
+        new_cols = ", ".join(f"new.{x}" for x in columns)
+        old_cols = ", ".join(f"old.{x}" for x in columns)
+        # peewee writes all columns on save, trigger updates index only when searched text really changed
+        changed = " OR ".join(f"old.{x} IS NOT new.{x}" for x in columns)
+
+        with model.db.atomic():
+            created = not model.db.table_exists(index)
+            model.db.execute_sql(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5({cols}, content='{table}', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+            _ensure_trigger(
+                f"{index}_ai",
+                f'CREATE TRIGGER {index}_ai AFTER INSERT ON "{table}" BEGIN '
+                f"INSERT INTO {index}(rowid, {cols}) VALUES (new.id, {new_cols}); END"
+            )
+            _ensure_trigger(
+                f"{index}_ad",
+                f'CREATE TRIGGER {index}_ad AFTER DELETE ON "{table}" BEGIN '
+                f"INSERT INTO {index}({index}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END"
+            )
+            _ensure_trigger(
+                f"{index}_au",
+                f'CREATE TRIGGER {index}_au AFTER UPDATE OF {cols} ON "{table}" WHEN {changed} BEGIN '
+                f"INSERT INTO {index}({index}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); "
+                f"INSERT INTO {index}(rowid, {cols}) VALUES (new.id, {new_cols}); END"
+            )
+            if created or rebuild:
+                logging.info(f"building search index {index}")
+                model.db.execute_sql(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+
+
+def match_expression(text):
+    """Converts text typed by user to FTS5 query: all words must match, as prefixes. Returns None if there is no word"""
+    words = _WORD_RE.findall(text or "")
+    return " ".join(f'"{x}"*' for x in words) or None
+
+
+def search_ids(model_name, text, limit=None, include_hidden=False):
+    """Returns list of ids of records of <model_name> matching <text>, the most relevant first"""
+    model_class = _model(model_name)
+    if (expression := match_expression(text)) is None:
+        return []
+    table = model_class._meta.table_name
+    index = _index_name(model_class)
+    hidden = "" if include_hidden else "AND NOT t.hidden"
+    cursor = model.db.execute_sql(
+        f'SELECT t.id FROM {index} JOIN "{table}" AS t ON t.id = {index}.rowid WHERE {index} MATCH ? {hidden} ORDER BY {index}.rank LIMIT ?',
+        (expression, limit or settings.SEARCH_LIMIT),
+    )
+    return [x for (x,) in cursor.fetchall()]
+
+
+def search(model_name, text, limit=None, include_hidden=False):
+    """Returns records of <model_name> matching <text> in structure used in UX (see model.queryset_to_ux), the most relevant first"""
+    model_class = _model(model_name)
+    ids = search_ids(model_name, text, limit, include_hidden)
+    if not ids:
+        return {"data": []}
+    ranks = Case(model_class.id, [(x, i) for i, x in enumerate(ids)])
+    return model.queryset_to_ux(model_class.select().where(model_class.id.in_(ids)).order_by(ranks))
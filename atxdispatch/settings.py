@@ -7,6 +7,16 @@ DEFAULT_LANGUAGE = "cs"
 # pause in seconds between checks for new data in input folder
 SLEEP_INTERVAL = 1
 
+# how to find out new files in input folder: "inotify" (Linux only), "polling" or "auto" (inotify if available)
+# with inotify, SLEEP_INTERVAL is just the upper limit of how long main loop waits for new files
+WATCHER = "auto"
+
+# When at least this many files wait in input folder (typically after outage), they are processed in "catch-up" mode:
+# parsed in CATCHUP_WORKERS threads and written to DB in transactions of (approx.) CATCHUP_TRANSACTION_SIZE files
+CATCHUP_THRESHOLD = 100
+CATCHUP_WORKERS = 4
+CATCHUP_TRANSACTION_SIZE = 200
+
 SERVER_PORT = 7781
 
 # communication with other modules
@@ -16,6 +26,16 @@ MATERIAL_INI_FILE = "/atx300/comm/material/material.ini"
 THERMOMETER_INI_FILE = "/atx300/conf/thermometer.ini"
 DB_BACKUP_PATH = "/atx300/history/dispatch/"
 
+# DB backup (see backup.py): backup is made every DB_BACKUP_INTERVAL seconds (None = never) and on exit (if DB_BACKUP_ON_EXIT)
+# only DB_BACKUP_KEEP newest backups are kept (None = keep all)
+DB_BACKUP_INTERVAL = None
+DB_BACKUP_KEEP = 30
+DB_BACKUP_ON_EXIT = True
+# exit waits until backup is finished, or at most DB_BACKUP_EXIT_TIMEOUT seconds, if set (unfinished backup is abandoned then)
+DB_BACKUP_EXIT_TIMEOUT = None
+# count of DB pages copied by one step of backup, progress is logged after every step
+DB_BACKUP_STEP_PAGES = 16384
+
 # Temperature date read from thermometer application is compared with current date
 # older records than this treshold (in seconds) are ignored - propably thermometer is not running correctly
 TEMPERATURE_AGE_THRESHOLD = 3600
@@ -31,6 +51,60 @@ LOG_FILE = "/atx300/log/dispatch.log"
 
 DEFAULT_DB_FILE = "/atx300/data/dispatch.sqlite3"
 
+# SQLite pragmas, applied to every DB connection (peewee keeps one connection per thread).
+# WAL journal lets web readers and the writer processing input folder work without blocking each other.
+# cache_size is negative = in KiB, mmap_size in bytes
+DB_PRAGMAS = {
+    "foreign_keys": 1,
+    "journal_mode": "wal",
+    "synchronous": "normal",  # safe in WAL mode, only last transactions may be lost on power failure
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "memory",
+}
+
+# How long (in seconds) a connection waits for lock held by other connection, before "database is locked" error
+DB_TIMEOUT = 10
+
+# Lock taken by BEGIN of transactions (db.atomic() and friends). IMMEDIATE takes write lock at start, waiting up to DB_TIMEOUT.
+# With deferred BEGIN (None) transaction, which reads and then writes after other connection committed, fails at once in WAL mode
+DB_TRANSACTION_MODE = "IMMEDIATE"
+
+# Maximum count of records returned by full-text search (see search.py)
+SEARCH_LIMIT = 20
+
+# Exports (see export.py): CSV delimiter (semicolon is what Excel with Czech locale expects)
+# and how many rows are written at once
+EXPORT_CSV_DELIMITER = ";"
+EXPORT_CHUNK_ROWS = 1000
+
+# Profiling of web requests (see profiling.py), switched on by "profiling": true in CONFIG_FILE.
+# Statistics are computed from PROFILING_WINDOW last requests, diagnostics page shows PROFILING_TOP_N slowest of them.
+# Requests slower than PROFILING_SLOW_SEC are logged, and with "profiling_cprofile": true their cProfile stats are
+# dumped into PROFILING_DUMP_PATH, where only PROFILING_DUMP_KEEP newest dumps are kept
+PROFILING_WINDOW = 1000
+PROFILING_TOP_N = 20
+PROFILING_SLOW_SEC = 1.0
+PROFILING_DUMP_PATH = "/atx300/log/profiles/"
+PROFILING_DUMP_KEEP = 50
+
+# Default buckets (upper limits in seconds) of histograms in metrics (see metrics.py)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Integrity check (see integrity.py) checks tables in INTEGRITY_CHECK_WORKERS threads,
+# report lists keys of up to INTEGRITY_CHECK_EXAMPLES invalid rows for every problem
+INTEGRITY_CHECK_WORKERS = 4
+INTEGRITY_CHECK_EXAMPLES = 10
+
+# material.ini is exported when no material was changed for MATERIAL_INI_DEBOUNCE seconds (so that many changes
+# in short time are written at once), but at latest MATERIAL_INI_MAX_DELAY seconds after the first change.
+# File is not rewritten at all if its content would be the same
+MATERIAL_INI_DEBOUNCE = 2
+MATERIAL_INI_MAX_DELAY = 10
+
+# Import of legacy atxd300 data (see importer.py) reads and writes records in chunks of IMPORT_CHUNK_SIZE
+IMPORT_CHUNK_SIZE = 500
+
 # File with configuration of modules. See manual.txt for details
 CONFIG_FILE = "/atx300/conf/dispatch.hjson"
 
@@ -0,0 +1,121 @@
+""" Watchers of input communication folder
+
+    Watcher tells the main loop which files appeared in the folder, and lets the loop sleep until
+    something new arrives. There are two backends:
+        InotifyWatcher  Linux only. Files are reported as soon as the writer closes them
+                        (or renames them into the folder), no periodic listdir is needed.
+        PollingWatcher  Fallback for everything else (Windows). Lists the folder every time it is asked.
+
+    Use get_watcher() to pick the backend according to settings.WATCHER
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from . import func
+from . import settings
+
+
+class PollingWatcher:
+    """Lists folder on every call of pending(), sleeps in wait(). This is how the main loop always worked."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def pending(self):
+        """Returns list of full filenames waiting in folder"""
+        return func.list_of_files(self.path)
+
+    def wait(self, timeout):
+        """Blocks for <timeout> seconds"""
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Uses Linux inotify (via libc, no extra dependency) to get notified about new files in folder.
+
+    Note: first call of pending() lists entire folder, to pick up files left there while dispatch was not running.
+    The same full listing is done when kernel event queue overflows.
+    """
+
+    # see <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    _EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self, path):
+        self.path = path
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {path}")
+        self._rescan = True  # list entire folder on next pending()
+        self._names = {}  # used as ordered set
+
+    def _read_events(self):
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            _wd, mask, _cookie, length = self._EVENT_HEADER.unpack_from(buf, offset)
+            offset += self._EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                logging.warning(f"inotify queue overflow on {self.path}, will rescan")
+                self._rescan = True
+            elif name:
+                self._names[os.fsdecode(name)] = None
+
+    def pending(self):
+        """Returns list of full filenames closed or moved into the folder since last call"""
+        self._read_events()
+        if self._rescan:
+            self._rescan = False
+            self._names = {}
+            return func.list_of_files(self.path)
+        ret = [f"{self.path}/{fn}" for fn in self._names]
+        self._names = {}
+        return [ffn for ffn in ret if os.path.isfile(ffn)]
+
+    def wait(self, timeout):
+        """Blocks until some event arrives or <timeout> seconds passes"""
+        select.select([self.fd], [], [], timeout)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_watcher(path):
+    """Returns watcher for <path>, backend is chosen according to settings.WATCHER ("auto", "inotify" or "polling")"""
+    backend = settings.WATCHER
+    if backend in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            ret = InotifyWatcher(path)
+            logging.info(f"watching {path} via inotify")
+            return ret
+        except (OSError, AttributeError):  # AttributeError: libc without inotify symbols
+            if backend == "inotify":
+                raise
+            logging.exception(f"inotify watcher for {path} failed, falling back to polling")
+    logging.info(f"watching {path} via polling every {settings.SLEEP_INTERVAL} sec")
+    return PollingWatcher(path)
@@ -0,0 +1,25 @@
+import pytest
+
+from atxdispatch import glo, model
+
+
+@pytest.fixture
+def db():
+    """Empty in-memory DB with all tables"""
+    model.mount_db(":memory:")
+    model.db.create_tables(model.TABLES)
+    glo.setup = {"rounding_precision": 2}
+    yield model.db
+    model.db.close()
+    model.invalidate_caches()
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    """Empty DB file with all tables, for tests where more threads (connections) access DB"""
+    model.mount_db(str(tmp_path / "db.sqlite3"))
+    model.db.create_tables(model.TABLES)
+    glo.setup = {"rounding_precision": 2}
+    yield model.db
+    model.db.close()
+    model.invalidate_caches()
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from atxdispatch import backup
+
+
+def _db(tmp_path):
+    fn = str(tmp_path / "db.sqlite3")
+    conn = sqlite3.connect(fn)
+    conn.execute("PRAGMA journal_mode=wal")
+    conn.execute("CREATE TABLE t (x)")
+    conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(100)])
+    conn.commit()
+    return fn, conn
+
+
+def test_backup_includes_wal(tmp_path):
+    fn, conn = _db(tmp_path)
+    backup_fn = backup.backup_db(fn, str(tmp_path / "backups"), keep=None)
+    conn.close()
+    assert sqlite3.connect(backup_fn).execute("SELECT COUNT(*) FROM t").fetchone() == (100,)
+
+
+def test_backups_in_same_second_do_not_overwrite(tmp_path):
+    fn, _ = _db(tmp_path)
+    backup_path = str(tmp_path / "backups")
+    fns = {backup.backup_db(fn, backup_path, keep=None) for _ in range(3)}
+    assert len(fns) == 3
+    assert sorted(os.listdir(backup_path)) == sorted(os.path.basename(x) for x in fns)
+
+
+def test_rotation(tmp_path):
+    backup_path = tmp_path / "backups"
+    backup_path.mkdir()
+    names = ["20240101-120000.sqlite3", "20240101-120000-000001.sqlite3", "20240102-120000-000000.sqlite3"]
+    for name in names + ["20240103-120000-000000.sqlite3_", "notes.txt"]:
+        (backup_path / name).write_text("")
+    backup.rotate_backups(str(backup_path), 2)
+    assert sorted(os.listdir(backup_path)) == sorted(names[1:] + ["notes.txt"])
+
+
+def test_thread_without_exit_backup(tmp_path, monkeypatch):
+    fn, _ = _db(tmp_path)
+    monkeypatch.setattr(backup.settings, "DB_BACKUP_PATH", str(tmp_path / "backups"))
+    thread = backup.BackupThread(fn, interval=None, on_exit=False)
+    thread.start()
+    thread.stop(timeout=10)
+    assert not thread.is_alive()
+    assert not os.path.exists(tmp_path / "backups")
+
+    thread = backup.BackupThread(fn, interval=None)
+    thread.start()
+    thread.stop(timeout=10)
+    assert len(os.listdir(tmp_path / "backups")) == 1
+
+
+def test_progress_logged(tmp_path, monkeypatch, caplog):
+    fn, conn = _db(tmp_path)
+    conn.executemany("INSERT INTO t VALUES (?)", [("x" * 1000,) for _ in range(20)])
+    conn.commit()
+    monkeypatch.setattr(backup.settings, "DB_BACKUP_STEP_PAGES", 2)
+    with caplog.at_level("INFO"):
+        backup_fn = backup.backup_db(fn, str(tmp_path / "backups"), keep=None)
+    progress = [x.message for x in caplog.records if "pages copied" in x.message]
+    assert len(progress) > 2
+    assert progress[-1].endswith(f"{sqlite3.connect(fn).execute('PRAGMA page_count').fetchone()[0]} pages copied")
+    assert sqlite3.connect(backup_fn).execute("SELECT COUNT(*) FROM t").fetchone() == (120,)
+
+
+@pytest.mark.parametrize("keep, expected", [(2, 2), (None, 4)])
+def test_default_keep(tmp_path, monkeypatch, keep, expected):
+    fn, _ = _db(tmp_path)
+    backup_path = str(tmp_path / "backups")
+    monkeypatch.setattr(backup.settings, "DB_BACKUP_KEEP", keep)
+    for _ in range(4):
+        backup.backup_db(fn, backup_path)
+    assert len(os.listdir(backup_path)) == expected
+
+
+def test_exit_waits_for_backup(tmp_path, monkeypatch):
+    fn, _ = _db(tmp_path)
+    monkeypatch.setattr(backup.settings, "DB_BACKUP_PATH", str(tmp_path / "backups"))
+    backup_db = backup.backup_db
+
+    def slow_backup_db(*args, **kwargs):
+        time.sleep(0.5)
+        return backup_db(*args, **kwargs)
+    monkeypatch.setattr(backup, "backup_db", slow_backup_db)
+    thread = backup.BackupThread(fn, interval=None)
+    thread.start()
+    thread.stop(backup.settings.DB_BACKUP_EXIT_TIMEOUT)
+    assert not thread.is_alive()
+    assert len(os.listdir(tmp_path / "backups")) == 1
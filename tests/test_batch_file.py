@@ -0,0 +1,78 @@
+from atxdispatch.batch_file import BatchFile, ENCODING
+
+BE2 = """\
+[Order]
+ID=12
+Volume=2.5
+
+[Recipe]
+ID=3
+Number=007
+Name=C 25/30
+Cement1_Name=CEM I
+Cement1_Weight=300
+Cement1_ID=41
+AdMixture1_Name=123
+AdMixture1_Weight=1.5
+AdMixture1_ID=42
+Fiber1_Name=PP
+Fiber1_Weight=0.9
+Fiber1_ID=43
+
+[Batch_Request]
+Sequence=2
+Total=2
+Date=01.01.2024
+Time=8:00:00
+Fiber1_Weight=0.9
+AdMixture1_Weight=1.6
+Cement1_Weight=301
+Cement1_Silo_Major=1
+Sand1_Weight=10
+
+[Batch_Evidence1]
+ProductionMode=1
+Cement1_Weight=299.5
+AdMixture1_Weight=1.4
+Fiber1_Weight=
+
+[Batch_Evidence2]
+Date=01.01.2024
+Time=8:01:00
+"""
+
+
+def _batch_file(tmp_path, content=BE2):
+    fn = tmp_path / "x.be2"
+    fn.write_text(content, encoding=ENCODING)
+    return BatchFile(str(fn))
+
+
+def test_values_are_strings_except_numbers(tmp_path):
+    bf = _batch_file(tmp_path)
+    assert bf.order["ID"] == 12
+    assert bf.order["Volume"] == "2.5"
+    assert bf.recipe["Number"] == "007"
+    assert bf.batch_request["Sequence"] == bf.batch_request["Total"] == 2
+    assert bf.batch_evidence1["ProductionMode"] == "1"
+    materials = {x["_k_orig"]: x for x in bf.recipe["materials"]}
+    assert materials["AdMixture1"] == {"_k_orig": "AdMixture1", "Name": "123", "Weight": 1.5, "ID": 42}
+    assert materials["Cement1"]["Weight"] == 300.0
+
+
+def test_any_material_name(tmp_path):
+    bf = _batch_file(tmp_path)
+    assert [x["_k_orig"] for x in bf.recipe["materials"]] == ["Cement1", "AdMixture1", "Fiber1"]
+    assert [x["_k_orig"] for x in bf.batch_request["materials"]] == ["Fiber1", "AdMixture1", "Cement1", "Sand1"]
+
+
+def test_paired_materials(tmp_path):
+    pairs = _batch_file(tmp_path).paired_materials()
+    assert [(m["ID"], rq["Weight"], ev1["Weight"]) for m, rq, ev1 in pairs] == [(41, 301.0, 299.5), (42, 1.6, 1.4), (43, 0.9, None)]
+
+
+def test_missing_section_and_material(tmp_path):
+    bf = _batch_file(tmp_path, BE2.replace("AdMixture1_Weight=1.4\n", ""))
+    assert bf.section("Nonexistent") == {"materials": []}
+    pairs = {m["ID"]: (rq, ev1) for m, rq, ev1 in bf.paired_materials()}
+    assert pairs[42][1] is None
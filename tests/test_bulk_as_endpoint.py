@@ -0,0 +1,50 @@
+import pytest
+
+from atxdispatch import glo, model
+
+
+def _orders(count):
+    model.Setup.singleton()
+    zone = model.TransportZone.create(name="Zone", distance_km_max=100, price_per_m3=10)
+    for i in range(count):
+        order = model.Order.create(r_name="C 25/30", r_price=100, volume=2 + i, auto_number=i + 1, transport_zone_modified=zone if i % 2 else None)
+        model.Delivery.create(order=order, car_registration_number=f"1A{i}", distance_driven=10)
+        model.OrderSurcharge.create(order=order, name="Winter", price=5, price_type=model.SURCHARGE_PRICE_PER_CUBIC_METER)
+
+
+def _query_count(query):
+    with model.QueryCounter() as qc:
+        ret = model.Order.bulk_as_endpoint(query)
+    return qc.count, ret
+
+
+@pytest.mark.parametrize("transport_zones", [False, True])
+def test_constant_query_count(db, transport_zones):
+    glo.setup["transport_zones"] = transport_zones
+    _orders(40)
+    query = model.Order.select().order_by(model.Order.id)
+    few_count, _ = _query_count(query.limit(4))
+    many_count, data = _query_count(query)
+    assert len(data) == 40
+    assert many_count == few_count
+    assert many_count <= 6
+
+
+def test_same_as_as_endpoint(db):
+    glo.setup["transport_zones"] = True
+    _orders(5)
+    query = model.Order.select().order_by(model.Order.id)
+    expected = [x.as_endpoint() for x in query]
+    _, data = _query_count(query)
+    assert data == expected
+    assert data[1]["price_transport_calculated"] == 10 * 3
+    assert [x["vehicle_id"] for x in data] == [f"1A{i}" for i in range(5)]
+
+
+def test_query_counter_nesting(db):
+    with model.QueryCounter() as outer:
+        model.Material.select().count()
+        with model.QueryCounter() as inner:
+            model.Material.select().count()
+    model.Material.select().count()
+    assert (outer.count, inner.count) == (2, 1)
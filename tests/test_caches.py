@@ -0,0 +1,166 @@
+import itertools
+import threading
+
+import pytest
+from peewee import IntegrityError
+
+from atxdispatch import glo, model
+
+
+def test_setup_cache_invalidated_by_save(db):
+    setup = model.Setup.singleton()
+    setup.company_name = "Beton"
+    setup.vat_rate = 21
+    setup.save()
+    assert model.Setup.singleton().vat_rate == 21
+    model.Setup.singleton().update_from_json({"vat_rate": 15})
+    assert model.Setup.singleton().vat_rate == 15
+
+
+@pytest.mark.parametrize("data, exc", [({"vat_rate": 10, "nonexistent": 1}, KeyError), ({"vat_rate": 10, "company_name": None}, IntegrityError)])
+def test_setup_failed_update_is_not_cached(db, data, exc):
+    model.Setup.create(company_name="Beton", vat_rate=21)
+    model.Setup.invalidate_cache()
+    with pytest.raises(exc):
+        model.Setup.singleton().update_from_json(data)
+    assert model.Setup.singleton().vat_rate == 21
+
+
+def test_as_json_does_not_modify_shared_record(db):
+    order = model.Order.create(r_name="C 25/30", volume=1, auto_number=1)
+    data = order.as_json()
+    assert "t_human" in data
+    assert "t_human" not in order.__data__
+
+
+def test_zone_endpoint_after_transport_type_rename(db):
+    glo.setup["rounding_precision"] = 0
+    transport_type = model.TransportType.create(name="Mix")
+    model.TransportZone.create(distance_km_max=100, price_per_m3=10, transport_type=transport_type)
+    zone = model.TransportZone.best_zone(50)
+    assert zone.as_endpoint()["_transport_type_name"] == "Mix"
+    assert "_price_str" not in zone.__data__
+    transport_type.name = "Dumper"
+    transport_type.save()
+    assert model.TransportZone.best_zone(50).as_endpoint()["_transport_type_name"] == "Dumper"
+
+
+def _naive_get_zones(zones, distance, transport_type_id):
+    """get_zones() as it used to be done by SQL queries"""
+    distance = int(distance)
+    matching = []
+    for min_inclusive, max_inclusive in itertools.product([False, True], repeat=2):
+        for z in zones:
+            if (z.distance_min_inclusive, z.distance_max_inclusive) != (min_inclusive, max_inclusive):
+                continue
+            lo_ok = z.distance_km_min <= distance if min_inclusive else z.distance_km_min < distance
+            hi_ok = distance <= z.distance_km_max if max_inclusive else distance < z.distance_km_max
+            if lo_ok and hi_ok:
+                matching.append(z)
+    ret = [z for z in matching if transport_type_id and z.transport_type_id == transport_type_id]
+    for z in matching + zones:
+        if z not in ret:
+            ret.append(z)
+    return [z.id for z in ret]
+
+
+def test_get_zones(db):
+    types = [model.TransportType.create(name=f"T{i}") for i in range(2)]
+    car = model.Car.create(registration_number="1A1", transport_type=types[1])
+    for i, (lo, hi) in enumerate([(0, 10), (10, 20), (5, 15), (20, 20), (0, 100), (30, 40)]):
+        model.TransportZone.create(
+            distance_km_min=lo, distance_km_max=hi, distance_min_inclusive=i % 2 == 0, distance_max_inclusive=i % 3 == 0,
+            price_per_m3=i, transport_type=types[i % 2],
+        )
+    zones = list(model.TransportZone.select().order_by(model.TransportZone.id))
+    for distance in [-1, 0, 0.5, 5, 9.9, 10, 15, 20, 20.7, 35, 100, 1000]:
+        assert [z.id for z in model.TransportZone.get_zones(distance)] == _naive_get_zones(zones, distance, None)
+        assert [z.id for z in model.TransportZone.get_zones(distance, car.id)] == _naive_get_zones(zones, distance, types[1].id)
+        assert model.TransportZone.best_zone(distance).id == _naive_get_zones(zones, distance, None)[0]
+
+
+def test_zone_cache_not_stored_when_changed_while_building(db, monkeypatch):
+    model.TransportZone.create(distance_km_max=10, price_per_m3=1)
+    build_cache = model.TransportZone._build_cache
+
+    def build_cache_and_write():
+        ret = build_cache()
+        model.TransportZone.create(distance_km_max=20, price_per_m3=2)  # write while cache is being built
+        return ret
+
+    monkeypatch.setattr(model.TransportZone, "_build_cache", build_cache_and_write)
+    assert len(model.TransportZone.cached().zones) == 1
+    monkeypatch.undo()
+    assert len(model.TransportZone.cached().zones) == 2
+
+
+def _in_thread(func):
+    """Returns result of <func>() called in another thread, i.e. by another DB connection"""
+    ret = []
+
+    def run():
+        try:
+            ret.append(func())
+        finally:
+            model.db.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return ret[0]
+
+
+def test_setup_cache_built_before_commit_is_invalidated(file_db):
+    model.Setup.create(company_name="Beton", vat_rate=21)
+    with model.db.atomic():
+        setup = model.Setup.singleton()
+        setup.vat_rate = 10
+        setup.save()
+        # another thread sees the last committed data and caches them
+        assert _in_thread(lambda: model.Setup.singleton().vat_rate) == 21
+    assert model.Setup.singleton().vat_rate == 10
+    assert _in_thread(lambda: model.Setup.singleton().vat_rate) == 10
+
+
+def test_setup_cache_invalidated_by_rollback(db):
+    model.Setup.create(company_name="Beton", vat_rate=21)
+    with pytest.raises(ZeroDivisionError):
+        with model.db.atomic():
+            model.Setup.singleton().update_from_json({"vat_rate": 10})
+            assert model.Setup.singleton().vat_rate == 10
+            1 / 0
+    assert model.Setup.singleton().vat_rate == 21
+
+
+def test_zone_index_built_before_commit_is_invalidated(file_db):
+    glo.setup["transport_zones"] = True
+    zone = model.TransportZone.create(distance_km_max=100, price_per_m3=10)
+    order = model.Order.create(r_name="C 25/30", volume=2, auto_number=1)
+    model.Delivery.create(order=order, distance_driven=10)
+    with model.db.atomic():
+        zone.price_per_m3 = 20
+        zone.save()
+        assert model.Order.get_by_id(order.id).price_transport == 40  # recalculated with uncommitted zone
+        assert _in_thread(lambda: model.TransportZone.best_zone(10).price_per_m3) == 10
+    assert model.TransportZone.best_zone(10).price_per_m3 == 20
+    assert _in_thread(lambda: model.TransportZone.best_zone(10).price_per_m3) == 20
+
+
+def test_price_cache_built_before_commit_is_invalidated(file_db):
+    recipe = model.Recipe.create(name="C 25/30", price=2000)
+    customer = model.Customer.create(name="Metrostav")
+    price = model.Price.create(customer=customer, recipe=recipe, type=model.Price.PRICE_TYPE_ABSOLUTE, amount=1800)
+
+    def best_prices():
+        return [x for x, _ in model.Price.get_best_prices([(recipe, customer, None)])]
+
+    with model.db.atomic():
+        price.amount = 1700
+        price.save()
+        assert best_prices() == [1700]
+        assert _in_thread(best_prices) == [1800]
+    assert _in_thread(best_prices) == best_prices() == [1700]
+
+    with model.db.atomic():
+        customer.delete_instance()  # its prices are deleted by DB
+        assert _in_thread(best_prices) == [1700]
+    assert _in_thread(lambda: model.Price.cached()) == model.Price.cached() == {}
@@ -0,0 +1,48 @@
+import json
+import threading
+
+from atxdispatch import model, model_utils
+
+
+def test_next(db):
+    assert [model.Counter.next(model.Counter.ORDER) for _ in range(3)] == [1, 2, 3]
+    assert model.Counter.next(model.Counter.INVOICE) == 1
+
+
+def test_import_state(db, tmp_path):
+    fn = tmp_path / "state.json"
+    fn.write_text(json.dumps({model.Counter.ORDER: 41, "something_else": 1}))
+    model.Counter.import_state(str(fn))
+    assert model.Counter.next(model.Counter.ORDER) == 42
+    assert model.Counter.next(model.Counter.PUMP_ORDER) == 1
+
+
+def test_clear_db_keeps_counters(db):
+    model.Counter.next(model.Counter.INVOICE)
+    model.Material.create(type="Cement", name="CEM I")
+    model_utils.clear_db()
+    assert model.Material.select().count() == 0
+    assert model.Counter.next(model.Counter.INVOICE) == 2
+
+
+def test_concurrent_read_then_write_transactions(file_db):
+    """Transactions, which read before writing, do not fail when other connection commits meanwhile (WAL snapshot)"""
+    errors = []
+
+    def allocate():
+        try:
+            for _ in range(20):
+                with model.db.atomic():
+                    model.Order.select().count()
+                    model.Counter.next(model.Counter.ORDER)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            model.db.close()
+    threads = [threading.Thread(target=allocate) for _ in range(6)]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+    assert errors == []
+    assert model.Counter.next(model.Counter.ORDER) == 6 * 20 + 1
@@ -0,0 +1,77 @@
+import csv
+import io
+import zipfile
+from xml.etree import ElementTree
+
+import pytest
+
+from atxdispatch import export, model, settings
+
+T0 = 1700000000
+NS = {"x": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+
+
+@pytest.fixture
+def orders(db):
+    model.Order.create(r_name="C 25/30", volume=2, auto_number=1, t=T0, customer='=HYPERLINK("http://evil")', comment="Call\x07 before")
+    model.Order.create(r_name="C 30/37", volume=3.5, auto_number=2, t=T0 + 60, customer="Metrostav", construction_site="-Sklad", comment=None)
+    model.Order.create(r_name="C 30/37", volume=1, auto_number=3, t=T0 + 2 * 86400, customer="Out of range")
+
+
+def _export(fmt):
+    return b"".join(export.iter_export("orders", fmt, T0, T0 + 86400))
+
+
+def _csv_rows():
+    text = _export("csv").decode("utf-8-sig")
+    return list(csv.reader(io.StringIO(text), delimiter=settings.EXPORT_CSV_DELIMITER))
+
+
+def _xlsx_rows():
+    with zipfile.ZipFile(io.BytesIO(_export("xlsx"))) as zf:
+        assert zf.testzip() is None
+        sheet = ElementTree.fromstring(zf.read("xl/worksheets/sheet1.xml"))
+    ret = []
+    for row in sheet.iterfind(".//x:row", NS):
+        cells = []
+        for c in row.iterfind("x:c", NS):
+            if (t := c.find("x:is/x:t", NS)) is not None:
+                cells.append(t.text or "")
+            elif (v := c.find("x:v", NS)) is not None:
+                cells.append(float(v.text))
+            else:
+                cells.append(None)
+        ret.append(cells)
+    return ret
+
+
+def _column(rows, name):
+    i = rows[0].index(name)
+    return [x[i] for x in rows[1:]]
+
+
+def test_csv_round_trip(orders):
+    rows = _csv_rows()
+    assert rows[0][:4] == ["id", "number", "invoice_number", "time"]
+    assert _column(rows, "number") == ["1", "2"]
+    assert _column(rows, "volume") == ["2.0", "3.5"]
+    # formulas are not evaluated by spreadsheet, text stays readable
+    assert _column(rows, "customer") == ['\'=HYPERLINK("http://evil")', "Metrostav"]
+    assert _column(rows, "construction_site") == ["", "'-Sklad"]
+    assert _column(rows, "comment") == ["Call\x07 before", ""]
+
+
+def test_xlsx_round_trip(orders):
+    rows = _xlsx_rows()
+    assert rows[0] == _csv_rows()[0]
+    assert _column(rows, "number") == [1, 2]
+    assert _column(rows, "volume") == [2, 3.5]
+    assert _column(rows, "customer") == ['=HYPERLINK("http://evil")', "Metrostav"]  # inline string, never a formula
+    assert _column(rows, "comment") == ["Call before", None]
+
+
+def test_many_rows(db, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_CHUNK_ROWS", 3)
+    model.Order.insert_many([{"r_name": "C 25/30", "volume": 1, "auto_number": i, "t": T0 + i} for i in range(10)]).execute()
+    assert _column(_csv_rows(), "number") == [str(i) for i in range(10)]
+    assert _column(_xlsx_rows(), "number") == list(range(10))
@@ -0,0 +1,73 @@
+import dbf
+import pytest
+
+from atxdispatch import importer, model
+
+
+class _Record(dict):
+    """DBF record stand-in, missing field raises the same error as dbf"""
+
+    def __missing__(self, key):
+        raise dbf.FieldMissingError(key)
+
+
+def _recipe(id_rec, name, **materials):
+    fields = ["TRIDA", "POZNAMKA", "KONZISTENC", "MAX_MNOZST", "DOBA_VYSYP", "DOBA_SKORO", "DOBA_POOTE", "DOBA_POOT2", "DOBA_OTEVR",
+              "DOBA_MICHA", "ZPRACOVAT", "CENA", "ACCAWR_1", "POMER_1", "OBSAH_CL"]
+    return _Record({**{x: None for x in fields}, "ID_REC": id_rec, "NAZEV": name, "CISLO": 0, **materials})
+
+
+def _site(name, distance):
+    return _Record(NAZEV=name, ULICE="", MESTO="Brno", PSC="", TEL="", VZDALENOST=distance)
+
+
+@pytest.fixture
+def imp(db):
+    progress = importer._Progress("test")
+    cement = model.Material.create(id=1, type="Cement", name="CEM I")
+    addition = model.Material.create(id=2, type="Addition", name="Popílek")
+    imp = importer._Atxd300Import("/nonexistent")
+    yield imp, progress, cement, addition
+
+
+def test_material_type_checked_as_in_save(imp, monkeypatch):
+    imp, progress, *_ = imp
+    monkeypatch.setitem(importer.ATXD300_MATERIAL_TYPES, 7, "Bogus")
+    records = [_Record(ID_MAT=10 + i, NAZEV=f"Material {i}", NAZEV_RIZE=f"M{i}", TYP=typ, MNOZ_JEDNO="kg") for i, typ in enumerate([1, 7])]
+    imp.import_materials(records, progress)
+    assert (progress.imported, progress.invalid) == (1, 1)
+    assert [x.name for x in model.Material.select().where(model.Material.id >= 10)] == ["M0"]
+
+
+def test_k_value_checked_as_in_save(imp):
+    imp, progress, *_ = imp
+    records = [
+        _recipe(1, "C 25/30", ID_CEM_1=1, MNOZ_CEM_1=300, ACCAWR_CEM_1=0.4),
+        _recipe(2, "C 30/37", ID_CEM_1=1, MNOZ_CEM_1=320, ID_POJ_1=2, MNOZ_POJ_1=30, ACCAWR_POJ_1=0.4),
+    ]
+    imp.import_recipes(records, progress)
+    assert (progress.imported, progress.invalid) == (1, 1)
+    assert [(x.recipe.name, x.material.name, x.k_value) for x in model.RecipeMaterial.select()] == [
+        ("C 30/37", "CEM I", None), ("C 30/37", "Popílek", 0.4),
+    ]
+
+
+def test_materials_of_failed_recipe_skipped(imp):
+    imp, progress, *_ = imp
+    # written behind importer's back: bulk insert fails, importer falls back to row by row
+    existing = model.Recipe.create(name="C 25/30")
+    records = [
+        _recipe(1, "C 25/30", ID_CEM_1=1, MNOZ_CEM_1=300),
+        _recipe(2, "C 30/37", ID_CEM_1=1, MNOZ_CEM_1=320),
+    ]
+    imp.import_recipes(records, progress)
+    assert (progress.imported, progress.invalid) == (1, 1)
+    assert existing.materials.count() == 0
+    assert [(x.recipe.name, x.amount) for x in model.RecipeMaterial.select()] == [("C 30/37", 320)]
+
+
+def test_invalid_site_distance(imp):
+    imp, progress, *_ = imp
+    imp.import_sites([_site("Bytový dům", "12"), _site("Sklad", "daleko"), _site("Hala", None)], progress)
+    assert (progress.imported, progress.invalid) == (1, 2)
+    assert [(x.name, x.distance) for x in model.ConstructionSite.select()] == [("Bytový dům", 12)]
@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+from atxdispatch import glo, integrity, model
+
+
+@pytest.fixture
+def db_fn(tmp_path):
+    """DB file with all tables and a few valid records"""
+    fn = str(tmp_path / "db.sqlite3")
+    model.mount_db(fn)
+    model.db.create_tables(model.TABLES)
+    glo.setup = {"rounding_precision": 2}
+    cement = model.Material.create(type="Cement", name="Cement")
+    addition = model.Material.create(type="Addition", name="Addition")
+    recipe = model.Recipe.create(name="C 25/30")
+    model.RecipeMaterial.create(recipe=recipe, material=cement, amount=300)
+    model.RecipeMaterial.create(recipe=recipe, material=addition, amount=30, k_value=0.4)
+    customer = model.Customer.create(name="Metrostav")
+    model.Price.create(customer=customer, type=model.Price.PRICE_TYPE_ABSOLUTE, amount=2000)
+    model.Order.create(r_name="C 25/30", volume=2, auto_number=1)
+    model.db.close()
+    yield fn
+    model.invalidate_caches()
+
+
+def _problems(fn):
+    report = integrity.check_db(fn)
+    return {(table, x["column"], x["check"]): x["count"] for table, result in report["tables"].items() for x in result["problems"]}
+
+
+def _execute(fn, *statements):
+    with sqlite3.connect(fn) as conn:
+        for sql in statements:
+            conn.execute(sql)
+    conn.close()
+
+
+def test_valid_db(db_fn):
+    assert _problems(db_fn) == {}
+
+
+def test_model_rules(db_fn):
+    _execute(
+        db_fn,
+        "UPDATE material SET type = 'Bogus' WHERE name = 'Cement'",
+        'UPDATE "order" SET volume = 0',
+        "UPDATE recipematerial SET k_ratio = 1.2",
+        "INSERT INTO price (customer_id, type, amount) SELECT customer_id, type, amount FROM price",
+        "INSERT INTO lockedtable (user_id, table_name) VALUES (1, 'Order')",
+    )
+    assert _problems(db_fn) == {
+        ("Material", "type", "allowed_type"): 1,
+        ("Order", "volume", "positive"): 1,
+        ("RecipeMaterial", "k_value", "addition_only"): 1,  # Addition may have it
+        ("Price", "recipe_id", "unique_without_recipe"): 2,
+        ("Price", "construction_site_id", "unique_without_construction_site"): 2,
+        ("LockedTable", "table_name", "lockable"): 1,
+        ("LockedTable", "user_id", "foreign_key"): 1,
+    }
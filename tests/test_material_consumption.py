@@ -0,0 +1,33 @@
+from atxdispatch import benchmark, dispatch, model
+from atxdispatch.batch_file import BatchFile
+
+
+def _order(materials_count, auto_number):
+    order = model.Order.create(r_name="C 25/30", volume=1, auto_number=auto_number)
+    for i in range(materials_count):
+        material_type = benchmark.MATERIAL_TYPES[i % len(benchmark.MATERIAL_TYPES)]
+        material = model.Material.create(type=material_type, name=f"M{auto_number}-{i}")
+        model.OrderMaterial.create(order=order, material=material, type=material_type, name=material.name, sequence_number=i, amount=100 + i)
+    return order
+
+
+def _process(tmp_path, materials_count, auto_number):
+    order = _order(materials_count, auto_number)
+    fn = str(tmp_path / f"{order.id}.be2")
+    benchmark.order_be2(fn, order)
+    with model.QueryCounter() as qc:
+        dispatch.update_material_consumption(BatchFile(fn))
+    return order, qc.count
+
+
+def test_constant_query_count(db, tmp_path):
+    _, few_count = _process(tmp_path, 4, 1)
+    order, many_count = _process(tmp_path, 20, 2)
+    assert many_count == few_count
+
+    batch_materials = model.BatchMaterial.select().join(model.OrderMaterial).where(model.OrderMaterial.order == order)
+    assert batch_materials.count() == 20
+    materials = model.Material.select().where(model.Material.name.startswith("M2-"))
+    assert sorted(x.get_stock() for x in materials) == sorted(-(100 + i - 1) for i in range(20))
+    day = model.DailyConsumption.day_of(order.t)
+    assert model.DailyConsumption.select().where(model.DailyConsumption.day == day).count() == 24
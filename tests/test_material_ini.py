@@ -0,0 +1,28 @@
+import os
+
+from atxdispatch import dispatch, model
+
+
+def _save(fn):
+    return dispatch.save_materials_to_ini(model.Material.select(), model.Material.ALLOWED_TYPES, fn)
+
+
+def test_written_only_when_different_from_disk(db, tmp_path):
+    fn = str(tmp_path / "material.ini")
+    model.Material.create(type="Cement", name="CEM I 42,5 R")
+    model.Material.create(type="Water", name="Voda")
+    assert _save(fn)
+    assert not _save(fn)
+
+    os.remove(fn)
+    assert _save(fn)
+
+    with open(fn, "a", encoding="cp1250") as f:
+        f.write("[Foreign]\n")
+    assert _save(fn)
+    with open(fn, encoding="cp1250") as f:
+        assert "Foreign" not in f.read()
+
+    model.Material.create(type="Aggregate", name="Písek 0-4")
+    assert _save(fn)
+    assert not _save(fn)
@@ -0,0 +1,145 @@
+import pytest
+
+from playhouse.migrate import SqliteMigrator, migrate
+
+from atxdispatch import glo, model
+
+
+def _order(**kwargs):
+    order = model.Order.create(r_name="C 25/30", r_price=100, volume=2, auto_number=1, **kwargs)
+    model.Delivery.create(order=order, distance_driven=10, car_price_per_km=3)
+    return order
+
+
+def _stored(order):
+    """Stored prices of <order> as in DB, and as calculated from current data"""
+    order = model.Order.get_by_id(order.id)
+    stored = {x: getattr(order, x) for x in model.Order.PRICE_FIELDS}
+    order.update_prices()
+    return stored, {x: getattr(order, x) for x in model.Order.PRICE_FIELDS}
+
+
+@pytest.fixture
+def update_prices_calls(monkeypatch):
+    calls = []
+    update_prices = model.Order.update_prices
+
+    def counted(self):
+        calls.append(self.id)
+        return update_prices(self)
+    monkeypatch.setattr(model.Order, "update_prices", counted)
+    return calls
+
+
+def test_prices_follow_surcharges_and_deliveries(db):
+    order = _order()
+    order.update_surcharges([
+        {"name": "Winter", "price": 5, "price_type": model.SURCHARGE_PRICE_PER_CUBIC_METER, "unit_name": None},
+        {"name": "Pump", "price": 7, "price_type": model.SURCHARGE_PRICE_FIXED, "unit_name": None},
+    ])
+    stored, calculated = _stored(order)
+    assert stored == calculated
+    assert (stored["price_concrete"], stored["price_transport"], stored["price_surcharges"]) == (200, 30, 17)
+
+    delivery = order.deliveries[0]
+    delivery.distance_driven = 20
+    delivery.save()
+    model.OrderSurcharge.get(model.OrderSurcharge.name == "Pump").delete_instance()
+    stored, calculated = _stored(order)
+    assert stored == calculated
+    assert stored["price_total"] == 200 + 60 + 10
+
+
+def test_recalculated_once_per_batch(db, update_prices_calls):
+    order = _order()
+    update_prices_calls.clear()
+    order.update_surcharges([
+        {"name": f"Surcharge {i}", "price": 1, "price_type": model.SURCHARGE_PRICE_FIXED, "unit_name": None} for i in range(10)
+    ])
+    assert update_prices_calls == [order.id]
+    assert model.Order.get_by_id(order.id).price_surcharges == 10
+
+
+def test_not_recalculated_without_input_change(db, update_prices_calls):
+    order = _order()
+    update_prices_calls.clear()
+    order.change_status(model.Order.STATUS_PRODUCTION)
+    delivery = order.deliveries[0]
+    delivery.car_driver = "Franta"
+    delivery.save()
+    assert update_prices_calls == []
+
+    order.volume = 3
+    order.save()
+    assert update_prices_calls == [order.id]
+    assert model.Order.get_by_id(order.id).price_concrete == 300
+
+
+def test_vat_rate_change(db):
+    order = _order()
+    setup = model.Setup.singleton()
+    setup.company_name = "Betonarna"
+    setup.vat_rate = 10
+    setup.save()
+    assert model.Order.get_by_id(order.id).price_grand_total == 253  # (200 + 30) * 1.1
+
+    setup = model.Setup.singleton()
+    setup.vat_rate = 20
+    setup.save()
+    stored, calculated = _stored(order)
+    assert stored == calculated
+    assert stored["price_grand_total"] == 276
+
+
+def test_transport_zone_change(db):
+    glo.setup["transport_zones"] = True
+    zone = model.TransportZone.create(distance_km_max=100, price_per_m3=10)
+    order, without_transport = _order(), _order(without_transport=True)
+    assert model.Order.get_by_id(order.id).price_transport == 20
+
+    zone.price_per_m3 = 15
+    zone.save()
+    assert model.Order.get_by_id(order.id).price_transport == 30
+    assert model.Order.get_by_id(without_transport.id).price_transport == 0
+
+    model.TransportZone.create(distance_km_min=5, distance_km_max=50, price_per_m3=50)
+    zone.delete_instance()
+    assert model.Order.get_by_id(order.id).price_transport == 100
+
+
+def test_price_columns_calculated_with_loaded_setup(db):
+    glo.setup["transport_zones"] = True
+    model.TransportZone.create(distance_km_max=100, price_per_m3=10)
+    order = _order()
+    migrator = SqliteMigrator(model.db)
+    migrate(*[migrator.drop_column("order", x) for x in model.Order.PRICE_FIELDS])
+    model.DailyRevenue.drop_table()
+
+    # schema migration runs before config file is loaded, so it must not calculate anything
+    glo.setup = {}
+    changes = model.db.connection().total_changes
+    model.ensure_schema()
+    assert model.db.connection().total_changes == changes
+    assert model.Order.get_by_id(order.id).price_total is None
+
+    glo.setup = {"rounding_precision": 2, "transport_zones": True}
+    model.update_stored_prices()
+    stored, calculated = _stored(order)
+    assert stored == calculated
+    assert stored["price_transport"] == 20
+    assert model.DailyRevenue.get().price_total == stored["price_total"]
+
+
+def test_config_change(db, update_prices_calls):
+    model.TransportZone.create(distance_km_max=100, price_per_m3=10)
+    order = _order()
+    model.update_stored_prices()
+    update_prices_calls.clear()
+    model.update_stored_prices()
+    assert update_prices_calls == []
+
+    glo.setup["transport_zones"] = True
+    model.update_stored_prices()
+    assert update_prices_calls == [order.id]
+    assert model.Order.get_by_id(order.id).price_transport == 20
+    assert model.DailyRevenue.get().price_total == 220
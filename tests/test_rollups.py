@@ -0,0 +1,96 @@
+import pytest
+
+from atxdispatch import model
+
+DAY = 86400
+T0 = 1700000000  # 2023-11-14 23:13:20 in UTC, local day depends on settings.TIMEZONE
+
+
+def _rows(rollup):
+    fields = [x for x in rollup._meta.sorted_fields if x is not rollup._meta.primary_key]
+    rows = [tuple(round(x, 6) if isinstance(x, float) else x for x in row) for row in rollup.select(*fields).tuples()]
+    return sorted(rows, key=repr)
+
+
+def _rollups():
+    return {x.__name__: _rows(x) for x in (model.DailyVolume, model.DailyRevenue)}
+
+
+def _rebuilt():
+    current = _rollups()
+    model.rebuild_rollups()
+    return current, _rollups()
+
+
+def _order(**kwargs):
+    values = {"r_name": "C 25/30", "r_price": 100, "volume": 2, "auto_number": 1, "t": T0, **kwargs}
+    return model.Order.create(**values)
+
+
+@pytest.fixture
+def rollup_calls(monkeypatch):
+    calls = []
+    add = model._DailyRollup.add.__func__
+
+    def counted(cls, rows):
+        rows = list(rows)
+        calls.append((cls.__name__, len(rows)))
+        return add(cls, rows)
+    monkeypatch.setattr(model._DailyRollup, "add", classmethod(counted))
+    return calls
+
+
+def test_incremental_equals_rebuilt(db):
+    orders = [_order(customer=None if i % 3 else f"Customer {i % 2}", t=T0 + i * DAY // 3, payment_type=i % 2) for i in range(12)]
+    orders[0].volume = 5
+    orders[0].save()
+    orders[1].t += 4 * DAY
+    orders[1].customer = "Customer 9"
+    orders[1].save()
+    orders[2].payment_type = model.PAYMENT_CARD
+    orders[2].r_price = 120
+    orders[2].save()
+    orders[3].delete_instance()
+    current, rebuilt = _rebuilt()
+    assert current == rebuilt
+    assert sum(x[4] for x in current["DailyVolume"]) == 11  # orders_count
+
+
+def test_null_keys_share_row(db):
+    for _ in range(3):
+        _order(customer=None, construction_site=None, payment_type=None)
+    assert model.DailyVolume.select().count() == model.DailyRevenue.select().count() == 1
+    assert model.DailyVolume.get().orders_count == 3
+
+
+def test_moved_order_leaves_no_empty_row(db):
+    order = _order(customer="A")
+    order.customer = "B"
+    order.save()
+    assert [x.customer for x in model.DailyVolume.select()] == ["B"]
+    order.delete_instance()
+    assert _rollups() == {"DailyVolume": [], "DailyRevenue": []}
+
+
+def test_unrelated_change_does_not_touch_rollups(db, rollup_calls):
+    order = _order()
+    rollup_calls.clear()
+    order.change_status(model.Order.STATUS_PRODUCTION)
+    order.comment = "Call before arrival"
+    order.save()
+    assert rollup_calls == []
+
+    order.volume = 3
+    order.save()
+    assert rollup_calls == [("DailyVolume", 2), ("DailyRevenue", 2)]
+
+
+def test_consumption_one_upsert(db):
+    def add(count):
+        rows = [{"day": 20240101, "material": f"M{i}", "amount_recipe": 10, "amount_rq": None, "amount_e1": 9} for i in range(count)]
+        with model.QueryCounter() as qc:
+            model.DailyConsumption.add(rows + rows[:1])
+        return qc.count
+    assert add(40) == add(4)
+    assert [(x.material, x.amount_recipe, x.amount_rq, x.amount_e1) for x in model.DailyConsumption.select().where(model.DailyConsumption.material == "M0")] == [("M0", 40, 0, 36)]
+    assert model.DailyConsumption.select().count() == 40
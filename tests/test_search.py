@@ -0,0 +1,40 @@
+from atxdispatch import model, search
+
+
+def _changes():
+    return model.db.execute_sql("SELECT total_changes()").fetchone()[0]
+
+
+def _trigger_sql(name):
+    return model.db.execute_sql("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).fetchone()[0]
+
+
+def test_search_follows_changes(db):
+    search.ensure_search_indexes()
+    order = model.Order.create(r_name="C 25/30 XC2", volume=1, auto_number=1, customer="Metrostav", comment="Pozor, úzká cesta")
+    assert search.search_ids("Order", "metro uzka") == [order.id]
+    order.customer = "Skanska"
+    order.save()
+    assert search.search_ids("Order", "metro") == []
+    assert search.search_ids("Order", "skan xc2") == [order.id]
+    order.delete_instance()
+    assert search.search_ids("Order", "skan") == []
+
+
+def test_index_untouched_without_text_change(db):
+    search.ensure_search_indexes()
+    order = model.Order.create(r_name="C 25/30", volume=1, auto_number=1, customer="Metrostav")
+    changes = _changes()
+    order.change_status(model.Order.STATUS_PRODUCTION)
+    assert _changes() - changes == 1  # just the order, trigger did not write into index
+    assert search.search_ids("Order", "metro") == [order.id]
+
+
+def test_outdated_trigger_replaced(db):
+    search.ensure_search_indexes()
+    current = _trigger_sql("order_search_au")
+    model.db.execute_sql("DROP TRIGGER order_search_au")
+    model.db.execute_sql('CREATE TRIGGER order_search_au AFTER UPDATE OF comment ON "order" BEGIN SELECT 1; END')
+    search.ensure_search_indexes()
+    assert _trigger_sql("order_search_au") == current
+    assert "WHEN" in current
@@ -0,0 +1,52 @@
+from atxdispatch import model
+
+
+def _materials(count):
+    return [model.Material.create(name=f"M{i}", type="Aggregate") for i in range(count)]
+
+
+def _balances():
+    return {x.material_id: x.amount for x in model.StockBalance.select()}
+
+
+def _movement_sums():
+    query = model.StockMovement.select(model.StockMovement.material, model.fn.SUM(model.StockMovement.amount)).group_by(model.StockMovement.material)
+    return dict(query.tuples())
+
+
+def _insert_query_count(materials):
+    with model.QueryCounter() as qc:
+        model.StockMovement.insert_movements([{"material": x, "amount": -10} for x in materials])
+    return qc.count
+
+
+def test_balance_follows_movements(db):
+    m1, m2 = _materials(2)
+    model.StockMovement.insert_movements([{"material": m1, "amount": 100}, {"material": m2.id, "amount": 50}, {"material": m1, "amount": -30}])
+    movement = model.StockMovement.create(material=m1, amount=5)
+    assert _balances() == {m1.id: 75, m2.id: 50}
+
+    movement.material = m2
+    movement.amount = 7
+    movement.save()
+    assert _balances() == {m1.id: 70, m2.id: 57}
+    movement.delete_instance()
+    assert _balances() == _movement_sums() == {m1.id: 70, m2.id: 50}
+
+
+def test_constant_query_count(db):
+    materials = _materials(40)
+    assert _insert_query_count(materials) == _insert_query_count(materials[:4])
+    assert _balances() == _movement_sums() == {x.id: -20 if i < 4 else -10 for i, x in enumerate(materials)}
+
+
+def test_edit_is_one_upsert(db):
+    m1, m2 = _materials(2)
+    with model.QueryCounter() as created:
+        movement = model.StockMovement.create(material=m1, amount=5)
+    movement.material = m2
+    movement.amount = 8
+    with model.QueryCounter() as edited:
+        movement.save()
+    assert edited.count == created.count + 1  # just reading the old movement on top of that
+    assert _balances() == {m1.id: 0, m2.id: 8}
@@ -0,0 +1,78 @@
+import ctypes
+import os
+import sys
+
+import pytest
+
+from atxdispatch import watcher
+
+inotify_only = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+
+
+def _write(path, fn, text="x"):
+    with open(path / fn, "w") as f:
+        f.write(text)
+
+
+def _names(ffns):
+    return sorted(os.path.basename(x) for x in ffns)
+
+
+def _check_new_and_renamed(w, path):
+    """<w> reports files written into <path> and renamed within it, not temporary names or directories"""
+    _write(path, "1.be2")
+    (path / "subdir").mkdir()
+    assert _names(w.pending()) == ["1.be2"]
+    os.remove(path / "1.be2")
+
+    _write(path, "2.ord_")
+    os.rename(path / "2.ord_", path / "2.ord")
+    _write(path, "3.be2")
+    assert _names(w.pending()) == ["2.ord", "3.be2"]
+
+
+def test_polling_reports_new_and_renamed_files(tmp_path):
+    w = watcher.PollingWatcher(str(tmp_path))
+    assert w.pending() == []
+    _check_new_and_renamed(w, tmp_path)
+
+
+@inotify_only
+def test_inotify_reports_new_and_renamed_files(tmp_path):
+    _write(tmp_path, "0.be2")  # left there before start
+    w = watcher.InotifyWatcher(str(tmp_path))
+    try:
+        assert _names(w.pending()) == ["0.be2"]
+        os.remove(tmp_path / "0.be2")
+        _check_new_and_renamed(w, tmp_path)
+        assert w.pending() == []
+        _write(tmp_path, "4.be2")
+        w.wait(5)  # returns as soon as the file is there
+        assert _names(w.pending()) == ["4.be2"]
+    finally:
+        w.close()
+
+
+@pytest.mark.parametrize("error", [OSError(24, "Too many open files"), AttributeError("inotify_init1")])
+def test_falls_back_to_polling(tmp_path, monkeypatch, error):
+    def unavailable(*args, **kwargs):
+        raise error
+    monkeypatch.setattr(ctypes, "CDLL", unavailable)
+    monkeypatch.setattr(sys, "platform", "linux")
+    monkeypatch.setattr(watcher.settings, "WATCHER", "auto")
+    w = watcher.get_watcher(str(tmp_path))
+    assert isinstance(w, watcher.PollingWatcher)
+    _check_new_and_renamed(w, tmp_path)
+
+    monkeypatch.setattr(watcher.settings, "WATCHER", "inotify")  # explicitly required, must not fall back
+    with pytest.raises(type(error)):
+        watcher.get_watcher(str(tmp_path))
+
+
+def test_polling_elsewhere(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "platform", "win32")
+    monkeypatch.setattr(watcher.settings, "WATCHER", "auto")
+    assert isinstance(watcher.get_watcher(str(tmp_path)), watcher.PollingWatcher)
+    monkeypatch.setattr(sys, "platform", "linux")
+    monkeypatch.setattr(watcher.settings, "WATCHER", "polling")
+    assert isinstance(watcher.get_watcher(str(tmp_path)), watcher.PollingWatcher)